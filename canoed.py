@@ -25,9 +25,9 @@ import license
 # Standard imports
 
 import argparse
+import collections
 import cx_Oracle
 import datetime
-import errno
 import hashlib
 import os
 import sys
@@ -35,12 +35,13 @@ import sys
 # Canøe imports
 
 import canoedb as cdb
+import canoestats
 import canoeconfig as cc
 import canoecrypter as cxx
 import canoeenv
 import executive
-import fifo
 import importlib
+import jobqueue
 import jparse as jp
 import loader
 from   reanimator import ReAnimator
@@ -50,6 +51,7 @@ import time
 import tombstone as tomb
 from   urdecorators import show_exceptions_and_frames as trap
 import urutils as uu
+import workerpool
 
 #####################################
 ############# BEGIN #################
@@ -74,6 +76,7 @@ def handler(signum:int, stack:object=None) -> None:
 
     elif signum in [ signal.SIGUSR2, signal.SIGQUIT, signal.SIGINT ]:
         tomb.tombstone('Closing up.')
+        if pool is not None: pool.shutdown()
         uu.fclose_all()
         sys.exit(os.EX_OK)
 
@@ -96,6 +99,12 @@ known_events = ['run','alert']
 available_cpus = len(os.sched_getaffinity(0))
 retry_counter = 0
 max_retries = 0
+pool = None
+queue = None
+leased = None
+pool_size = int(os.environ.get('CANOE_WORKERS', available_cpus))
+recycle_after = int(os.environ.get('CANOE_RECYCLE', 50))
+rotate_every = float(os.environ.get('CANOE_LOG_ROTATE_HOURS', 24)) * 3600
 
 @trap
 def canoed(pipe_affinity:str='') -> None: 
@@ -117,20 +126,26 @@ def canoed(pipe_affinity:str='') -> None:
 
     global pipe_name, known_events
     global available_cpus, retry_counter, max_retries
+    global pool_size, recycle_after, rotate_every
+    global pool, queue, leased
 
     if pipe_name is None:
         # First time through, only.
         pipe_name = pipe_affinity
 
-    try:
-        pipe = fifo.FIFO(pipe_name, 'non_block')
-    except Exception as e:
-        uu.tombstone(uu.type_and_text(e))
-        tomb.tombstone(f'unable to use {pipe_name}')
-        sys.exit(os.EX_NOINPUT)
+    # The queue, the pool, and the jobs in flight survive a reload; 
+    # only a cold start replays the jobs that were left unfinished.
+    cold_start = queue is None
+    if cold_start:
+        try:
+            queue = jobqueue.JobQueue(pipe_name, 'r')
+        except Exception as e:
+            uu.tombstone(uu.type_and_text(e))
+            tomb.tombstone(f'unable to use {pipe_name}')
+            sys.exit(os.EX_NOINPUT)
 
     tomb.tombstone('THIS IS CANOE 20!')
-    tomb.tombstone(f'Reading events from the pipe named {pipe_name}.')
+    tomb.tombstone(f'Reading events from the queue named {pipe_name}.')
 
     # Our name will reflect the pipe from which we are reading.
     setproctitle('canoed:' + pipe_name)
@@ -153,138 +168,200 @@ def canoed(pipe_affinity:str='') -> None:
 
     if count <= 0: sys.exit(os.EX_CONFIG)
 
-    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
-    tomb.tombstone("Child signals will be ignored.")
+    # Find every plugin that the programs use now, before the workers
+    # are forked, so that they inherit the lookups. The code may have 
+    # just been reloaded, so forget what we found the last time.
+    executive.entry_points.clear()
+    for name, program in programs.items():
+        try:
+            executive.resolve(program)
+        except Exception as e:
+            tomb.tombstone(str(e))
+    tomb.tombstone(f"Resolved {len(executive.entry_points)} plugins.")
+
+    # The workers are reaped with wait4() so that we learn how they
+    # ended and what they cost. Leaving SIGCHLD at its default also
+    # means that the workers (which inherit it) can wait for the 
+    # subprocesses that the plugins start, and count what they cost.
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    try:
+        stats = canoestats.default()
+    except Exception as e:
+        stats = None
+        tomb.tombstone(f"Resource usage will not be recorded: {uu.type_and_text(e)}")
+
+    # zero is the least nice a non-priv process can be. The function returns
+    # the current niceness.
+    my_niceness = os.nice(0)
+
+    def warmup() -> None:
+        """
+        Run once in each new worker. The plugins were imported by the 
+        ReAnimator before the fork, so what remains is to give the 
+        worker its own database handles, drop the queue, and leave the
+        reloading signals to the parent.
+        """
+        for _ in ( signal.SIGHUP, signal.SIGUSR1, signal.SIGRTMIN+1 ):
+            signal.signal(_, signal.SIG_IGN)
+        queue.close()
+        # Each niceness level is 10%, so this makes our worker 
+        # twice as nice as the parent.
+        os.nice(my_niceness+6)
+        tomb.reopen()
+        setproctitle('canoed:' + pipe_name + ':worker')
+
+
+    def run_job(name:str) -> Tuple[int, str]:
+        """
+        Run one job in a worker. This is what the child of the fork
+        used to do, except that the worker survives to run the next one.
+
+        returns -- the exit code, and the job's serial number.
+        """
+        child_exit = os.EX_OK
+        sn = None
+        proctitle = getproctitle()
+        uu.tombstone(f'Worker process {os.getpid()} begins {name}.')
+        try:
+            # Change our name so that we show up correctly in ps
+            setproctitle(proctitle + ':' + name)
+
+            # The accumulator counts the steps of execution in 
+            # the process. If the worker has been running a while
+            # it is up in the many thousands; we want zero. 
+            uu.Accumulator.reset()
+
+            # An executive is a module that executes a recipe. So we
+            # build one, get the recipe, resolve any bindings, and
+            # then attach and run it. Straightforward.
+            sn = uu.new_serial_number()
+            tomb.tombstone(f'Child s/n: {sn} assigned to task {name}')
+
+            opcodes = programs.get(name)
+            if opcodes is None:
+                tomb.tombstone(f'No opcodes found for {name}')
+                return os.EX_NOINPUT, sn
+
+            guido = executive.Executive(opcodes, sn)
+            guido.exec()
+
+        except SystemExit as e:
+            # The executive stops a recipe with sys.exit(); that ends
+            # the job, not the worker.
+            child_exit = e.code if isinstance(e.code, int) else os.EX_OK
+
+        except Exception as e:
+            child_exit = os.EX_OSERR
+            tomb.tombstone('Terminal error in child process.')
+            uu.fatalerror()
+
+        finally:
+            uu.tombstone(f'Worker process {os.getpid()} ended {name}.')
+            setproctitle(proctitle)
+
+        return child_exit, sn
+
+
+    def classes_of(name:str) -> List[str]:
+        """
+        The compiler puts the recipe's concurrency classes in its opcodes.
+        """
+        return (programs.get(name) or {}).get('concurrency') or ()
+
+
+    if pool is None:
+        pool = workerpool.WorkerPool(pool_size, recycle_after, 
+            job=run_job, warmup=warmup, classes_of=classes_of)
+        tomb.tombstone(f"Started {pool.start()} workers; each retires after {recycle_after} jobs.")
+    else:
+        # The busy workers finish what they are doing and report back
+        # to us before they are replaced.
+        replaced = pool.reload(job=run_job, warmup=warmup, classes_of=classes_of)
+        pool.start()
+        tomb.tombstone(f"Replaced {replaced} idle workers; {len(pool.busy_workers())} busy ones follow.")
+    tomb.tombstone(f"Concurrency limits: {pool.admission.limits}")
 
     # We put the main event loop in a try block so that we can execute
     # the finally block at the end. To ensure that we do not raise 
     # additional exceptions, we introduce all the names used inside
     # the try block.
-    db = cdb.default()
     events = []
-    event = ''
-    pid = 0
-    sn = 0
-    guido = None
-    db_timeout = 7200
-    db_connected = time.time()
-
-    # zero is the least nice a non-priv process can be. The function returns
-    # the current niceness.
-    my_niceness = os.nice(0)
+    readable = []
+    timeout = 60
+
+    # Jobs that we took from the queue, and have not finished, by name.
+    # They are acknowledged when they finish; if we die first, the next
+    # canoed runs them again.
+    if leased is None: leased = collections.defaultdict(collections.deque)
+    if cold_start: queue.replay()
+    check_queue = True
+
+    # The log is kept to a bounded size by moving the old rows to the
+    # archives. We do it now, and then every rotate_every seconds.
+    log = cdb.default()
+    missing = log.missing_log_indexes()
+    if missing: 
+        tomb.tombstone(f"canoe_log is missing the indexes {missing}; run logmaint in the console.")
+    next_rotation = time.time()
 
     stop_after = False
     try:
         parent_exit = os.EX_OK # I try to be optimistic.
-        while not stop_after:
+        while not (stop_after and pool.quiet()):
             # This is the beginning of the main event loop. The only way
-            # to leave is via an Exception.
+            # to leave is via an Exception, or a stop instruction after
+            # the work in hand is done.
 
             try:
-                # Get anything in the pipe.
-                events = pipe(60*60*24) # All day, if necessary.
-                if len(events): uu.tombstone(f'read {events} from pipe.')
-
-                for name in [_.strip() for _ in events]:
-                    stop_after = name == 'stop'
-                    if stop_after: 
-                        tomb.tombstone("Read shutdown instruction. Stopping after pipe is emptied.")
-
-                    # Put the brakes on a run away process that has loaded up the 
-                    # pipe. For example, if we have been offline for a while, then
-                    # the pipe could have several hundred events in it.
-                    while os.getloadavg()[0] > available_cpus:
-                        uu.tombstone('too busy {}.'.format(os.getloadavg()))
-                        time.sleep(10)
-
-                    # Run each integration in its own process. According to the 
-                    # multiprocessing module's documentation, an OSError is
-                    # raised if fork fails -- a slight difference from 
-                    # `man 2 fork`.
-                    try:
-                        time.sleep(4)
-                        pid = os.fork()
-                    except OSError as e:
-                        raise Exception("fork failed!") from e
-
-                    if not pid:  
-                        uu.tombstone(f'Child process {os.getpid()} begun.')
-                        ###
-                        # Behold, a child is born. It needs its own try-block
-                        # to handle its exceptions because we need to keep it
-                        # from bubbling up and having an indefinite life span
-                        # as a copy of canoed that reads the pipe.
-                        ###
-                        # Each niceness level is 10%, so this makes our child 
-                        # twice as nice as the parent.
-                        os.nice(my_niceness+6)
-                        child_exit = os.EX_OK
-
-                        try:
-                            # Change our name so that we show up correctly in ps
-                            setproctitle(getproctitle() + ':' + name)
-
-                            # The accumulator counts the steps of execution in 
-                            # the process. If the parent has been running a while
-                            # it is up in the many thousands; we want zero. 
-                            uu.Accumulator.reset()
-
-                            # Let any canoetop procs know that we are running.
-                            # for _ in uu.pids_of('canoetop', True): 
-                            #     os.kill(_, signal.SIGUSR1)
-
-                            # An executive is a module that executes a recipe. So we
-                            # build one, get the recipe, resolve any bindings, and
-                            # then attach and run it. Straightforward.
-                            # Canøe will attempt to repurpose an already open database
-                            # connection.
-
-                            sn = uu.new_serial_number()
-
-                            tomb.tombstone(f'Child s/n: {sn} assigned to task {name}')
-
-                            opcodes = programs.get(name)
-                            if opcodes is None:
-                                tomb.tombstone(f'No opcodes found for {name}')
-                                os._exit(os.EX_NOINPUT)
-
-                            guido = executive.Executive(programs[name], sn)
-                            guido.exec()
-
-
-                        except Exception as e:
-
-                            child_exit = os.EX_OSERR
-                            tomb.tombstone('Terminal error in child process.')
-                            uu.fatalerror()
-                
-                        finally:
-                            uu.tombstone(f'Child process {os.getpid()} ended.')
-                            # Always hang up your boots.
-                            os._exit(child_exit)
-
-                    elif pid > 0: 
-                        ###
-                        # Parent code.
-                        ###
-                        # Write down what we did. 
-                        uu.tombstone(f"Forked: {name}")
-                        continue
-
-                    elif pid < 0:
-                        ###
-                        # This is not really the child's pid; it is the negative of
-                        # the signal number that killed the child process.
-                        ###
-                        e = errno.errorcode
-                        tomb.tombstone("child terminated by signal {}.".format(-1*pid))
-
-                ########## ACHTUNG! ####################################
-                # This continue statement jumps up to the beginning    #
-                # of the >while True< loop. It is outside the 'for'.   #
-                ########################################################
-                # tomb.tombstone('continuing w/o catching an exception.')
-                continue
+                # Sleep until the doorbell rings, or a worker reports 
+                # back. Once we have been told to stop, we only listen
+                # to the workers. The timeout is a backstop in case a 
+                # ring is ever missed.
+                if not check_queue:
+                    readable = pool.wait([] if stop_after else [queue.fileno()], timeout)
+                    check_queue = not stop_after and (queue.fileno() in readable or not readable)
+
+                if check_queue:
+                    events = queue.lease()
+                    if len(events): uu.tombstone(f'read {[_[1] for _ in events]} from queue.')
+
+                    for job_id, name in events:
+                        if name == 'stop':
+                            queue.ack(job_id)
+                            stop_after = True
+                            tomb.tombstone("Read shutdown instruction. Stopping after queue is emptied.")
+                            continue
+                        leased[name].append(job_id)
+                        pool.submit(name)
+                    check_queue = False
+
+                for name, code, usage in pool.collect(readable):
+                    if leased[name]: queue.ack(leased[name].popleft())
+                    if stats is not None: stats.record_usage(name, code, usage)
+
+                # A job whose worker died goes back in the queue.
+                while pool.lost:
+                    name = pool.lost.popleft()
+                    if leased[name]: queue.requeue(leased[name].popleft())
+                    check_queue = True
+                pool.reap()
+
+                # Start whatever will fit. The number of workers caps the
+                # total, and the concurrency classes cap the jobs that
+                # share a resource. A job that does not fit stays in the 
+                # backlog until a worker in its class reports back, which 
+                # wakes us up.
+                pool.dispatch()
+                if pool.backlog and pool.idle_workers():
+                    uu.tombstone(f"{len(pool.backlog)} jobs held; running {pool.admission}")
+
+                # A big backlog of old rows is moved a piece at a time,
+                # so that the jobs are not kept waiting.
+                if rotate_every and time.time() >= next_rotation:
+                    moved = log.rotate_log(most=100000)
+                    tomb.tombstone(f"Moved {moved} log rows to the archives.")
+                    next_rotation = time.time() + (60 if moved >= 100000 else rotate_every)
 
             except OSError as e:
                 tomb.tombstone(uu.type_and_text(e))
@@ -296,11 +373,6 @@ def canoed(pipe_affinity:str='') -> None:
                 tomb.tombstone(str(e))
                 raise 
 
-            else:
-                # Again, this is back to >while True<
-                tomb.tombstone('continuing via else')
-                continue 
-
         # End of WHILE
         if stop_after:
             tomb.tombstone('stopping as instructed.')
@@ -310,6 +382,7 @@ def canoed(pipe_affinity:str='') -> None:
 
     finally:
         tomb.tombstone('exiting via finally.')
+        pool.shutdown()
         sys.exit(parent_exit)
 
 
@@ -329,7 +402,13 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--pipe', type=str, required=True)
+    parser.add_argument('--workers', type=int, default=pool_size,
+        help="number of pre-forked workers.")
+    parser.add_argument('--recycle', type=int, default=recycle_after,
+        help="retire a worker after this many jobs; 0 means never.")
     my_args = parser.parse_args()
+    pool_size = my_args.workers
+    recycle_after = my_args.recycle
     try:
         canoed(my_args.pipe)
 
@@ -6,5 +6,6 @@ __all__ = [
     'grammar',
     'tombstone',
     'loader',
-    'recipe'
+    'recipe',
+    'workerpool'
     ]
@@ -30,6 +30,7 @@ import time
 
 from   canoebrowser import ScheduleBrowser
 import canoedb as cdb
+import canoestats
 import canoelib as cl
 import fifo
 from   fifo import FIFO
@@ -119,7 +120,7 @@ statuses = {
 canoe_processes = {
     "canoe:console":"This program. Allows interaction with the daemons.",
     "canoearkd":"Interfaces with CyberArk.",
-    "canoed":"The execution daemon. Bound to a single OAQ. Forks for each task.",
+    "canoed":"The execution daemon. Bound to a single OAQ. Hands each task to a pre-forked worker.",
     "canoelockd":"Processes to keep network shares active.",
     "canoelogd":"Writes the logfiles and the database tables that contain logging info.",
     "canoenagd":"Constructs packets for Nagios IX.",
@@ -583,26 +584,31 @@ class CanoeConsole(cmd.Cmd):
             self.do_help('review')
             return
 
-        use_sn = len(args) > 4 
-
-        SQL = {
-            True  : f"SELECT * FROM canoe_log WHERE serial_number LIKE '{args}%'",
-            False : f"""SELECT * FROM canoe_log 
-                WHERE serial_number LIKE '%{args}' """
-            }
-        order = " ORDER BY serial_number, sequence_number ASC"
-
-        QUERY = SQL[use_sn] + order
-        frame = self.db.execute_SQL(QUERY)
-        if frame.empty:
+        if self.db.missing_log_indexes():
+            print('The log is not fully indexed, so this may be slow; see logmaint.')
+        rows = self.db.review(args.strip())
+        if not rows:
             print('Nothing matching your search criteria')
             return 
 
-        start = frame.iloc[0]['microtime']
-        for i in range(frame.shape[0]):
-            row = frame.iloc[i]
-            elapsed = round(row['microtime'] - start, 3)
-            print(f"{elapsed:7.3f} {row['message']}")
+        start = rows[0][0]
+        print("\n".join(f"{round(t - start, 3):7.3f} {message}" for t, message in rows))
+
+
+    @trap
+    def do_logmaint(self, args:str="") -> None:
+        """
+        Build any missing indexes on the log, and give its free pages 
+        back to the file system. The log is locked while this runs, so
+        choose a quiet time.
+
+        Syntax: logmaint
+        """
+        started = time.time()
+        built = self.db.check_log_indexes()
+        print(f"Built {len(built)} indexes {built}." if built else "The log is fully indexed.")
+        before, after = self.db.compact_log()
+        print(f"The log went from {before} to {after} pages in {time.time()-started:.1f}s.")
 
 
     @trap
@@ -1176,6 +1182,48 @@ class CanoeConsole(cmd.Cmd):
             print('You pressed control-C.')
             
 
+    @trap
+    def do_usage(self, args:str='') -> None:
+        """
+        Show what the recipes cost to run, as percentiles over their 
+        most recent runs.
+
+        Syntax: usage [recipe-prefix] [runs]
+
+            recipe-prefix -- only the recipes whose names begin with it.
+            runs -- how many recent runs of each recipe to use; the 
+                default is 100.
+
+        For each recipe, the three numbers in each column are the 50th,
+        90th, and 99th percentiles. Wall time and CPU are in seconds,
+        peak RSS is in MB, and I/O is in blocks read and written.
+        """
+        args = args.split()
+        runs = int(args.pop()) if args and args[-1].isdigit() else 100
+        prefix = args[0] if args else ''
+
+        try:
+            summary = canoestats.default().usage_percentiles(prefix + '%', runs)
+        except Exception as e:
+            print(f"Cannot read the stats database: {uu.type_and_text(e)}")
+            return
+
+        if not summary:
+            print('Nothing matching your search criteria')
+            return
+
+        def three(values:list, scale:float=1) -> str:
+            return "/".join('-' if _ is None else f"{_/scale:.1f}" for _ in values)
+
+        print("{:<30} {:>5} {:>20} {:>20} {:>20} {:>20}".format(
+            'recipe', 'runs', 'wall s', 'cpu s', 'peak MB', 'I/O blocks'))
+        print("-"*120)
+        for name, x in sorted(summary.items()):
+            print("{:<30} {:>5} {:>20} {:>20} {:>20} {:>20}".format(
+                name[:30], x['runs'], three(x['elapsed']), three(x['cpu']),
+                three(x['maxrss'], 1024), three(x['io'])))
+
+
     @trap
     def do_version(self, arg: str=None) -> None:
         """ 
@@ -15,6 +15,7 @@ import re
 import signal
 import sqlitedb
 import socket
+import sqlite3
 import sys
 import time
 
@@ -38,6 +39,35 @@ import license
 
 class CanoeCrypter: pass
 
+###
+# Decrypted credentials, kept for the life of the process (or at most
+# $CANOE_CRED_TTL seconds, so that a change made elsewhere is seen).
+# Each entry is (expires, value), keyed on (k_family, k), or on 
+# (k_family, None) for the whole family. add_credential() empties it.
+###
+credential_ttl = float(os.environ.get('CANOE_CRED_TTL', 300))
+credential_cache = {}
+credential_indexes_checked = False
+
+###
+# The log. Rows older than $CANOE_LOG_DAYS are moved, a month to a 
+# file, into $CANOE_LOG_ARCHIVE/canoe_log.YYYYMM.db, and the archives
+# are kept for $CANOE_LOG_MONTHS months. canoed does this once every
+# $CANOE_LOG_ROTATE_HOURS. Building the indexes and shrinking the file
+# lock the log for a long time, so they are done from the console 
+# (logmaint), not by canoed.
+###
+log_days = int(os.environ.get('CANOE_LOG_DAYS', 90))
+log_months = int(os.environ.get('CANOE_LOG_MONTHS', 12))
+log_archive = os.environ.get('CANOE_LOG_ARCHIVE', '/sw/canoe/databases/archive')
+log_batch = 10000
+log_vacuum_pages = int(os.environ.get('CANOE_LOG_VACUUM_PAGES', 2000))
+
+
+def invalidate_credentials() -> None:
+    credential_cache.clear()
+
+
 class CanoeDB(sqlitedb.SQLiteDB):
     """ 
     CanoeDB is nothing but a gossamer shell to keep the code
@@ -45,6 +75,44 @@ class CanoeDB(sqlitedb.SQLiteDB):
     in the configuration file. 
     """
 
+    credential_indexes = (
+        "CREATE INDEX IF NOT EXISTS credentials_by_name ON credentials(k_family, k)",
+        "CREATE INDEX IF NOT EXISTS credentials_by_key ON credentials(k)"
+        )
+    credential_stmt = "SELECT v FROM credentials WHERE k_family = ? AND k = ?"
+    family_stmt = "SELECT k, v FROM credentials WHERE k_family = ? ORDER BY k"
+    key_stmt = "SELECT v FROM credentials WHERE k = ?"
+    all_credentials_stmt = "SELECT k, v, k_family FROM credentials ORDER BY k_family, k"
+
+    # The hash in a serial number is its last four characters, so the 
+    # suffix index is on those.
+    log_indexes = {
+        'canoe_log_by_sn': "CREATE INDEX IF NOT EXISTS canoe_log_by_sn ON canoe_log(serial_number, sequence_number)",
+        'canoe_log_by_hash': "CREATE INDEX IF NOT EXISTS canoe_log_by_hash ON canoe_log(substr(serial_number, -4), serial_number)",
+        'canoe_log_by_time': "CREATE INDEX IF NOT EXISTS canoe_log_by_time ON canoe_log(microtime)",
+        'canoe_log_by_recipe': "CREATE INDEX IF NOT EXISTS canoe_log_by_recipe ON canoe_log(recipe, microtime)"
+        }
+    log_index_names_stmt = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'canoe_log'"
+    review_by_prefix_stmt = """SELECT microtime, message FROM canoe_log 
+        WHERE serial_number >= ? AND serial_number < ?
+        ORDER BY serial_number, sequence_number"""
+    review_by_hash_stmt = """SELECT microtime, message FROM canoe_log 
+        WHERE substr(serial_number, -4) = ?
+        ORDER BY serial_number, sequence_number"""
+    review_by_suffix_stmt = """SELECT microtime, message FROM canoe_log 
+        WHERE substr(serial_number, -4) LIKE ?
+        ORDER BY serial_number, sequence_number"""
+    old_months_stmt = """SELECT DISTINCT strftime('%Y%m', microtime, 'unixepoch', 'localtime')
+        FROM canoe_log WHERE microtime < ?"""
+    archive_stmt = """INSERT INTO archive.canoe_log SELECT * FROM main.canoe_log 
+        WHERE rowid IN (SELECT rowid FROM main.canoe_log WHERE microtime < ? 
+            AND strftime('%Y%m', microtime, 'unixepoch', 'localtime') = ? 
+            ORDER BY rowid LIMIT ?)"""
+    unarchived_stmt = """DELETE FROM main.canoe_log WHERE rowid IN (
+        SELECT rowid FROM main.canoe_log WHERE microtime < ? 
+            AND strftime('%Y%m', microtime, 'unixepoch', 'localtime') = ? 
+            ORDER BY rowid LIMIT ?)"""
+
     @trap
     def add_credential(self, sn:int, 
             k_family:str, k:str, v:str, desc:str, plain_text:bool=False) -> None:
@@ -69,6 +137,7 @@ class CanoeDB(sqlitedb.SQLiteDB):
         self.execute_SQL(SQL1, k_family, k)
         self.execute_SQL(SQL2, k, k_family, v)
         self.commit()
+        invalidate_credentials()
         self.execute_SQL(SQL3, sn, 0, time.time(), 'cred-change', f"cred-change {k_family}:{k}")
 
 
@@ -90,21 +159,205 @@ class CanoeDB(sqlitedb.SQLiteDB):
         gotten = "ALL" if not k_family else k_family
         gotten += ":ALL" if not k else (":"+k)
 
-        results = self.get_credentials(and_decrypt)
+        if not k_family or not and_decrypt:
+            results = self.get_credentials(and_decrypt)
+            if not k_family and not k: return results
+            elif not k:  
+                try:
+                    return {k_family: results[k_family]}
+                except:
+                    return "Nothing matching " + str(k_family)
+            else:        
+                try:
+                    return {k_family: {k: results[k_family][k]}}
+                except:
+                    return "Nothing matching " + str(k_family) + " and " + str(k)
+
+        if not k:
+            family = self.get_credential_family(k_family)
+            return {k_family: family} if family else "Nothing matching " + str(k_family)
+
+        value = self.get_credential(k_family, k)
+        return ( {k_family: {k: value}} if value is not None else
+            "Nothing matching " + str(k_family) + " and " + str(k) )
+
+
+    def _check_credential_indexes(self) -> None:
+        """
+        Make sure the lookups by name are indexed. Once per process is
+        enough.
+        """
+        global credential_indexes_checked
+        if credential_indexes_checked: return
+        try:
+            for stmt in CanoeDB.credential_indexes: self.cursor.execute(stmt)
+            self.commit()
+        except sqlite3.Error as e:
+            uu.tombstone(f"cannot index the credentials: {e}")
+        credential_indexes_checked = True
 
-        if not k_family and not k: return results
-        elif not k:  
-            try:
-                return {k_family: results[k_family]}
-            except:
-                return "Nothing matching " + str(k_family)
 
-        else:        
+    @trap
+    def get_credential(self, k_family:str, k:str) -> Union[str, None]:
+        """
+        Look up one credential, and decrypt only it.
+
+        returns -- the value, or None if there is no such credential.
+        """
+        now = time.time()
+        try:
+            expires, value = credential_cache[(k_family, k)]
+            if expires > now: return value
+        except KeyError as e:
+            pass
+
+        self._check_credential_indexes()
+        row = self.cursor.execute(CanoeDB.credential_stmt, (k_family, k)).fetchone()
+        value = None if row is None else reveal(row[0])
+        credential_cache[(k_family, k)] = (now + credential_ttl, value)
+        return value
+
+
+    @trap
+    def get_credential_family(self, k_family:str) -> Dict[str, str]:
+        """
+        Look up all the credentials in one family, and decrypt them.
+
+        returns -- {k: value}, empty if there are none.
+        """
+        now = time.time()
+        try:
+            expires, family = credential_cache[(k_family, None)]
+            if expires > now: return dict(family)
+        except KeyError as e:
+            pass
+
+        self._check_credential_indexes()
+        family = { k: reveal(v) 
+            for k, v in self.cursor.execute(CanoeDB.family_stmt, (k_family,)) }
+        credential_cache[(k_family, None)] = (now + credential_ttl, family)
+        for k, v in family.items():
+            credential_cache[(k_family, k)] = (now + credential_ttl, v)
+        return dict(family)
+
+
+
+
+    def missing_log_indexes(self) -> List[str]:
+        """
+        The names of the indexes on canoe_log that have not been built.
+        """
+        present = { _ for _, in self.cursor.execute(CanoeDB.log_index_names_stmt) }
+        return [ _ for _ in CanoeDB.log_indexes if _ not in present ]
+
+
+    @trap
+    def check_log_indexes(self) -> List[str]:
+        """
+        Build the indexes on canoe_log that are missing. On a large log 
+        this takes a while, and the log is locked while it does, so it 
+        is for the console, not for canoed.
+
+        returns -- the names of the indexes that were built.
+        """
+        missing = self.missing_log_indexes()
+        for _ in missing: self.cursor.execute(CanoeDB.log_indexes[_])
+        self.commit()
+        return missing
+
+
+    @trap
+    def compact_log(self) -> Tuple[int, int]:
+        """
+        Give the log's free pages back to the file system, and set it 
+        up so that rotate_log() can do that a piece at a time from now 
+        on. VACUUM rebuilds the whole file with the log locked, so this
+        is for the console, not for canoed.
+
+        returns -- the number of pages before and after.
+        """
+        before = self.cursor.execute('PRAGMA page_count').fetchone()[0]
+        self.commit()
+        self.cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.cursor.execute('VACUUM')
+        after = self.cursor.execute('PRAGMA page_count').fetchone()[0]
+        return before, after
+
+
+    @trap
+    def review(self, sn:str) -> List[Tuple[float, str]]:
+        """
+        The log of the jobs whose serial numbers begin with sn, or, if 
+        sn is no more than four characters, end with it. 
+
+        returns -- a list of (microtime, message), in order.
+        """
+        if len(sn) > 4:
+            # A prefix is a range of serial numbers.
+            return self.cursor.execute(CanoeDB.review_by_prefix_stmt, 
+                (sn, sn + '\U0010ffff')).fetchall()
+        elif len(sn) == 4:
+            return self.cursor.execute(CanoeDB.review_by_hash_stmt, (sn,)).fetchall()
+        else:
+            return self.cursor.execute(CanoeDB.review_by_suffix_stmt, ('%' + sn,)).fetchall()
+
+
+    @trap
+    def rotate_log(self, days:int=None, months:int=None, most:int=None) -> int:
+        """
+        Move the rows older than days into the monthly archives, a batch
+        at a time so that the writers are never held up for long, and
+        delete the archives older than months.
+
+        most -- stop after about this many rows; the rest can be moved
+            the next time. None means move them all.
+
+        returns -- the number of rows moved.
+        """
+        days = log_days if days is None else days
+        months = log_months if months is None else months
+        cutoff = time.time() - days * 86400
+        os.makedirs(log_archive, exist_ok=True)
+
+        moved = 0
+        for month, in self.cursor.execute(CanoeDB.old_months_stmt, (cutoff,)).fetchall():
+            archive = os.path.join(log_archive, f"canoe_log.{month}.db")
+            self.cursor.execute("ATTACH DATABASE ? AS archive", (archive,))
             try:
-                return {k_family: {k: results[k_family][k]}}
-            except:
-                return "Nothing matching " + str(k_family) + " and " + str(k)
-        
+                self.cursor.execute("""CREATE TABLE IF NOT EXISTS archive.canoe_log 
+                    AS SELECT * FROM main.canoe_log WHERE 0""")
+                self.commit()
+                while True:
+                    self.cursor.execute(CanoeDB.archive_stmt, (cutoff, month, log_batch))
+                    n = self.cursor.execute(CanoeDB.unarchived_stmt, 
+                        (cutoff, month, log_batch)).rowcount
+                    self.commit()
+                    moved += n
+                    if n < log_batch or (most is not None and moved >= most): break
+            finally:
+                self.cursor.execute("DETACH DATABASE archive")
+            if most is not None and moved >= most: return moved
+
+        oldest = time.strftime('%Y%m', time.localtime(time.time() - months * 31 * 86400))
+        for f in os.listdir(log_archive):
+            if f.startswith('canoe_log.') and f.endswith('.db') and f[10:16] < oldest:
+                os.unlink(os.path.join(log_archive, f))
+                uu.tombstone(f"removed the log archive {f}")
+
+        # The pages that are freed are used again for new rows, so the 
+        # file only needs to shrink after the first, large rotation. Once
+        # compact_log() has been run, we give back a few pages at a time;
+        # until then, we only say that it is worth doing.
+        pages = self.cursor.execute('PRAGMA page_count').fetchone()[0]
+        free = self.cursor.execute('PRAGMA freelist_count').fetchone()[0]
+        if self.cursor.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            # Run to completion; a single step gives back only one page.
+            self.db.executescript(f'PRAGMA incremental_vacuum({log_vacuum_pages});')
+        elif free > pages // 2:
+            uu.tombstone(f"{free} of {pages} pages of {self.name} are free; "
+                "run logmaint in the console to give them back.")
+
+        return moved
 
 
     @trap
@@ -123,21 +376,20 @@ class CanoeDB(sqlitedb.SQLiteDB):
     def get_key(self, key:str) -> str:
         """ Retrieve the value of a key by its unique name. """
 
-        if not self.sn: self.sn = self.new_serial_number()
-        SQL = f"SELECT v FROM credentials WHERE k = {key}"
-        return str(self.row_one(SQL, 'V'))
+        self._check_credential_indexes()
+        row = self.cursor.execute(CanoeDB.key_stmt, (key,)).fetchone()
+        return None if row is None else str(row[0])
 
 
     @trap
-    def get_keys(self, key_family:str) -> List[List[Dict]]:
+    def get_keys(self, key_family:str) -> List[Tuple[str, str]]:
         """ 
         Return a list of key-value pairs for a collection of keys
         identified by name. 
         """
 
-        if not self.sn: self.sn = self.new_serial_number()
-        SQL = f"SELECT k, v FROM credentials WHERE k_family = {key_family}"
-        return self.execute_SQL(SQL)
+        self._check_credential_indexes()
+        return self.cursor.execute(CanoeDB.family_stmt, (key_family,)).fetchall()
 
 
     @trap
@@ -150,38 +402,10 @@ class CanoeDB(sqlitedb.SQLiteDB):
 
         self.sn = os.environ.get('sn', uu.new_serial_number())
         creds = {}
-        SQL = "SELECT k, v, k_family FROM credentials ORDER BY k_family, k"
-        frame = self.execute_SQL(SQL)
-        
-        for i in range(frame.shape[0]):
-            row = frame.iloc[i]
-            # The temp variables are to ease comprehension.
-            family = row['K_FAMILY']
-            key = row['K']
-            value = row['V'][2:-1]
-
-            try:
-                newvalue = CanoeCrypter.get_instance().decrypt(value)
-
-            except Exception as e:
-                # This must have been an un-encrypted value.
-                newvalue = row['V']
-
-            finally:
-                value = newvalue
-
-            # This is a bit of future proofing and roll-forward/backward compatibility.
-            # If the decrypted value is a text encoding of a byte encoding, then
-            # we need to strip it down.
-            #
-            # Now that we allow plain text values, let's not attempt to trim
-            # anything that is too short.
-            if len(value) > 3 and value[:2] == "b'" and value[-1] == "'":
-                value = value[2:-1]
-
+        for key, value, family in self.cursor.execute(CanoeDB.all_credentials_stmt):
             if family not in creds: 
                 creds[family] = {}
-            creds[family][key] = value
+            creds[family][key] = reveal(value) if and_decrypt else value
 
         return creds    
 
@@ -312,6 +536,30 @@ class CanoeCrypter:
         return self._slice_off_padding(engine.decrypt(message))
 
 
+def reveal(stored:str) -> str:
+    """
+    Decrypt a value from the credentials table. Values that were
+    stored in plain text are returned as they are.
+    """
+    try:
+        value = CanoeCrypter.get_instance().decrypt(stored[2:-1])
+
+    except Exception as e:
+        # This must have been an un-encrypted value.
+        value = stored
+
+    # This is a bit of future proofing and roll-forward/backward compatibility.
+    # If the decrypted value is a text encoding of a byte encoding, then
+    # we need to strip it down.
+    #
+    # Now that we allow plain text values, let's not attempt to trim
+    # anything that is too short.
+    if len(value) > 3 and value[:2] == "b'" and value[-1] == "'":
+        value = value[2:-1]
+
+    return value
+
+
 @trap
 def default(mode:int=0) -> CanoeDB:
     """
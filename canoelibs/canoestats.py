@@ -2,8 +2,13 @@
 import typing
 from   typing import *
 
+import atexit
+import collections
+import math
 import os
 import sys
+import threading
+import time
 
 import enum
 import sqlite3
@@ -35,11 +40,25 @@ class LED(enum.IntEnum):
 dash_devices = dict(zip(LED, ' @..*#wre'))
 dash_devices[None] = ' '
 
+###
+# The plugins change the lights many times in each job, mostly to 
+# the color they already are. So the writes are coalesced: update()
+# and inc() only remember the change, and flush() writes the ones
+# that differ from what is already in the database, all in one 
+# transaction. A flush happens flush_interval seconds after the first
+# change that is waiting, and when the job ends. Each process shares
+# one connection; see default().
+###
+flush_interval = float(os.environ.get('CANOE_STATS_INTERVAL', 2.0))
+shared = None
+
 class CanoeStats: pass
 class CanoeStats:
 
     inc_stmt = """update stats set last_update = CURRENT_TIMESTAMP,
             {0} = {0} + 1 where {0} > -1 and name = ?"""
+    inc_by_stmt = """update stats set last_update = CURRENT_TIMESTAMP,
+            {0} = {0} + ? where {0} > -1 and name = ?"""
     
     new_integration_stmt = "insert or ignore into stats (name, frequency) values (?, ?)"
     new_execution_stmt = """update stats set serial_number = ?,
@@ -63,6 +82,31 @@ class CanoeStats:
         for field in fields )
     updates = uu.SloppyDict(dict(zip(fields, update_statements)))
 
+    # What each job cost, by serial number. canoed writes a row each
+    # time a worker reports back.
+    usage_schema = """
+        create table if not exists job_usage (
+            serial_number text primary key,
+            name text not null,
+            finished real not null,
+            exit_code integer,
+            elapsed real,
+            utime real,
+            stime real,
+            maxrss integer,
+            inblock integer,
+            oublock integer
+            );
+        create index if not exists job_usage_by_name on job_usage(name, finished);
+        """
+    usage_stmt = "insert or replace into job_usage values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    # The summaries are of wall time, CPU (user + sys), peak RSS, and
+    # blocks moved (in + out).
+    usage_fields = ('elapsed', 'cpu', 'maxrss', 'io')
+    recent_usage_stmt = """select name, elapsed, utime + stime, maxrss, inblock + oublock from (
+        select *, row_number() over (partition by name order by finished desc) as n
+        from job_usage where name like ?) where n <= ? order by name"""
+
 
     def __init__(self, dbname:str):
         """
@@ -72,8 +116,17 @@ class CanoeStats:
         f = fname.Fname(dbname)
         if not f:
             raise Exception("Cannot connect to a database at {}".format(f))
-        self.conn = sqlite3.connect(dbname)
+        self.conn = sqlite3.connect(dbname, check_same_thread=False)
         self.cursor = self.conn.cursor()
+        self.conn.executescript(CanoeStats.usage_schema)
+
+        self.lock = threading.RLock()
+        self.pending = {}                       # (name, field) -> value
+        self.counts = collections.Counter()     # (name, field) -> increment
+        self.written = {}                       # (name, field) -> value in the db
+        self.timer = None
+        self.pid = os.getpid()
+        atexit.register(self.flush)
 
 
     def update(self, name:str, field:str, value:LED) -> bool:
@@ -84,16 +137,65 @@ class CanoeStats:
         field -- attribute of the integration to update.
         value -- one of the enumerated values.
         """
-        try:
-            stmt = CanoeStats.updates[field]
-            self.cursor.execute(stmt, (value, name))
-            self.conn.commit()
-            return True
-
-        except Exception as e:
-            uu.tombstone(str(e))
+        if field not in CanoeStats.fields:
+            uu.tombstone(f"no stats field named {field}")
             return False
 
+        with self.lock:
+            # Increments that are waiting happened before this update.
+            if (name, field) in self.counts: self.flush()
+            self.pending[(name, field)] = value
+            self._arm()
+        return True
+
+
+    def _arm(self) -> None:
+        """
+        Make sure a flush is coming. Called with the lock held.
+        """
+        if self.timer is None:
+            self.timer = threading.Timer(flush_interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+
+    def flush(self) -> int:
+        """
+        Write the changes that are waiting, in one transaction.
+
+        returns -- the number of statements executed.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            # A forked child has the parent's changes and its connection;
+            # they are the parent's to write.
+            if self.pid != os.getpid(): return 0
+
+            changes = [ (k, v) for k, v in self.pending.items() 
+                if self.written.get(k, self) != v ]
+            counts, self.counts = self.counts, collections.Counter()
+            self.pending = {}
+            if not changes and not counts: return 0
+
+            try:
+                for (name, field), value in changes:
+                    self.cursor.execute(CanoeStats.updates[field], (value, name))
+                for (name, field), n in counts.items():
+                    self.cursor.execute(CanoeStats.inc_by_stmt.format(field), (n, name))
+                self.conn.commit()
+
+            except Exception as e:
+                uu.tombstone(uu.type_and_text(e))
+                self.written = {}
+                return 0
+
+            self.written.update(changes)
+            for k in counts: self.written.pop(k, None)
+            return len(changes) + len(counts)
+
 
     def new_integration(self, name:str, frequency:str) -> bool:
         """
@@ -101,18 +203,20 @@ class CanoeStats:
             and a lot of new values if it already exists.
         """
 
-        try:
-            self.cursor.execute(CanoeStats.new_integration_stmt, (name, frequency))
-            self.cursor.execute(CanoeStats.update_frequency_stmt, (frequency, name))
-            self.conn.commit()
+        with self.lock:
+            self.flush()
+            try:
+                self.cursor.execute(CanoeStats.new_integration_stmt, (name, frequency))
+                self.cursor.execute(CanoeStats.update_frequency_stmt, (frequency, name))
+                self.conn.commit()
 
-        except sqlite3.IntegrityError as e:
-            uu.tombstone('{} already exists, updating it instead.'.format(name))
-            return self.new_execution(name, 0)
+            except sqlite3.IntegrityError as e:
+                uu.tombstone('{} already exists, updating it instead.'.format(name))
+                return self.new_execution(name, 0)
 
-        except Exception as e:
-            uu.tombstone(uu.type_and_text(e))
-            return False
+            except Exception as e:
+                uu.tombstone(uu.type_and_text(e))
+                return False
         return True
 
 
@@ -120,15 +224,12 @@ class CanoeStats:
         """
         Bump the value by one.
         """
-        try:        
-            self.cursor.execute(
-                CanoeStats.inc_stmt.format(field), (name,)
-            )
-            self.conn.commit()
-
-        except Exception as e:
-            raise
-            return False
+        with self.lock:
+            # An update that has not been written yet must be written
+            # first, or the increment would be lost under it.
+            if (name, field) in self.pending: self.flush()
+            self.counts[(name, field)] += 1
+            self._arm()
         return True
 
 
@@ -137,14 +238,71 @@ class CanoeStats:
         We call this when we execute a new job.
         """
 
-        try:
-            self.cursor.execute(CanoeStats.new_execution_stmt, (serial_number, name))
-            self.conn.commit()
+        with self.lock:
+            self.flush()
+            try:
+                self.cursor.execute(CanoeStats.new_execution_stmt, (serial_number, name))
+                self.conn.commit()
+                # Every field of this integration is NULL now.
+                for field in CanoeStats.fields: self.written[(name, field)] = None
+
+            except Exception as e:
+                uu.tombstone(uu.type_and_text(e))
+                return False
+        return True
+
+
+    def record_usage(self, name:str, exit_code:int, usage:tuple) -> bool:
+        """
+        Keep what one execution of a recipe cost.
+
+        usage -- a workerpool.Usage: (serial_number, elapsed, utime, stime,
+            maxrss, inblock, oublock)
+        """
+        serial_number = usage[0] or f"{name}.{time.time()}"
+        with self.lock:
+            try:
+                self.cursor.execute(CanoeStats.usage_stmt, 
+                    (serial_number, name, time.time(), exit_code, *usage[1:]))
+                self.conn.commit()
+
+            except Exception as e:
+                uu.tombstone(uu.type_and_text(e))
+                return False
+        return True
 
+
+    def usage_percentiles(self, 
+            pattern:str='%', 
+            runs:int=100, 
+            percentiles:Tuple[int]=(50, 90, 99)) -> Dict[str, dict]:
+        """
+        Summarize the most recent runs of each recipe.
+
+        pattern -- an SQL LIKE pattern for the recipe names.
+        runs -- how many of the most recent runs of each recipe to use.
+        percentiles -- which ones to compute.
+
+        returns -- {name: {'runs':n, field: [value at each percentile]}}
+        """
+        try:
+            rows = self.cursor.execute(CanoeStats.recent_usage_stmt, (pattern, runs)).fetchall()
         except Exception as e:
             uu.tombstone(uu.type_and_text(e))
-            return False
-        return True
+            return {}
+
+        samples = {}
+        for name, *values in rows:
+            samples.setdefault(name, []).append(values)
+
+        summary = {}
+        for name, values in samples.items():
+            summary[name] = {'runs':len(values)}
+            for i, field in enumerate(CanoeStats.usage_fields):
+                column = sorted(_[i] for _ in values if _[i] is not None)
+                summary[name][field] = [ nearest_rank(column, p) for p in percentiles ]
+
+        return summary
 
 
     def get_jobs(self, order:str='alpha') -> list:
@@ -161,13 +319,33 @@ class CanoeStats:
             return []
 
 
+def nearest_rank(data:list, p:float) -> Union[float, None]:
+    """
+    The p-th percentile of data (already sorted), by the nearest rank
+    method: the smallest value that is at least p percent of the data.
+    """
+    if not data: return None
+    return data[max(0, math.ceil(p / 100 * len(data)) - 1)]
+
+
 def default() -> CanoeStats:
     """
-    Open the default stats database.
+    The default stats database, opened once in each process.
+    """
+    global shared
+    if shared is None or shared.pid != os.getpid():
+        shared = CanoeStats(
+            os.path.join(os.environ.get('CANOE_HOME'), 'canoestats.db')
+            )
+    return shared
+
+
+def flush() -> int:
+    """
+    Write whatever the default stats database is holding. The 
+    executive calls this when a job ends.
     """
-    return CanoeStats(
-        os.path.join(os.environ.get('CANOE_HOME'), 'canoestats.db')
-        )
+    return 0 if shared is None else shared.flush()
 
 
 def get_dashboard() -> str:
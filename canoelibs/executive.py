@@ -29,6 +29,7 @@ from   grammar import *
 import importlib as il
 import urpacker
 import tombstone as tomb
+import urtunnel as urt
 import urutils as uu
 
 if uu.in_production():
@@ -52,6 +53,65 @@ import license
 waitable_signals = set(range(signal.SIGRTMIN+1, signal.NSIG))
 executive_mod_on = os.stat(__file__).st_mtime
 
+# The <plugin>_main function of each plugin, by plugin name. A worker
+# runs many recipes, so each plugin is looked up once per process. 
+# Clear it if the plugins are reloaded.
+entry_points = {}
+
+
+def plugin_name(section_name:str) -> str:
+    """
+    Return the section_name without the numerical suffix on the end.
+    """
+    try:
+        location = section_name.rindex('_')
+        plugin_name = section_name[:location]
+        return plugin_name if plugin_name in ITERABLE_SECTIONS else section_name
+
+    except ValueError as e:
+        return section_name
+
+
+def entry_point(plugin_type:str) -> Callable:
+    """
+    Find the function that runs a plugin.
+    """
+    global entry_points
+    try:
+        return entry_points[plugin_type]
+    except KeyError as e:
+        pass
+
+    plugin_module = il.import_module(plugin_type)
+    f = getattr(plugin_module, f"{plugin_type}_main", None)
+    if not callable(f):
+        raise Exception(f"plugin {plugin_type} has no function {plugin_type}_main")
+    entry_points[plugin_type] = f
+    return f
+
+
+def resolve(recipe:object) -> List[Tuple[str, str, Callable]]:
+    """
+    Find the plugin for every step in the roster before any of them
+    runs, so that a recipe with a missing plugin fails at once rather
+    than part way through.
+
+    returns -- a list of (step name, plugin name, function), in order.
+    """
+    steps = []
+    missing = []
+    for name in recipe.roster:
+        plugin_type = plugin_name(name)
+        try:
+            steps.append((name, plugin_type, entry_point(plugin_type)))
+        except Exception as e:
+            missing.append(f"{name}: {e}")
+
+    if missing:
+        raise Exception(f"{recipe.name} cannot run. " + "; ".join(missing))
+    return steps
+
+
 class Executive:
     """ 
     Execute the recipe. 
@@ -98,6 +158,8 @@ class Executive:
             }
 
         recipe_commit = self.r.compiler_info[0]
+        self.steps = resolve(self.r)
+        self.timings = []
 
         try:
             os.environ['recipe'] = self.r.name
@@ -121,17 +183,8 @@ class Executive:
 
     @trap
     def plugin_name(self, section_name:str) -> str:
-        """
-        Return the section_name without the numerical suffix on the end.
-        """
-        try:
-            location = section_name.rindex('_')
-            plugin_name = section_name[:location]
-            return plugin_name if plugin_name in ITERABLE_SECTIONS else section_name
+        return plugin_name(section_name)
 
-        except ValueError as e:
-            return section_name
-    
 
 
     @trap
@@ -191,30 +244,30 @@ class Executive:
         # program consists of 
         ###
         try:    
-            for name in self.r.roster:
+            for name, plugin_type, plugin_main in self.steps:
                 if self.verbose: tomb.tombstone(f"Found {name=} instruction.")
                 self._log("{}:{}".format(getproctitle(), name))
-                time.sleep(0.1)
                 if (self.wait_until is not None and name != self.wait_until): 
                     if self.verbose: tomb.tombstone("skipping because of previous return code.")
                     continue   
 
                 opcodes = self.r[name]
                 tomb.tombstone_comments(opcodes)
-                plugin_type = self.plugin_name(name)
                 uu.tombstone(f"{name=} -> {plugin_type=}")
-                plugin_module = il.import_module(plugin_type)
                 tomb.tombstone(f"{name} begins.")
                 
                 if self.verbose: tomb.tombstone(f"invoking {plugin_type=} plugin")
-                result = getattr(plugin_module, f"{plugin_type}_main")(opcodes)
+                step_start = time.perf_counter()
+                result = plugin_main(opcodes)
+                elapsed = time.perf_counter() - step_start
                 try:
                     # NOTE: This is the name of the value in the enumeration of return codes, so
                     # something like 'proceed', 'cleanup', etc.
                     code = result.name
                 except:
                     code = ERROR_ACTION.cleanup
-                self._log(f"{getproctitle()}:{name} returned {code}")
+                self.timings.append((name, elapsed))
+                self._log(f"{getproctitle()}:{name} returned {code} in {elapsed:.3f}s")
 
                 # Figure out what to do next, and bail out on ERROR_ACTION.stop
                 for foo in self.jump_table.get(result, [self.runtime_error]):
@@ -233,6 +286,16 @@ class Executive:
             else:
                 uu.tombstone("Affirmation email not requested.")
 
+            # The SSH connections were pooled for the life of the job.
+            n = urt.release_all()
+            if n: uu.tombstone(f"Closed {n} pooled connections.")
+
+            total = time.time() - self.start_time
+            in_steps = sum(t for _, t in self.timings)
+            self._log(f"{self.sn} {self.r.name} ran {len(self.timings)} steps in "
+                f"{in_steps:.3f}s of {total:.3f}s; " +
+                ", ".join(f"{name}={t:.3f}" for name, t in self.timings))
+            canoestats.flush()
             self._log(f'{self.sn} {self.r.name} completed.')
             self._nag(self.nag_map.get(result, 3))
             tomb.tombstone('end-job')
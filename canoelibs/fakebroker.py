@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+A canoearkd for testing PasswordBroker's framed protocol. It answers
+each request with the folder and object it was asked for.
+
+    import fakebroker
+    port = fakebroker.fake_broker()
+    b = passwordbroker.PasswordBroker(port=port, protocol='framed')
+"""
+
+import typing
+from   typing import *
+
+""" Standard Python imports """
+
+import socket
+import threading
+
+""" Installed imports """
+
+import msgpack
+
+""" Canøe imports """
+
+from   passwordbroker import frame_header
+
+""" Credits """
+
+__author__ = 'George Flanagin'
+__copyright__ = 'Copyright 2019, University of Richmond'
+__credits__ = None
+__version__ = '0.1'
+__maintainer__ = 'George Flanagin'
+__email__ = 'gflanagi@richmond.edu'
+__status__ = 'Testing'
+
+""" License """
+
+__license__ = 'MIT'
+import license
+
+""" ******************** BEGIN ******************** """
+
+def fake_broker(port:int=0) -> int:
+    """
+    A canoearkd for testing, in a thread: it answers each request with
+    the folder and object it was asked for.
+
+    returns -- the port it is listening on.
+    """
+    listener = socket.create_server(('127.0.0.1', port))
+
+    def serve(conn:socket.socket) -> None:
+        buffer = b''
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data: return
+                buffer += data
+                while len(buffer) >= frame_header.size:
+                    n, = frame_header.unpack_from(buffer)
+                    if len(buffer) < frame_header.size + n: break
+                    request = msgpack.unpackb(buffer[frame_header.size:frame_header.size+n], raw=False)
+                    buffer = buffer[frame_header.size+n:]
+                    body = msgpack.packb({'id':request['id'],
+                        'result':f"{request['folder']}/{request['object']}"})
+                    conn.sendall(frame_header.pack(len(body)) + body)
+
+    def accept() -> None:
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
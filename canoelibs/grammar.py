@@ -215,13 +215,13 @@ DOCUMENTARY_SECTIONS = (
     'zzz', 'devlead', 'owner', 
     'date_offset', 'debug', 'rerun_ok', 
     'comment', 'frequency', 'schedule', 
-    'allowed_environments', 'affirm' 
+    'allowed_environments', 'affirm', 'concurrency' 
     )
 DOCUMENTARY_VALUES = ( 
     None, ['no lead'], ['no owner'], 
     0, False, True, 
     ['Missing comment.'], 'unknown', None, 
-    None, False )
+    None, False, () )
 DOCUMENTARY_DEFAULTS = dict(zip(DOCUMENTARY_SECTIONS, DOCUMENTARY_VALUES))
 
 
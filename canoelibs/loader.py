@@ -39,6 +39,87 @@ __status__ = 'testable'
 __license__ = 'MIT'
 import license
 
+###
+# The schedule index. The compiler writes it next to the compiled 
+# recipes, so that canoeschedd can find out when everything runs 
+# without unpacking the recipes themselves. It is JSON:
+#
+#   { "version": 1,
+#     "recipes": { name: { "schedule": [ [ [0], [6], null, null, [1,2,3,4,5] ], ... ],
+#                          "source": source file, "mtime": its mtime, 
+#                          "hash": its sha256, "object": the .jsc file } } }
+#
+# Each schedule is five lists (minute, hour, day, month, weekday), and
+# null is "every".
+###
+schedule_index_name = 'schedule.index.json'
+schedule_index_version = 1
+
+
+def schedule_to_json(schedules:List[List[set]]) -> list:
+    return [ [ None if isinstance(_, uu.Universal) or not _ else sorted(_) 
+        for _ in schedule ] for schedule in schedules ]
+
+
+def schedule_from_json(schedules:list) -> List[List[set]]:
+    return [ [ uu.Universal() if _ is None else set(_) 
+        for _ in schedule ] for schedule in schedules ]
+
+
+def load_schedule_index(location:str) -> dict:
+    """
+    returns -- the recipes in the index, or an empty dict if there is
+        no index we can use.
+    """
+    try:
+        with open(os.path.join(location, schedule_index_name)) as f:
+            index = json.load(f)
+    except (OSError, ValueError) as e:
+        return {}
+
+    return ( index.get('recipes', {}) 
+        if index.get('version') == schedule_index_version else {} )
+
+
+def save_schedule_index(location:str, recipes:dict) -> None:
+    """
+    Replace the index in one step, so that a reader never sees half of it.
+    """
+    filename = os.path.join(location, schedule_index_name)
+    with open(filename + '.new', 'w') as f:
+        json.dump({'version':schedule_index_version, 'recipes':recipes}, 
+            f, sort_keys=True)
+    os.replace(filename + '.new', filename)
+
+
+def schedule_index_stamp(location:str) -> tuple:
+    """
+    Something that changes when the index is replaced.
+    """
+    try:
+        info = os.stat(os.path.join(location, schedule_index_name))
+        return info.st_ino, info.st_mtime_ns, info.st_size
+    except OSError as e:
+        return None
+
+
+@trap
+def schedules(location:str) -> Dict[str, List[List[set]]]:
+    """
+    The schedule of each recipe, by name. They come from the index if 
+    there is one; otherwise (as before the compiler wrote an index), 
+    from the recipes.
+    """
+    index = load_schedule_index(location)
+    if index:
+        return { name: schedule_from_json(entry['schedule']) 
+            for name, entry in index.items() }
+
+    tomb.tombstone(f"No schedule index in {location}; reading the recipes instead.")
+    return { prog.name: schedule_from_json(schedule_to_json(prog.schedule)) 
+        for prog in load(location) }
+
+
 @trap
 def load(location:str) -> uu.SloppyDict:
 
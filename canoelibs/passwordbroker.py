@@ -1,15 +1,37 @@
 # -*- coding: utf-8 -*-
-""" Module comment. """
+"""
+The client side of canoearkd, the daemon that fetches passwords
+from CyberArk.
+
+One connection is kept open for the life of the process, and every
+message on it, in either direction, is framed:
+
+    4 bytes, big endian     the length of what follows
+    msgpack                 the message
+
+A request is {'id':n, 'folder':..., 'object':...}, and the answer
+to it is {'id':n, 'result':...}. The ids let the client send several
+requests before it reads any answers, so get_many() costs one round
+trip however many secrets it asks for. The answers may come back in
+any order.
+
+The canoearkd that is deployed only speaks the old protocol (one 
+unframed message, and one answer, per connection), so that is still
+the default; give protocol='framed' once the daemon has been updated.
+"""
 
 import typing
 from   typing import *
 
 """ Standard Python imports """
 
+import itertools
 import json
 import os
 import socket
+import struct
 import sys
+import threading
 
 """ Installed imports """
 
@@ -25,7 +47,7 @@ import urutils as uu
 __author__ = 'George Flanagin'
 __copyright__ = 'Copyright 2019, University of Richmond'
 __credits__ = None
-__version__ = '0.1'
+__version__ = '0.2'
 __maintainer__ = 'George Flanagin'
 __email__ = 'gflanagi@richmond.edu'
 __status__ = 'Production'
@@ -37,18 +59,27 @@ import license
 
 """ ******************** BEGIN ******************** """
 
+frame_header = struct.Struct('>I')
+
+# One broker for each address, per process.
+brokers = {}
+
 class PasswordBroker:
     """
-    This object presents a callable Python interface to the 
-    daemon that provides items (usually passwords) from the 
+    This object presents a callable Python interface to the
+    daemon that provides items (usually passwords) from the
     Cyberark instance. The details of invocation are shown
     in the relevant functions below.
     """
     def __init__(self, **info) -> None:
         """
-        Make a connection to the canoearkd process at the given address.
+        Set up a connection to the canoearkd process at the given
+        address. The connection is made when it is first needed, and
+        made again if it is lost.
 
-        info -- keywords containing IP, port, timeout, etc.
+        info -- keywords containing IP, port, timeout, etc. The timeout
+            is for connecting; reply_timeout is how long to wait for 
+            the answers on the long-lived connection.
 
         Example:
             x = PasswordBroker({'IP':'8.8.4.4', etc.})
@@ -60,31 +91,30 @@ class PasswordBroker:
             self.ip_address = info.get('IP', '127.0.0.1')
             self.port = int(info.get('port', 4000))
             self.timeout = int(info.get('timeout', 1))
+            self.reply_timeout = float(info.get('reply_timeout', 30))
             self.bufsize = int(info.get('bufsize', 4096))
+            self.retries = int(info.get('retries', 1))
+            self.protocol = info.get('protocol', 'legacy')
 
         except Exception as e:
             tomb.tombstone(uu.type_and_text(e))
             raise e from None
 
-        try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.settimeout(self.timeout)
+        if self.protocol not in ('framed', 'legacy'):
+            raise Exception(f"unknown protocol {self.protocol}")
 
-        except Exception as e:
-            tomb.tombstone('Unable to connect to canoearkd')
-            raise
+        self.sock = None
+        self.pid = None
+        self.buffer = b''
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
 
 
     def __del__(self) -> None:
         """
         Be polite and disconnect.
         """
-        try:
-            self.sock.shutdown(socket.SHUT_RDWR)
-            self.sock.close()
-
-        except Exception as e:
-            pass
+        self.close()
 
 
     def __lshift__(self, some_args:Union[str, tuple]) -> Union[dict, str, None, bool]:
@@ -92,7 +122,7 @@ class PasswordBroker:
         Make a request of the PasswordBroker, and await the answer.
 
         some_args -- folder and credential that you want. There are subcases
-            of allowable items. 
+            of allowable items.
 
         1. The default folder is root/.
         1a. A single credential stored in root/
@@ -105,31 +135,149 @@ class PasswordBroker:
 
         2. Some other folder.
         2a. A single password.
-    
+
             password = broker << (folder_name, name_of_password)
 
         2b. Several passwords.
 
-            password_dict = broker << (folder_name, list_of_password_names)         
+            password_dict = broker << (folder_name, list_of_password_names)
 
         returns --  object on success.
                     False indicates a denial.
                     None suggests that there was no response.
         """
         try:
+            return self.get_many([some_args])[0]
+
+        except Exception as e:
+            tomb.tombstone(uu.type_and_text(e))
+            return None
+
+
+    def get_many(self, requests:List[Union[str, list, tuple]]) -> List[object]:
+        """
+        Send all the requests at once, and then collect the answers.
+
+        requests -- each is anything that << accepts.
+
+        returns -- the answers, in the same order as the requests. An
+            answer that never came is None.
+        """
+        messages = [ self._request(_) for _ in requests ]
+        if self.protocol == 'legacy':
+            return [ self._legacy_call(_) for _ in messages ]
+
+        with self.lock:
+            for attempt in range(self.retries + 1):
+                try:
+                    return self._pipeline(messages)
+
+                except socket.timeout as e:
+                    # The daemon is slow, not gone. Sending it all again 
+                    # would only make it slower.
+                    tomb.tombstone(f"canoearkd did not answer in {self.reply_timeout}s.")
+                    self.close()
+                    break
 
-            # We need to supply the name of the folder if the caller did not.
-            if isinstance(some_args, str) or isinstance(some_args, list):
-                some_args = {"folder":"root", "object":some_args}
-            elif isinstance(some_args, tuple):
-                some_args = {"folder":some_args[0], "object":some_args[1]}
-            else:
-                raise TypeError('<< called with bad argument type')
+                except (OSError, EOFError) as e:
+                    tomb.tombstone(f"canoearkd connection lost: {e}")
+                    self.close()
 
-            self.sock.connect((self.ip_address, self.port))
-            self.sock.setblocking(True)
-            self.sock.sendall(self._encode_message(some_args))
-            return self._decode_message(self.sock.recv(self.bufsize))
+        return [ None for _ in messages ]
+
+
+    def close(self) -> None:
+        """
+        Disconnect. A connection inherited across a fork is only closed,
+        because shutting it down would disconnect the parent, too.
+        """
+        try:
+            if self.pid == os.getpid(): self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+
+        except Exception as e:
+            pass
+
+        self.sock = None
+        self.buffer = b''
+
+
+    def _request(self, some_args:Union[str, list, tuple]) -> dict:
+        # We need to supply the name of the folder if the caller did not.
+        if isinstance(some_args, str) or isinstance(some_args, list):
+            return {"folder":"root", "object":some_args}
+        elif isinstance(some_args, tuple):
+            return {"folder":some_args[0], "object":some_args[1]}
+        elif isinstance(some_args, dict):
+            return dict(some_args)
+        else:
+            raise TypeError('<< called with bad argument type')
+
+
+    def _connect(self) -> socket.socket:
+        """
+        The connection is shared by all the threads in a process, but
+        a forked child must make its own.
+        """
+        if self.sock is not None and self.pid == os.getpid(): return self.sock
+
+        self.close()
+        self.sock = socket.create_connection((self.ip_address, self.port), self.timeout)
+        self.sock.settimeout(self.reply_timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.pid = os.getpid()
+        self.buffer = b''
+        return self.sock
+
+
+    def _pipeline(self, messages:List[dict]) -> List[object]:
+        sock = self._connect()
+        ids = []
+        out = b''
+        for message in messages:
+            message['id'] = next(self.ids)
+            ids.append(message['id'])
+            out += self._encode_message(message)
+        sock.sendall(out)
+
+        answers = {}
+        waiting = set(ids)
+        while waiting:
+            reply = self._read_frame()
+            waiting.discard(reply.get('id'))
+            answers[reply.get('id')] = reply.get('result')
+
+        return [ answers.get(_) for _ in ids ]
+
+
+    def _read_frame(self) -> dict:
+        while True:
+            if len(self.buffer) >= frame_header.size:
+                n, = frame_header.unpack_from(self.buffer)
+                if len(self.buffer) >= frame_header.size + n:
+                    frame = self.buffer[frame_header.size:frame_header.size+n]
+                    self.buffer = self.buffer[frame_header.size+n:]
+                    return self._decode_message(frame)
+
+            data = self.sock.recv(max(self.bufsize, 65536))
+            if not data: raise EOFError('canoearkd closed the connection')
+            self.buffer += data
+
+
+    def _legacy_call(self, message:dict) -> object:
+        """
+        One connection, one message, and one answer, which is read
+        until it is complete rather than in one recv().
+        """
+        try:
+            with socket.create_connection((self.ip_address, self.port), self.timeout) as sock:
+                sock.sendall(msgpack.packb(message))
+                unpacker = msgpack.Unpacker(use_list=False, raw=False)
+                while True:
+                    data = sock.recv(self.bufsize)
+                    if not data: return None
+                    unpacker.feed(data)
+                    for answer in unpacker: return answer
 
         except Exception as e:
             tomb.tombstone(uu.type_and_text(e))
@@ -138,10 +286,11 @@ class PasswordBroker:
 
     def _encode_message(self, info:dict) -> bytes:
         """
-        Transform the kwargs into a message to be written to the socket to request a 
+        Transform the kwargs into a message to be written to the socket to request a
         credential.
         """
-        return msgpack.packb(info)
+        body = msgpack.packb(info)
+        return frame_header.pack(len(body)) + body
 
 
     def _decode_message(self, msg:bytes) -> tuple:
@@ -149,7 +298,17 @@ class PasswordBroker:
         Unpack the answer[s]. Lists of things are returned as Python tuples rather
         than mutable lists.
         """
-        return msgpack.unpackb(msg, use_list=False, encoding='utf-8') 
+        return msgpack.unpackb(msg, use_list=False, raw=False)
+
+
+def broker(**info) -> PasswordBroker:
+    """
+    The long-lived broker for this address, made when it is first
+    asked for.
+    """
+    key = (info.get('IP', '127.0.0.1'), int(info.get('port', 4000)))
+    if key not in brokers: brokers[key] = PasswordBroker(**info)
+    return brokers[key]
 
 
 if __name__ == "__main__":
@@ -160,11 +319,16 @@ if __name__ == "__main__":
         'bufsize':4096
         }
 
-    broker = PasswordBroker(**info)
+    if '--fake' in sys.argv: 
+        import fakebroker
+        info['port'] = fakebroker.fake_broker()
+        info['protocol'] = 'framed'
+
+    b = PasswordBroker(**info)
     x = {'safe':'canoe', 'folder':'root', 'object':['caone-1', 'x', 'y']}
-    print("{}".format(broker << x))
+    print("{}".format(b << x))
+    print("{}".format(b.get_many([ ('canoe', f"secret-{i}") for i in range(10) ])))
 
 else:
     # Branch taken when imported.
     pass
-
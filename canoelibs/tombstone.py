@@ -3,10 +3,12 @@
 import typing
 from   typing import *
 
+import atexit
 import datetime
 import os
 import sqlite3
 import sys
+import threading
 import time
 
 import canoedb
@@ -43,11 +45,129 @@ class Accumulator(object):
 
 
 AX=Accumulator()
-db=canoedb.default()
 SQL="""insert into canoe_log
 (serial_number, sequence_number, microtime, recipe, message)
 values (?, ?, ?, ?, ?)"""
 
+###
+# Rather than commit each line as it is written, we hold the rows
+# in a buffer and write them as a group when there are batch_size
+# of them, or flush_interval seconds after the first of them arrived,
+# whichever comes first. flush() is also called at exit, and the 
+# canoed workers call it after each job and before os._exit().
+#
+# Any thread may log, and any thread (including the timer's) may
+# flush, so the buffer is guarded by a lock, and the log has its own
+# connection, shared by the threads and used by one at a time. If the
+# log cannot be written (it is locked, say), the rows are kept for the
+# next try, up to most_held of them.
+###
+batch_size = int(os.environ.get('CANOE_LOG_BATCH', 64))
+flush_interval = float(os.environ.get('CANOE_LOG_INTERVAL', 2.0))
+most_held = int(os.environ.get('CANOE_LOG_HELD', 10000))
+use_wal = uu.boolify(os.environ.get('CANOE_LOG_WAL', False))
+buffer = []
+lock = threading.RLock()
+write_lock = threading.Lock()
+timer = None
+
+
+def reopen() -> sqlite3.Connection:
+    """
+    Open (or reopen, as after a fork) the connection to the log. If 
+    $CANOE_LOG_WAL is set, the log is put in WAL mode, and each group
+    commit does not need to wait for an fsync.
+    """
+    global db
+    log = canoedb.default()
+    try:
+        db = sqlite3.connect(log.name, timeout=log.timeout, 
+            isolation_level=log.isolation_level, check_same_thread=False)
+        if use_wal: 
+            db.execute('pragma journal_mode = WAL')
+            db.execute('pragma synchronous = NORMAL')
+
+    except sqlite3.Error as e:
+        # The rows wait in the buffer; flush() tries again.
+        uu.tombstone(f"Cannot open the log {log.name}: {e}")
+        db = None
+    return db
+
+
+def _arm() -> None:
+    """
+    Make sure a flush is coming. Called with the lock held.
+    """
+    global timer
+    if timer is None:
+        timer = threading.Timer(flush_interval, flush)
+        timer.daemon = True
+        timer.start()
+
+
+def _after_fork() -> None:
+    """
+    The child does not have the parent's threads, so the locks may be
+    held by no one, and the timer will never go off. What is in the 
+    buffer is the parent's to write, and so is the connection; the 
+    child opens its own when it first needs it.
+    """
+    global buffer, lock, write_lock, timer, db
+    buffer = []
+    db = None
+    lock = threading.RLock()
+    write_lock = threading.Lock()
+    timer = None
+
+
+def flush() -> int:
+    """
+    Write everything in the buffer in one transaction.
+
+    returns -- the number of rows written.
+    """
+    global buffer
+    global timer
+
+    with lock:
+        if timer is not None:
+            timer.cancel()
+            timer = None
+        rows, buffer = buffer, []
+    if not rows: return 0
+
+    with write_lock:
+        try:
+            if db is None and reopen() is None: 
+                raise sqlite3.OperationalError('the log is not open')
+            db.executemany(SQL, rows)
+            db.commit()
+            return len(rows)
+
+        except sqlite3.Error as e:
+            problem = str(e)
+            try:
+                if db is not None: db.rollback()
+            except sqlite3.Error as e:
+                pass
+
+    # Put them back in front of anything logged since, and try again
+    # later. Beyond most_held, the oldest are lost.
+    with lock:
+        buffer = rows + buffer
+        lost = max(0, len(buffer) - most_held)
+        if lost: buffer = buffer[lost:]
+        _arm()
+    uu.tombstone(f"Database Error {problem}")
+    if lost: uu.tombstone(f"Unable to record {lost} log messages.")
+    return 0
+
+
+db=reopen()
+atexit.register(flush)
+os.register_at_fork(after_in_child=_after_fork)
+
+
 def tombstone(o:object) -> str:
     """
     Print out a message, data, whatever you pass in, along with
@@ -55,8 +175,6 @@ def tombstone(o:object) -> str:
     Along with printing it out, it returns it.
     """
     global AX
-    global db
-    global SQL
 
     i = AX()
     i_str = "{:0>4}".format(i) 
@@ -67,13 +185,12 @@ def tombstone(o:object) -> str:
     
     sys.stderr.write(aa + "\n")
 
-    try:
-        db().execute(SQL, (
+    with lock:
+        buffer.append((
             os.environ.get('sn', 0), i, time.time(), os.environ.get('recipe', 'unknown'), aa))
-        db.commit()
-    except sqlite3.DatabaseError as e:
-        uu.tombstone(f"Database Error {e}")
-        uu.tombstone(f"Unable to record info about {o}")
+        full = len(buffer) >= batch_size
+        if not full: _arm()
+    if full: flush()
         
     # Return the info for use by CanoeDB.tombstone()
     return aa
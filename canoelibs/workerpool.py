@@ -0,0 +1,589 @@
+# -*- coding: utf-8 -*-
+"""
+A supervised pool of pre-forked workers for canoed.
+
+Instead of forking once for every event read from the pipe, canoed
+forks a fixed number of workers when it starts. The workers inherit
+the modules that the parent has already imported, open their own
+database handles once, and then sit on one end of a socketpair waiting
+for the name of a job to run. Each message in either direction is
+one line of text:
+
+    parent -> worker    job-name
+    worker -> parent    job-name exit-code serial-number usage...
+
+The usage is what the job cost: user and system CPU seconds, the
+peak resident set in kB, and the blocks read and written. The worker
+measures it with getrusage() before and after the job, counting the
+job's own subprocesses as well as itself, and resets its peak RSS
+before each job. (A worker runs many jobs, so wait4() can only tell
+the parent what a worker cost over its whole life; the parent reaps
+its workers with wait4() and logs that, too.)
+
+A worker that has run recycle_after jobs is retired by the parent,
+which closes its channel and forks a fresh replacement. A worker
+that dies (for whatever reason) is noticed when its channel reaches
+EOF, and it is replaced in the same way.
+
+Jobs may belong to concurrency classes ("oracle", "box", "sftp:host",
+...), each with a limit. Only the parent starts jobs, and it hears
+about every job that ends, so it keeps the counts for all the workers,
+and a job that would put a class over its limit waits in the backlog
+until a job in that class finishes.
+"""
+
+from   typing import *
+
+# System imports
+
+import collections
+import os
+import resource
+import select
+import signal
+import socket
+import time
+
+# Canoe imports
+
+import tombstone as tomb
+import urutils as uu
+
+if uu.in_production():
+    from urdecorators import show_exceptions_and_frames as trap
+else:
+    from urdecorators import null_decorator as trap
+
+# Credits
+__author__ = 'George Flanagin'
+__copyright__ = 'Copyright 2020, University of Richmond'
+__credits__ = None
+__version__ = '0.1'
+__maintainer__ = 'George Flanagin'
+__email__ = 'gflanagin@richmond.edu'
+__status__ = 'testable'
+
+__license__ = 'MIT'
+
+
+Usage = collections.namedtuple('Usage',
+    'serial_number elapsed utime stime maxrss inblock oublock')
+
+
+def _rusage() -> Tuple[float, float, int, int, int]:
+    """
+    The cumulative cost of this process and its waited-for children.
+
+    returns -- (utime, stime, inblock, oublock, children's maxrss)
+    """
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ( me.ru_utime + kids.ru_utime, me.ru_stime + kids.ru_stime,
+        me.ru_inblock + kids.ru_inblock, me.ru_oublock + kids.ru_oublock,
+        kids.ru_maxrss )
+
+
+def _reset_peak() -> bool:
+    """
+    Reset VmHWM, the peak RSS of this process, so that the next reading
+    belongs to the next job. Linux 4.0 and later.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError as e:
+        return False
+
+
+def _peak() -> int:
+    """
+    The peak RSS of this process, in kB.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'): return int(line.split()[1])
+    except OSError as e:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class WorkerClosing(Exception):
+    """
+    Raised in an idle worker by a closing signal.
+    """
+    pass
+
+
+class Worker:
+    """
+    The parent's view of one worker process.
+    """
+
+    __slots__ = ('pid', 'channel', 'buffer', 'busy_with', 'jobs_done', 'started', 'classes',
+        'generation')
+
+    def __init__(self, pid:int, channel:socket.socket, generation:int=0) -> None:
+        self.pid        = pid
+        self.channel    = channel
+        self.buffer     = b''
+        self.busy_with  = None
+        self.jobs_done  = 0
+        self.started    = 0.0
+        self.classes    = ()
+        self.generation = generation
+
+
+    def __str__(self) -> str:
+        return f"worker {self.pid} ({self.jobs_done} jobs, busy with {self.busy_with})"
+
+
+    def fileno(self) -> int:
+        return self.channel.fileno()
+
+
+class Admission:
+    """
+    Counting semaphores, one for each concurrency class.
+    """
+
+    default_limits = "oracle=4 box=8 sftp:*=2"
+
+    @staticmethod
+    def parse(s:str) -> Dict[str, int]:
+        """
+        Turn "oracle=4, sftp:*=2" into {'oracle':4, 'sftp:*':2}.
+        """
+        limits = {}
+        for item in s.replace(',', ' ').split():
+            k, _, v = item.partition('=')
+            limits[k.strip()] = int(v)
+        return limits
+
+
+    def __init__(self, limits:Dict[str, int]=None) -> None:
+        """
+        limits -- class name to the most jobs in the class that may run
+            at once. "prefix:*" sets the limit for every class with that
+            prefix, e.g., "sftp:*" for each host. Classes not mentioned
+            have no limit. The default comes from $CANOE_CONCURRENCY.
+        """
+        self.limits = ( Admission.parse(os.environ.get('CANOE_CONCURRENCY', 
+            Admission.default_limits)) if limits is None else limits )
+        self.running = collections.Counter()
+
+
+    def __str__(self) -> str:
+        return " ".join(f"{c}={n}/{self.limit(c)}" for c, n in sorted(self.running.items()) if n)
+
+
+    def limit(self, c:str) -> int:
+        if c in self.limits: return self.limits[c]
+        return self.limits.get(c.partition(':')[0] + ':*')
+
+
+    def fits(self, classes:Iterable[str]) -> bool:
+        for c in classes:
+            most = self.limit(c)
+            if most is not None and self.running[c] >= most: return False
+        return True
+
+
+    def acquire(self, classes:Iterable[str]) -> None:
+        for c in classes: self.running[c] += 1
+
+
+    def release(self, classes:Iterable[str]) -> None:
+        for c in classes: self.running[c] -= 1
+
+
+class WorkerPool:
+    """
+    Hand jobs, by name, to idle pre-forked workers.
+
+    Usage:
+
+        pool = WorkerPool(size, recycle_after, job=run_one, warmup=prepare)
+        pool.start()
+        pool.submit('some_recipe')
+        pool.dispatch()
+        ...
+        pool.collect(pool.wait(other_fds, timeout))
+        ...
+        pool.shutdown()
+
+    A worker that gets one of the closing_signals exits at once if it
+    is idle, or else when the job in hand is finished and reported.
+    """
+
+    closing_signals = ( signal.SIGINT, signal.SIGQUIT, signal.SIGUSR2 )
+
+    def __init__(self,
+            size:int,
+            recycle_after:int,
+            *,
+            job:Callable[[str], int],
+            warmup:Callable[[], None]=None,
+            classes_of:Callable[[str], Iterable[str]]=None,
+            admission:Admission=None) -> None:
+        """
+        size -- the number of workers to keep alive.
+        recycle_after -- retire a worker after this many jobs. Zero
+            means never retire a worker.
+        job -- the function (run in the worker) that executes a job. It
+            takes the job name and returns an exit code, or a tuple of 
+            (exit code, serial number).
+        warmup -- optional function run once in each new worker before
+            it accepts any jobs.
+        classes_of -- optional function that gives the concurrency 
+            classes of a job from its name.
+        admission -- the limits on the classes. The default is an
+            Admission() built from the environment.
+        """
+        self.size           = max(1, int(size))
+        self.recycle_after  = max(0, int(recycle_after))
+        self.job            = job
+        self.warmup         = warmup
+        self.workers        = {}
+        self.backlog        = collections.deque()
+        self.classes_of     = classes_of or (lambda name: ())
+        self.admission      = Admission() if admission is None else admission
+        self.generation     = 0
+        self.lost           = collections.deque()
+        # Only a worker uses these, for itself.
+        self.in_job         = False
+        self.closing        = False
+
+
+    def __len__(self) -> int:
+        return len(self.workers)
+
+
+    def __str__(self) -> str:
+        return "\n".join(str(w) for w in self.workers.values())
+
+
+    @trap
+    def start(self) -> int:
+        """
+        Fork workers until the pool is full.
+
+        returns -- the number of workers.
+        """
+        while len(self.workers) < self.size:
+            self._spawn()
+        return len(self.workers)
+
+
+    @trap
+    def reload(self,
+            *,
+            job:Callable[[str], int],
+            warmup:Callable[[], None]=None,
+            classes_of:Callable[[str], Iterable[str]]=None) -> int:
+        """
+        Take up new code. The idle workers are replaced now, and the 
+        busy ones as soon as they report back, so that no job in 
+        progress goes uncollected. The backlog and the counts of the
+        concurrency classes are kept.
+
+        returns -- the number of workers replaced now.
+        """
+        self.job = job
+        self.warmup = warmup
+        self.classes_of = classes_of or (lambda name: ())
+        self.generation += 1
+
+        idle = self.idle_workers()
+        for w in idle: self._replace(w)
+        return len(idle)
+
+
+    def idle_workers(self) -> List[Worker]:
+        return [ w for w in self.workers.values() if w.busy_with is None ]
+
+
+    def busy_workers(self) -> List[Worker]:
+        return [ w for w in self.workers.values() if w.busy_with is not None ]
+
+
+    def quiet(self) -> bool:
+        """
+        True if there is nothing waiting and nothing running.
+        """
+        return not self.backlog and not self.busy_workers()
+
+
+    def submit(self, name:str) -> int:
+        """
+        Put a job in line to be run.
+
+        returns -- the number of jobs waiting for a worker.
+        """
+        self.backlog.append(name)
+        return len(self.backlog)
+
+
+    @trap
+    def dispatch(self, limit:int=None) -> int:
+        """
+        Give waiting jobs to idle workers, oldest first, skipping any
+        job whose concurrency classes are full. The jobs skipped keep
+        their places in line.
+
+        limit -- the most jobs to start on this call. None means as many
+            as there are idle workers.
+
+        returns -- the number of jobs started.
+        """
+        started = 0
+        idle = self.idle_workers()
+        held = collections.deque()
+        while idle and self.backlog and (limit is None or started < limit):
+            name = self.backlog.popleft()
+            classes = tuple(self.classes_of(name))
+            if not self.admission.fits(classes):
+                held.append(name)
+                continue
+
+            w = idle.pop(0)
+            try:
+                w.channel.sendall(f"{name}\n".encode('utf-8'))
+            except OSError as e:
+                # The worker is gone. Put the job back at the front of
+                # the line, and let collect() replace the worker.
+                tomb.tombstone(f"unable to hand {name} to worker {w.pid}: {e}")
+                self.backlog.appendleft(name)
+                self._replace(w)
+                continue
+
+            w.busy_with = name
+            w.started = time.time()
+            w.classes = classes
+            self.admission.acquire(classes)
+            started += 1
+            uu.tombstone(f"Dispatched: {name} to worker {w.pid}")
+
+        self.backlog.extendleft(reversed(held))
+        return started
+
+
+    def wait(self, other_fds:List[int], timeout:float=None) -> List[int]:
+        """
+        Sleep until a worker reports back or one of other_fds is readable.
+
+        returns -- the list of readable file descriptors.
+        """
+        fds = list(other_fds) + [ w.fileno() for w in self.workers.values() ]
+        try:
+            readable, _, _ = select.select(fds, [], [], timeout)
+        except InterruptedError as e:
+            readable = []
+        return readable
+
+
+    @trap
+    def collect(self, readable:List[int]) -> List[Tuple[str, int, Usage]]:
+        """
+        Read the reports from any workers in the readable list.
+
+        returns -- a list of (job name, exit code, usage) for the jobs 
+            that have finished. The names of jobs whose workers died
+            are added to self.lost.
+        """
+        finished = []
+        for w in list(self.workers.values()):
+            if w.fileno() not in readable: continue
+
+            try:
+                data = w.channel.recv(4096)
+            except OSError as e:
+                data = b''
+
+            if not data:
+                if w.busy_with is not None:
+                    tomb.tombstone(f"worker {w.pid} died while running {w.busy_with}.")
+                    self.admission.release(w.classes)
+                    self.lost.append(w.busy_with)
+                else:
+                    tomb.tombstone(f"worker {w.pid} exited.")
+                self._replace(w)
+                continue
+
+            w.buffer += data
+            while b'\n' in w.buffer:
+                line, w.buffer = w.buffer.split(b'\n', 1)
+                name, code, sn, *cost = line.decode('utf-8').rsplit(' ', 7)
+                usage = Usage(None if sn == '-' else sn, time.time() - w.started,
+                    float(cost[0]), float(cost[1]), int(cost[2]), int(cost[3]), int(cost[4]))
+                uu.tombstone(f"{name} finished in worker {w.pid} with {code} after {usage.elapsed:.2f}s; "
+                    f"cpu {usage.utime:.2f}u {usage.stime:.2f}s, peak {usage.maxrss} kB")
+                finished.append((name, int(code), usage))
+                self.admission.release(w.classes)
+                w.busy_with = None
+                w.classes = ()
+                w.jobs_done += 1
+
+            if w.busy_with is not None: continue
+            if self.recycle_after and w.jobs_done >= self.recycle_after:
+                uu.tombstone(f"recycling worker {w.pid} after {w.jobs_done} jobs.")
+                self._replace(w)
+            elif w.generation != self.generation:
+                uu.tombstone(f"replacing worker {w.pid}, which has the old code.")
+                self._replace(w)
+
+        return finished
+
+
+    def reap(self) -> List[Tuple[int, int, resource.struct_rusage]]:
+        """
+        Collect the exit status of any children (retired or dead workers)
+        that have exited, without waiting for the others.
+
+        returns -- a list of (pid, exit code, rusage). A negative code
+            is the number of the signal that killed the process.
+        """
+        reaped = []
+        while True:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError as e:
+                break
+            if not pid: break
+
+            code = os.waitstatus_to_exitcode(status)
+            tomb.tombstone(f"worker {pid} reaped with {code}; lifetime cpu "
+                f"{rusage.ru_utime:.2f}u {rusage.ru_stime:.2f}s, peak {rusage.ru_maxrss} kB, "
+                f"blocks {rusage.ru_inblock} in {rusage.ru_oublock} out")
+            reaped.append((pid, code, rusage))
+
+        return reaped
+
+
+    @trap
+    def shutdown(self) -> None:
+        """
+        Close all the channels. Idle workers exit at once; busy workers
+        exit after they finish the job they have.
+        """
+        for w in list(self.workers.values()):
+            self._retire(w)
+        self.backlog.clear()
+
+
+    def _retire(self, w:Worker) -> None:
+        self.workers.pop(w.pid, None)
+        try:
+            w.channel.close()
+        except OSError as e:
+            pass
+
+
+    def _replace(self, w:Worker) -> Worker:
+        self._retire(w)
+        return self._spawn()
+
+
+    def _spawn(self) -> Worker:
+        """
+        Fork one worker. In the parent, return its Worker record. The
+        child never returns.
+        """
+        # Anything still in the log buffer belongs to the parent; write
+        # it now so the worker does not inherit a copy.
+        tomb.flush()
+        parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            pid = os.fork()
+        except OSError as e:
+            parent_end.close()
+            child_end.close()
+            raise Exception("fork failed!") from e
+
+        if pid:
+            child_end.close()
+            w = Worker(pid, parent_end, self.generation)
+            self.workers[pid] = w
+            uu.tombstone(f"worker {pid} started.")
+            return w
+
+        ###
+        # This is the worker. Drop the parent's ends of everyone's
+        # channels so that EOF works the way it should, and then
+        # serve until the parent hangs up.
+        ###
+        parent_end.close()
+        for other in self.workers.values():
+            try:
+                other.channel.close()
+            except OSError as e:
+                pass
+        self.workers = {}
+        self.backlog.clear()
+
+        worker_exit = os.EX_OK
+        try:
+            self._serve(child_end)
+
+        except BaseException as e:
+            worker_exit = os.EX_SOFTWARE
+            tomb.tombstone(f"worker {os.getpid()} failed: {uu.type_and_text(e)}")
+
+        finally:
+            tomb.flush()
+            os._exit(worker_exit)
+
+
+    def _close_after_job(self, signum:int, stack:object=None) -> None:
+        """
+        The worker's handler for the closing_signals. The parent's 
+        handler would shut down the worker's copy of the pool, and the 
+        job would take the SystemExit for its own end.
+        """
+        self.closing = True
+        if not self.in_job: raise WorkerClosing()
+
+
+    def _serve(self, channel:socket.socket) -> None:
+        """
+        The worker's loop: read a name, run it, report, repeat.
+        """
+        self.in_job = self.closing = False
+        for _ in WorkerPool.closing_signals:
+            signal.signal(_, self._close_after_job)
+        try:
+            if self.warmup is not None: self.warmup()
+            uu.tombstone(f"worker {os.getpid()} is ready.")
+            self._serve_jobs(channel)
+        except WorkerClosing as e:
+            pass
+
+        uu.tombstone(f"worker {os.getpid()} {'closed' if self.closing else 'released'}.")
+
+
+    def _serve_jobs(self, channel:socket.socket) -> None:
+        reader = channel.makefile('r', encoding='utf-8')
+        for line in reader:
+            name = line.strip()
+            if not name: continue
+
+            self.in_job = True
+            before = _rusage()
+            _reset_peak()
+            try:
+                result = self.job(name)
+            except BaseException as e:
+                result = os.EX_SOFTWARE
+            code, sn = result if isinstance(result, tuple) else (result, None)
+            after = _rusage()
+
+            # If one of the job's subprocesses set a new record for the
+            # children, that is the job's peak; otherwise it is ours.
+            peak = max(_peak(), after[4] if after[4] > before[4] else 0)
+            tomb.flush()
+            channel.sendall((f"{name} {int(code or 0)} {sn or '-'} "
+                f"{after[0]-before[0]:.3f} {after[1]-before[1]:.3f} {peak} "
+                f"{after[2]-before[2]} {after[3]-before[3]}\n").encode('utf-8'))
+            self.in_job = False
+            if self.closing: return
@@ -27,6 +27,7 @@ import license
 # Standard imports
 
 import argparse
+import heapq
 import os
 import signal
 import sys
@@ -40,7 +41,7 @@ if sys.version_info < __required_version__:
 from   urutils import setproctitle, getproctitle
 
 # Canøe imports
-import fifo
+import jobqueue
 import loader
 import tombstone as tomb
 from   urdecorators import show_exceptions_and_frames as trap
@@ -79,6 +80,57 @@ def save_last_time(t:int) -> None:
         f.write("{}\n".format(int(t)))
 
 
+def load_todo_list(location:str) -> dict:
+    """
+    The schedules of all the recipes, by name.
+    """
+    todo_list = loader.schedules(location)
+    print("{} programs loaded.".format(len(todo_list)))
+
+    tomb.tombstone("+"*80)
+    tomb.tombstone("begin schedules")
+    for _ in sorted(todo_list.keys()):
+        tomb.tombstone("{} @ {}".format(_, todo_list[_]))
+
+    tomb.tombstone("end schedules")
+    tomb.tombstone("+"*80)
+    return todo_list
+
+
+def build_calendar(todo_list:dict, after_minute:int) -> list:
+    """
+    Make a heap of (next fire minute, job name, schedule number) with
+    one entry for each schedule of each job. Schedules that will never
+    fire (@adhoc) are left out.
+    """
+    calendar = []
+    for name, schedules in todo_list.items():
+        for i, schedule in enumerate(schedules):
+            minute = uu.next_fire_time(after_minute, schedule)
+            if minute is not None: calendar.append((minute, name, i))
+
+    heapq.heapify(calendar)
+    return calendar
+
+
+def jobs_due(calendar:list, todo_list:dict, this_minute:int) -> set:
+    """
+    Pop everything from the calendar that is due on or before this_minute,
+    and push each schedule's next fire time back on. If we have been
+    asleep for a while, this replays the missed minutes in order.
+
+    returns -- the set of job names to run.
+    """
+    jobs = set()
+    while calendar and calendar[0][0] <= this_minute:
+        minute, name, i = heapq.heappop(calendar)
+        jobs.add(name)
+        next_minute = uu.next_fire_time(minute, todo_list[name][i])
+        if next_minute is not None: heapq.heappush(calendar, (next_minute, name, i))
+
+    return jobs
+
+
 pipe_name = None
 
 @trap
@@ -91,12 +143,13 @@ def canoeschedd(pipe_affinity:str=None, cold:bool=False):
     tomb.tombstone("THIS IS CANOE 20's SCHEDULER STARTING.")
     if pipe_name is None: pipe_name = pipe_affinity
 
-    # It doesn't hurt to start it if it is already started.
+    # The queue is durable, so canoed need not be running; the jobs
+    # wait for it.
     try:
-        my_pipe = fifo.FIFO(pipe_name, 'w')
+        my_queue = jobqueue.JobQueue(pipe_name, 'w')
     except Exception as e:
         tomb.tombstone(str(e))
-        tomb.tombstone("Start canoed first. The scheduler cannot write without a reader.")
+        tomb.tombstone("The scheduler cannot open its queue.")
         sys.exit(os.EX_CANTCREAT)
     else:
         tomb.tombstone(f'Posting events to {pipe_name}')
@@ -108,36 +161,12 @@ def canoeschedd(pipe_affinity:str=None, cold:bool=False):
 
     COMPILEDRECIPES = os.environ.get('COMPILEDRECIPES', '/sw/canoe/compiledrecipes')
 
-    # Do this with a generator because we don't need all the recipes
-    # in memory -- we just need the schedule from each one, and the remainder
-    # of the data can be left off.
-    gen = loader.load(COMPILEDRECIPES)
-    todo_list = {}
-    while True:
-        try:
-            prog = next(gen)
-            for i, line_item in enumerate(prog.schedule):
-                for j, element in enumerate(line_item):
-                    if not element: prog.schedule[i][j] = uu.Universal()
-            todo_list[prog.name] = prog.schedule
-        except StopIteration as e:
-            break
-        except Exception as e:
-            tomb.tombstone(uu.type_and_text(e))
-            raise
-
-    print("{} programs loaded.".format(len(todo_list)))
-
-    # I suppose this could be combined with the above dictionary
-    # comprehension, but I think we might get to "unreadable" at
-    # that point.
-    tomb.tombstone("+"*80)
-    tomb.tombstone("begin schedules")
-    for _ in sorted(todo_list.keys()):
-        tomb.tombstone("{} @ {}".format(_, todo_list[_]))
-
-    tomb.tombstone("end schedules")
-    tomb.tombstone("+"*80)
+    # We only need the schedule of each recipe, and the compiler 
+    # keeps them all in one small index, so we read that rather than
+    # the recipes. When the compiler replaces the index, we read it 
+    # again.
+    index_stamp = loader.schedule_index_stamp(COMPILEDRECIPES)
+    todo_list = load_todo_list(COMPILEDRECIPES)
 
     start_time = stop_time = time.time()
     run_priority = 1.0
@@ -147,6 +176,7 @@ def canoeschedd(pipe_affinity:str=None, cold:bool=False):
     # Set this to zero if we are outside the while-loop starting below.
     # If inside the loop last_time is zero, then we are starting up cold.
     last_minute = 0 if cold else get_last_time()
+    calendar = None
     try:
         tomb.tombstone("last_minute initialized to {}".format(last_minute))
         while True:
@@ -160,24 +190,30 @@ def canoeschedd(pipe_affinity:str=None, cold:bool=False):
                 continue
 
             save_last_time(this_minute)
-            # Note that the following range() might have no elements.
-            minutes_to_consider = [this_minute] if last_minute == 0 else list(range(last_minute+1, this_minute+1))
-            # tomb.tombstone("Evaluating minutes {}".format(minutes_to_consider))
+
+            # If the recipes have been compiled again, start over with
+            # the new schedules from the last minute we considered.
+            stamp = loader.schedule_index_stamp(COMPILEDRECIPES)
+            if stamp != index_stamp:
+                tomb.tombstone("The schedule index has changed; reloading it.")
+                index_stamp = stamp
+                todo_list = load_todo_list(COMPILEDRECIPES)
+                calendar = None
+
+            # The first time through, we build the calendar from the
+            # last minute we considered, so anything we missed while we
+            # were down comes off the heap on this pass.
+            if calendar is None:
+                calendar = build_calendar(todo_list, 
+                    this_minute - 1 if last_minute == 0 else last_minute)
+                tomb.tombstone(f"{len(calendar)} schedules are on the calendar.")
             last_minute = this_minute
 
             try:
-                count = 0
-                jobs_to_do = set()
-                # Very likely there will be only one minute to consider.
-                for minute in minutes_to_consider:
-                    for _ in sorted(todo_list.keys()): # for each job ....
-                        for schedule in todo_list[_]: # for each schedule it has ....
-                            if uu.this_is_the_time(minute, schedule):
-                                jobs_to_do.add(_)
-                                count += 1
-                if count:
-                    jobs_to_do = list(jobs_to_do)
-                    my_pipe(jobs_to_do)
+                jobs_to_do = jobs_due(calendar, todo_list, this_minute)
+                if jobs_to_do:
+                    jobs_to_do = sorted(jobs_to_do)
+                    my_queue(jobs_to_do)
                     tomb.tombstone('Added {} events.'.format(len(jobs_to_do)))
                 else:
                     tomb.tombstone('Nothing new to schedule.')    
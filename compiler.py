@@ -13,11 +13,13 @@ of a Canøe job. The RecipeCompiler is a factory for Recipes.
 import argparse
 import collections
 from   collections.abc import *
+import concurrent.futures
 import configparser
 import copy
 import datetime
 from   datetime import datetime
 import glob
+import hashlib
 import inspect
 import json
 import math
@@ -43,6 +45,7 @@ from   grammar import *
 import ijklparser
 from   ijklparser import IJKLparser
 import jparse as jp
+import loader
 from   recipe import Recipe
 from   urdecorators import show_exceptions_and_frames as trap
 import urpacker
@@ -449,6 +452,13 @@ class RecipeCompiler:
             recipe.affirmation += f" {o_}" if '@' in o_ else f" {o_}@richmond.edu"
         recipe.affirmation += " < /dev/null"
 
+        ################################################################
+        # 9. Concurrency classes. canoed limits how many jobs in each
+        #    class run at once. Add the classes implied by the steps to
+        #    any that the author named.
+        ################################################################
+        recipe['concurrency'] = self._concurrency_classes(recipe)
+
         timer.stop()
 
         if not self.opts.quiet: print(str(timer))
@@ -533,6 +543,19 @@ class RecipeCompiler:
         return o
 
 
+    @trap
+    def check_concurrency(self, o:Any) -> object:
+        this_fcn = inspect.stack()[0][3]
+        if self.opts.verbose > 1: print(this_fcn)
+
+        o = uu.listify(o)
+        for _ in o:
+            if not isinstance(_, str):
+                self.fatal_error(f"Concurrency classes must be strings: {_}")
+
+        return o
+
+
     @trap
     def check_dashboard(self, o:Any) -> object:
         this_fcn = inspect.stack()[0][3]
@@ -1184,6 +1207,15 @@ class RecipeCompiler:
             if 'db' in keys:
                 _['db'] = self._validate_db(_['db'])
 
+            if 'batch_size' in keys:
+                try:
+                    _['batch_size'] = int(_['batch_size'])
+                except (TypeError, ValueError) as e:
+                    self.fatal_error(f"batch_size must be an integer, not {_['batch_size']}")
+
+            if _.get('packing', 'pickle') not in ('pickle', 'columnar', 'frame'):
+                self.fatal_error(f"packing must be pickle, columnar or frame, not {_['packing']}")
+
         return o
 
 
@@ -1883,6 +1915,30 @@ class RecipeCompiler:
         return info        
         
 
+    @trap
+    def _concurrency_classes(self, recipe:Recipe) -> List[str]:
+        """
+        Find the shared resources that the steps of the recipe use:
+        
+            oracle          -- any step with a database.
+            box             -- any step that talks to Box.
+            sftp:{hostname} -- each remote host.
+
+        returns -- a sorted list of the class names.
+        """
+        classes = set(recipe.get('concurrency') or ())
+        for section in recipe.roster:
+            for step in uu.listify(recipe[section]):
+                if not isinstance(step, dict): continue
+                if step.get('db'): classes.add('oracle')
+                if step.get('box'): classes.add('box')
+                host = step.get('host')
+                if isinstance(host, dict) and host.get('hostname', 'localhost') != 'localhost':
+                    classes.add(f"sftp:{host['hostname']}")
+
+        return sorted(classes)
+
+
     @trap
     def _validate_host(self, name:str, password:str=None) -> dict:
         this_fcn = inspect.stack()[0][3]
@@ -2311,6 +2367,164 @@ def diagnostics() -> int:
     return r_val
 
 
+###
+# Incremental builds. The manifest in the output directory records, for
+# each source file, the hashes of what it was compiled from, and the 
+# version of the compiler that did it. Only the files whose entries no
+# longer match are compiled again.
+###
+manifest_name = 'compiler.manifest.json'
+worker_compiler = None
+
+
+def file_hash(filename:str) -> str:
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1<<16), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+# The compiler is this file, the grammar, and the parser.
+compiler_version = " ".join([this_commit] + 
+    [ file_hash(_.__file__)[:16] for _ in (sys.modules[__name__], grammar, ijklparser) ])
+
+
+def config_hash(opts:argparse.Namespace) -> str:
+    """
+    Hash everything other than the source that goes into a recipe: the
+    config files that RecipeCompiler loads, the ssh config and the AWS
+    credentials whose contents are copied into the recipes, and the 
+    options and the environment that change what it does with them.
+
+    NOTE: the credentials that come from the database are not in the
+    hash. After they change, compile with --force.
+    """
+    hasher = hashlib.sha256()
+    files = []
+    for r, ds, fs in os.walk(opts.config, followlinks=True):
+        files.extend(os.path.join(r, _) for _ in fs if _.endswith(opts.ext))
+    files.sort()
+
+    files.extend(sorted({ _ for _ in (opts.ssh_config, 
+        uu.expandall("~") + "/.ssh/config",
+        os.environ.get('AWS_SHARED_CREDENTIALS_FILE')) if _ }))
+
+    for _ in files:
+        hasher.update(_.encode('utf-8'))
+        try:
+            hasher.update(file_hash(_).encode('utf-8'))
+        except OSError as e:
+            hasher.update(b'missing')
+
+    settings = (opts.debug, opts.prod, opts.ssh_config, opts.opt, 
+        os.environ.get('CANOE_DATA', '/sw/canoe/var/data'))
+    hasher.update(repr(settings).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def load_manifest(directory:str) -> dict:
+    try:
+        with open(os.path.join(directory, manifest_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        return {}
+
+
+def save_manifest(directory:str, manifest:dict) -> None:
+    filename = os.path.join(directory, manifest_name)
+    with open(filename + '.new', 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(filename + '.new', filename)
+
+
+def update_schedule_index(directory:str, 
+        winners:Dict[str, str],
+        fresh:Dict[str, Recipe],
+        fingerprints:Dict[str, dict],
+        output_for:Callable[[str], str]) -> int:
+    """
+    Bring the schedule index up to date with this run.
+
+    winners -- the source file of each recipe that was compiled or was
+        up to date in this run, by name. 
+    fresh -- the recipes that were compiled in this run, by source file.
+
+    returns -- the number of recipes in the index.
+    """
+    index = loader.load_schedule_index(directory)
+    for name, f in winners.items():
+        if f in fresh:
+            schedule = fresh[f].schedule
+        elif index.get(name, {}).get('hash') == fingerprints[f]['source']:
+            continue
+        else:
+            # Up to date, but not in the index; it was compiled before
+            # there was one.
+            packer = urpacker.URpacker()
+            packer.attachIO(output_for(f), s_mode='read')
+            schedule = packer.read()['schedule']
+
+        index[name] = {'schedule': loader.schedule_to_json(schedule),
+            'source': f, 'mtime': os.path.getmtime(f), 
+            'hash': fingerprints[f]['source'], 'object': output_for(f)}
+
+    # Recipes whose object code is gone, or now belongs to a recipe
+    # with a different name, are not scheduled.
+    claimed = { output_for(f) for f in winners.values() }
+    index = { k: v for k, v in index.items() if os.path.isfile(v['object'])
+        and (k in winners or v['object'] not in claimed) }
+    loader.save_schedule_index(directory, index)
+    return len(index)
+
+
+def init_worker(opts:argparse.Namespace) -> None:
+    """
+    Each process that compiles gets its own compiler, and so its own
+    database connection and its own copy of the config.
+    """
+    global worker_compiler
+    worker_compiler = RecipeCompiler(opts)
+
+
+def compile_one(f:str) -> Tuple[Recipe, int, int]:
+    """
+    Parse and compile one source file with this process's compiler.
+
+    returns -- the same as RecipeCompiler.compile()
+    """
+    try:
+        parser = IJKLparser(worker_compiler.opts.debug)
+        s = parser.attachIO(f).parse()
+        if s is not None:
+            return worker_compiler.compile(s, f)
+        uu.tombstone("No source code found in {}".format(f))
+
+    except (Exception, SystemExit) as e:
+        # compile() calls sys.exit() on some errors, and that must
+        # not take down the pool.
+        uu.tombstone(f"{f} :: {uu.type_and_text(e)}")
+
+    return None, 1, 0
+
+
+def compile_all(file_list:List[str], opts:argparse.Namespace) -> Dict[str, tuple]:
+    """
+    Compile the files, in parallel if there is more than one and 
+    we are allowed to.
+
+    returns -- {filename: (recipe, errors, warnings)}
+    """
+    jobs = min(opts.jobs, len(file_list))
+    if jobs <= 1:
+        if worker_compiler is None: init_worker(opts)
+        return { f: compile_one(f) for f in file_list }
+
+    with concurrent.futures.ProcessPoolExecutor(jobs, 
+            initializer=init_worker, initargs=(opts,)) as pool:
+        return dict(zip(file_list, pool.map(compile_one, file_list)))
+
+
 def compiler_main() -> int:
     """
     Compile IJKL to executable code.
@@ -2334,6 +2548,10 @@ def compiler_main() -> int:
     p.add_argument('--ext', type=str, default='.json', 
         help='file ext for input files.')
 
+    p.add_argument('--force', action='store_true',
+        help='compile everything, even the recipes that are up to date. '
+            'Use it after changing the credentials in the database.')
+
     p.add_argument('filenames', type=str, action='append', nargs='?',
         help='The name of the file[s] to compile.')
 
@@ -2343,6 +2561,9 @@ def compiler_main() -> int:
     p.add_argument('--no-diag', action='store_true', 
         help='do NOT create a decompiled version of the fully parsed input.')
 
+    p.add_argument('-j', '--jobs', type=int, default=len(os.sched_getaffinity(0)),
+        help='the number of recipes to compile at once.')
+
     p.add_argument('-o', '--output', default=COMPILEROUTPUT,
         help='Specify a non-default location for the compiled code.')
 
@@ -2391,21 +2612,18 @@ def compiler_main() -> int:
         print('ERROR: You must either specify a file to compile, or use the --all option.')
         return os.EX_NOINPUT
 
-    jreader = jp.JSONReader()       # To read the source code.
-    recipe = Recipe()               # So that this var is init-ed.
-    compiled_recipes = {}           # Temp storage to look for conflicts.
+    compiled_recipes = {}           # The first source file seen for each name.
     failures = []                   # List of recipes that failed to compile.
     supersedures = []               # List of recipes hiding other recipes.
     file_list = []                  # The list of fqn-s of source files.
     compiled_file_list = []         # Where they wind up.
+    up_to_date_list = []            # The ones that did not need to be compiled.
     diagnostic_file_list = []       # Where any diagnostic files might be found.
 
     stats = canoestats.CanoeStats(
         os.path.join(os.environ.get('CANOE_HOME', '.'), 'canoestats.db')
         )
 
-    compiler = RecipeCompiler(opts)
-
     if opts.all: 
         opts.filenames = glob.glob(os.path.join(opts.source, "*.json"))
         file_list.extend(opts.filenames)
@@ -2413,30 +2631,64 @@ def compiler_main() -> int:
         for e in opts.filenames:
             file_list.extend(glob.glob(os.path.join(opts.source, e)))
 
+    file_list = [ uu.expandall(f if f.startswith(os.sep) else os.path.join(opts.source, f)) 
+        for f in file_list ]
     print("list of files to compile: {}".format(file_list))
 
     mypid = os.getpid()
     process_bytes_used = uu.mymem()
 
-    for i, f in enumerate(file_list, start=1):
-        packer = urpacker.URpacker()
-        if not f.startswith(os.sep): f = os.path.join(opts.source, f)
-        f = uu.expandall(f)
-
-        errors = 1
-        warnings = 0
-
-        try:
-            parser = IJKLparser(opts.debug)
-            opts.debug and print(f"parser built")
-            s = parser.attachIO(f).parse()
-            if s is not None:
-                recipe, errors, warnings = compiler.compile(s, f)
-            else:
-                uu.tombstone("No source code found in {}".format(f))
+    ###
+    # Work out which files need to be compiled. These things are the
+    # same for every recipe in the run, so find them once.
+    ###
+    object_code = uu.canoe_version()
+    this_config = config_hash(opts)
+    manifest = {} if opts.force else load_manifest(COMPILEROUTPUT)
+
+    def output_for(f:str) -> str:
+        return uu.expandall(os.path.join(COMPILEROUTPUT, fname.Fname(f).fname_only + '.jsc'))
+
+    fingerprints = { f: {'source': file_hash(f), 'config': this_config, 
+        'compiler': compiler_version} for f in file_list }
+
+    def is_current(f:str) -> bool:
+        entry = manifest.get(f)
+        return ( entry is not None and os.path.isfile(output_for(f)) and
+            all(entry.get(k) == v for k, v in fingerprints[f].items()) )
+
+    stale = [ f for f in file_list if not is_current(f) ]
+    fresh = {}                      # The recipes written in this run, by source file.
+    print(f"{len(file_list)-len(stale)} of {len(file_list)} recipes are up to date.")
+    results = compile_all(stale, opts) if stale else {}
+
+    ###
+    # Which recipe supersedes which depends on the order of the files,
+    # so a recipe that is otherwise current must be compiled again if
+    # the one it hides (or not) has changed.
+    ###
+    first_seen = {}
+    resupersede = []
+    for f in file_list:
+        if f in results:
+            recipe = results[f][0]
+            if recipe is not None: first_seen.setdefault(recipe.name, f)
+        else:
+            entry = manifest[f]
+            first = first_seen.setdefault(entry['name'], f)
+            if entry['supersedes'] != (first if first != f else None):
+                resupersede.append(f)
+    if resupersede: results.update(compile_all(resupersede, opts))
+
+    for f in file_list:
+        if f not in results:
+            entry = manifest[f]
+            compiled_recipes.setdefault(entry['name'], f)
+            if entry['supersedes']: supersedures.append((f, entry['supersedes']))
+            up_to_date_list.append(output_for(f))
+            continue
 
-        except Exception as e:
-            uu.tombstone(str(e))
+        recipe, errors, warnings = results[f]
 
         summary = f"{errors} errors and {warnings} warnings."
         if errors or warnings:
@@ -2452,39 +2704,44 @@ def compiler_main() -> int:
             print(f"Compilation of {recipe.name} SUCCEEDED.")
             stats.new_integration(recipe.name, recipe.frequency)
 
-        # For informational purposes, we need to keep track of one recipe hiding another one.
-        try:
-            _ = compiled_recipes[recipe.name]
-            recipe['supersedes'] = _.origin
-            supersedures.append((recipe.origin, _.origin))
-
-        except KeyError as e:
-            # The recipe compiled, and this is the first time we have seen it.
-            compiled_recipes[recipe.name] = recipe
-            recipe['supersedes'] = None
-
-        except AttributeError as e:
-            # recipe was None.
+        if recipe is None:
             failures.append(f)
+            manifest.pop(f, None)
             continue
 
-        finally:
-            recipe = uu.deepsloppy(recipe)
+        # For informational purposes, we need to keep track of one recipe hiding another one.
+        first = compiled_recipes.setdefault(recipe.name, f)
+        recipe['supersedes'] = first if first != f else None
+        if recipe.supersedes: supersedures.append((f, first))
+        recipe = uu.deepsloppy(recipe)
 
-        outputfile = uu.expandall(
-            os.path.join(COMPILEROUTPUT, fname.Fname(f).fname_only + '.jsc')
-            )
+        packer = urpacker.URpacker()
+        outputfile = output_for(f)
         packer.attachIO(outputfile, s_mode='write')
-        packer.write(recipe, show_stats=True, object_code=uu.canoe_version())
-        compiled_file_list.append(outputfile + '.jsc')
+        packer.write(recipe, show_stats=True, object_code=object_code)
+        compiled_file_list.append(outputfile)
+        fresh[f] = recipe
+
+        # Only a clean compile is worth remembering.
+        if errors: 
+            manifest.pop(f, None)
+        else:
+            manifest[f] = {**fingerprints[f], 'name':recipe.name, 'supersedes':recipe.supersedes}
 
         if not opts.no_diag:
             diag_file = outputfile + '.diagnostic.json'
-            with open(diag_file, "w") as f:
+            with open(diag_file, "w") as diag:
                 printable=recipe.reorder(HEADER_KEYS + recipe.roster)
-                pprint.pprint(printable, stream=f, indent=4, width=100, compact=False, sort_dicts=False)
+                pprint.pprint(printable, stream=diag, indent=4, width=100, compact=False, sort_dicts=False)
             diagnostic_file_list.append(diag_file)
 
+    save_manifest(COMPILEROUTPUT, manifest)
+    scheduled = update_schedule_index(COMPILEROUTPUT, 
+        { name: f for name, f in compiled_recipes.items() 
+            if f in fresh or f not in results },
+        fresh, fingerprints, output_for)
+    if not opts.quiet: print(f"{scheduled} recipes are in the schedule index.")
+
     if len(compiled_recipes) and not opts.quiet:
         print("\ncompiled {} recipes.\n".format(len(compiled_recipes)))
         print(sorted(list(compiled_recipes.keys())))
@@ -2492,6 +2749,10 @@ def compiler_main() -> int:
         print("\nCompiled files\n" + 60*"-")
         print("\n".join(sorted(compiled_file_list)))
 
+        if up_to_date_list:
+            print("\nUp to date\n" + 60*"-")
+            print("\n".join(sorted(up_to_date_list)))
+
         if not opts.no_diag:
             print("\nDiagnostic files\n" + 60*"-")
             print("\n".join(sorted(diagnostic_file_list)))
@@ -259,12 +259,16 @@ def destination_main(opcodes:list) -> ERROR_ACTION:
 
             elif 'host' in subroutine:
                 handle = hop.HOP(subroutine.host)
+                # Send them all at once, several at a time; any that do 
+                # not make it are tried again, one by one, with back off.
+                sent = handle.send_files([ f.fqn for f in files ], 
+                    subroutine.directory, subroutine.overwrite) or {}
                 for f in files:
                     # f = fname.Fname(zipit(f, *subroutine.zip))
 
                     uu.tombstone('transferring {} to {}:{}'.format(
                         f.fqn, subroutine.host.hostname, subroutine.directory))
-                    if deliver_file_host(handle, local_filename=f.fqn, 
+                    if sent.get(f.fqn) or deliver_file_host(handle, local_filename=f.fqn, 
                             remote_directory=subroutine.directory,
                             remote_filename=f.fname, 
                             overwrite=subroutine.overwrite): 
@@ -80,33 +80,31 @@ def encryptpics_main(opcodes:uu.SloppyDict) -> ERROR_ACTION:
         return ERROR_ACTION.stop
 
     names = loader.read('pandas')[opcodes.column]
-    successes = 0
-    failures = 0
     missing = 0
-    for i, name in enumerate(names):
-        f = fname.Fname(uu.path_join(opcodes.images, name) + ".jpg")
-        if not f:
-            missing += 1
-            uu.tombstone(f"No file named {str(f)} found.")
-            continue
+    with pluginlib.CommandPool(myname) as pool:
+        for i, name in enumerate(names):
+            f = fname.Fname(uu.path_join(opcodes.images, name) + ".jpg")
+            if not f:
+                missing += 1
+                uu.tombstone(f"No file named {str(f)} found.")
+                continue
+            
+            # We should have files named {UR}i.{gpg} or similar, that represent
+            # the encrypted versions of the pictures.
+            seg = command_segments[2].format(i, str(f))
+
+            ##########
+            #  HERE  #
+            ##########
         
-        # We should have files named {UR}i.{gpg} or similar, that represent
-        # the encrypted versions of the pictures.
-        seg = command_segments[2].format(i, str(f))
-
-        ##########
-        #  HERE  #
-        ##########
-    
-        cmd = " ".join([command_segments[0], command_segments[1], seg])
-        result = uu.dorunrun(cmd, verbose=True)
-        if result: 
-            successes += 1
-            print(f"{str(f)} found and encrypted.", file=sys.stderr)
-        else: 
-            failures += 1
-            print(cmd)
-            sys.exit(-1)
+            cmd = " ".join([command_segments[0], command_segments[1], seg])
+            pool.submit(cmd, str(f))
+
+    uu.tombstone(f"{pool.successes} pictures encrypted, {missing} not found.")
+    if pool.failures:
+        tag, cmd, code, text = pool.failures[0]
+        print(cmd)
+        sys.exit(-1)
 
     stats.update(myname, mytype, LED.GREEN)
     return ERROR_ACTION.proceed
@@ -21,7 +21,6 @@ import os
 import os.path
 import shlex
 import shutil
-import subprocess
 import sys
 import time
  
@@ -30,6 +29,7 @@ import canoestats
 from   canoestats import LED
 import fname
 from   grammar import *
+import pluginlib
 import tombstone as tomb
 import urpacker
 import urutils as uu
@@ -98,47 +98,45 @@ def fusionpics_main(opcodes:uu.SloppyDict) -> ERROR_ACTION:
     #################### STEP 1 ##############################
     # In the dictionary, the keys are the URIDs, and the values
     # are the PIDMs with some modifiers for the correct filename    
+    # The conversions are independent of one another, so they are
+    # run several at a time.
     ###
+    try:
+        with pluginlib.CommandPool(myname) as pool:
+            for urid in list(all_pics.keys()):
+                # First ... let's see if there is a file at all.
+                original = picname(urid, fusiondirs.pics)
+                if original is None: 
+                    all_pics.pop(urid, None)
+                    continue
+            
+                # Now, check to see if there is resized file already, and one that
+                # is no older than the original file.
+                resized = picname(urid, fusiondirs.resized)
+                try:
+                    do_resize = os.stat(resized).st_mtime < os.stat(original).st_mtime
+                except:
+                    do_resize = True
+                if not do_resize: continue
+
+                ###
+                # OK, we need a resized pic. This is the real substance of the
+                # loop -- the above logic is just a filter.
+                ###
+                cmd=" ".join([
+                    opcodes.convert_exe, original, opcodes.convert_ops, 
+                    "{}{}{}.jpg".format(fusiondirs.resized, os.sep, urid)
+                    ])
+                pool.submit(shlex.split(cmd), original)
 
-    for i, urid in enumerate(list(all_pics.keys())):
-        if not i % 100:
-            tomb.tombstone("processing #{}".format(i))
-        # First ... let's see if there is a file at all.
-        original = picname(urid, fusiondirs.pics)
-        if original is None: 
-            all_pics.pop(urid, None)
-            continue
-    
-        # Now, check to see if there is resized file already, and one that
-        # is no older than the original file.
-        resized = picname(urid, fusiondirs.resized)
-        try:
-            do_resize = os.stat(resized).st_mtime < os.stat(original).st_mtime
-        except:
-            do_resize = True
-
-        ###
-        # OK, we need a resized pic. This is the real substance of the
-        # loop -- the above logic is just a filter.
-        ###
-        try:
-            cmd=" ".join([
-                opcodes.convert_exe, original, opcodes.convert_ops, 
-                "{}{}{}.jpg".format(fusiondirs.resized, os.sep, urid)
-                ])
-            subprocess.run(shlex.split(cmd)).check_returncode()
-
-        except subprocess.CalledProcessError as e:
-            stats.update(myname, mytype, LED.RED)
-            tomb.tombstone(uu.type_and_text(e))
-            return ERROR_ACTION.stop
+    except Exception as e:
+        stats.update(myname, mytype, LED.RED)
+        tomb.tombstone(uu.type_and_text(e))
+        return ERROR_ACTION.stop
 
-        except Exception as e:
-            stats.update(myname, mytype, LED.RED)
-            tomb.tombstone(uu.type_and_text(e))
-            return ERROR_ACTION.stop
-    else:
-        tomb.tombstone("processed {} pics.".format(i))        
+    if pool.failures:
+        stats.update(myname, mytype, LED.RED)
+        return ERROR_ACTION.stop
 
 
     ######################### STEP 2 ##################################
@@ -8,6 +8,7 @@ Description of the plugin goes here.
 
 import os
 import os.path
+import shutil
 import sys
 from   typing import *
 
@@ -57,21 +58,26 @@ def modifypics_main(opcodes:list) -> ERROR_ACTION:
     stats.update(myname, mytype, LED.ON)
     exe = shutil.which('convert')
 
-    for i, subroutine in enumerate(opcodes):
-        h = subroutine.size.height
-        w = subroutine.size.width
-        g = subroutine.gravity
-        o = subroutine.output
-        conversion = f"{exe} {{}} -resize {h}x{w}^ -despeckle -gravity {g} -crop {h}x{w}+0+0 o/{{}}"
-
-        for f in uu.all_files_like(subroutine.input):
-            try:
-                uu.dorunrun(conversion.format(f, os.path.basename(f)), 
-                    quiet=True)
-            except Exception as e:
-                uu.tombstone(e)
-                stats.update(myname, mytype, LED.RED)
-                return ERROR_ACTION.notify            
+    try:
+        with pluginlib.CommandPool(myname) as pool:
+            for i, subroutine in enumerate(opcodes):
+                h = subroutine.size.height
+                w = subroutine.size.width
+                g = subroutine.gravity
+                o = subroutine.output
+                conversion = f"{exe} {{}} -resize {h}x{w}^ -despeckle -gravity {g} -crop {h}x{w}+0+0 {o}/{{}}"
+
+                for f in uu.all_files_like(subroutine.input):
+                    pool.submit(conversion.format(f, os.path.basename(f)), f)
+
+    except Exception as e:
+        uu.tombstone(e)
+        stats.update(myname, mytype, LED.RED)
+        return ERROR_ACTION.notify            
+
+    if pool.failures:
+        stats.update(myname, mytype, LED.RED)
+        return ERROR_ACTION.notify            
 
     stats.update(myname, mytype, LED.GREEN)
     return ERROR_ACTION.proceed
@@ -10,12 +10,20 @@ from   typing import *
 
 import collections
 from   collections.abc import Iterable
+import concurrent.futures
+import ctypes
 import datetime
+import glob
 import json
+import math
 import os
 import os.path
+import select
 import signal
+import struct
+import subprocess
 import sys
+import threading
 import time
 
 # Installed imports
@@ -236,12 +244,113 @@ def test_empty(
     raise Exception(f'Bad arguments {filename}, {e}')
         
     
+class FileWatcher: pass
+class FileWatcher:
+    """
+    Wait for files matching a pattern to arrive in a local (or mounted)
+    directory. inotify tells us when a file is closed after writing, or
+    moved into the directory. Not every filesystem delivers the events
+    (NFS does not, for changes made on other hosts), so the directory
+    is also checked every poll_interval seconds, and if inotify is not
+    available at all, that is all we do.
+
+    Usage:
+
+        with FileWatcher('/a/b/*.csv') as w:
+            found = w.wait(seconds)
+    """
+
+    IN_CLOSE_WRITE  = 0x00000008
+    IN_MOVED_TO     = 0x00000080
+    event_header    = struct.Struct('iIII')
+    poll_interval   = float(os.environ.get('CANOE_POLL_SECONDS', 30))
+
+    def __init__(self, pattern:str) -> None:
+        self.pattern = pattern
+        self.directory = os.path.dirname(pattern) or '.'
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init1')
+            if libc.inotify_add_watch(fd, os.fsencode(self.directory), 
+                    FileWatcher.IN_CLOSE_WRITE | FileWatcher.IN_MOVED_TO) < 0:
+                e = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(e, f'inotify_add_watch {self.directory}')
+            self.fd = fd
+
+        except (OSError, AttributeError) as e:
+            uu.tombstone(f"inotify is not available; polling {self.directory}. {e}")
+
+
+    def __enter__(self) -> FileWatcher:
+        return self
+
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+    def matches(self) -> List[str]:
+        return glob.glob(self.pattern)
+
+
+    def wait(self, 
+            seconds:float, 
+            expected:Iterable=None) -> List[str]:
+        """
+        Wait until files matching the pattern are there, or the time
+        is up, whichever is first.
+
+        expected -- if given, wait for a number of files in it (as for
+            all_files_found()); otherwise, for at least one.
+
+        returns -- the files that match, which may be none.
+        """
+        deadline = time.time() + seconds
+        while True:
+            found = self.matches()
+            if found and (expected is None or all_files_found(found, expected)): 
+                return found
+
+            remaining = deadline - time.time()
+            if remaining <= 0: return found
+
+            timeout = min(remaining, FileWatcher.poll_interval)
+            if self.fd is None:
+                time.sleep(timeout)
+                continue
+
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if readable: self._drain()
+
+
+    def _drain(self) -> None:
+        """
+        Read and discard the events; we look at the directory itself
+        to see what is there.
+        """
+        try:
+            while os.read(self.fd, 65536): pass
+        except BlockingIOError as e:
+            pass
+
+
 @trap
 def wait_or_give_up(
     blinker:Blinker,
     interval:int=0,
     until:int=-1,
-    use:int=0) -> tuple:
+    use:int=0,
+    watch:str=None,
+    expected:Iterable=None) -> tuple:
     """
     Causes process to suspend for a while so that it can try again.
 
@@ -256,6 +365,13 @@ def wait_or_give_up(
     use -- on the initial call, this is used to calculate the value 
         of /until/ if use is zero. After that, it is set to zero. 
 
+    watch -- optionally, the local pathname (wildcards allowed) of the
+        files we are waiting for. If it is given, we return as soon 
+        as they arrive rather than at the end of the interval.
+
+    expected -- with watch, the numbers of files that are enough; see
+        all_files_found(). The default is any number but zero.
+
     returns -- modified parameters as tuple(interval, until, use)
         if the operation has reached its end, return None.
     """
@@ -286,18 +402,160 @@ def wait_or_give_up(
         interval = min(interval, until-now)
 
     blinker.blink(LED.WAITING)
-    uu.tombstone(f"Process {os.getpid()} is sleeping for {interval} minutes.")
     nap_begun = time.time()
-    sleep_for = interval*60
+    arrived = []
+    if watch is not None and os.path.isdir(os.path.dirname(watch) or '.'):
+        uu.tombstone(f"Process {os.getpid()} is watching for {watch} for up to {interval} minutes.")
+        # A stray signal should not put the handler to sleep; select()
+        # is restarted after the handler returns.
+        sleep_for = 0
+        with FileWatcher(watch) as watcher:
+            arrived = watcher.wait(interval*60, expected)
+        if arrived: uu.tombstone(f"{len(arrived)} files arrived after {time.time()-nap_begun:.1f}s.")
+
+    else:
+        uu.tombstone(f"Process {os.getpid()} is sleeping for {interval} minutes.")
+        sleep_for = interval*60
+        time.sleep(sleep_for)
 
-    time.sleep(sleep_for)
     uu.tombstone(f"Process {os.getpid()} has awakened.")
     then = now
     now = now_as_minutes_of_the_day()
     
-    if now >= until:
+    if arrived:
+        blinker.blink(LED.ON)
+        return interval, until, use
+    elif now >= until:
         blinker.blink(LED.WAIT_EXPIRED)
         return None, None, None
     else:
         blinker.blink(LED.ON)
         return interval, until, use
+
+
+@trap
+def pool_size(most:int=None) -> int:
+    """
+    Decide how many commands a CommandPool runs at once: as many as
+    there are CPUs that the load average says are idle, but at least
+    one, and no more than most.
+
+    most -- the cap. The default is $CANOE_POOL_MAX, or the number 
+        of CPUs.
+    """
+    cpus = len(os.sched_getaffinity(0))
+    idle = cpus - math.ceil(os.getloadavg()[0])
+    most = most or int(os.environ.get('CANOE_POOL_MAX', cpus))
+    return max(1, min(idle, most))
+
+
+class CommandPool:
+    """
+    Run external commands (convert, gpg, ...) several at a time. The
+    commands are child processes, so the threads that wait on them
+    cost almost nothing, and the work spreads across the CPUs.
+
+    Usage:
+
+        with pluginlib.CommandPool(myname) as pool:
+            for f in files:
+                pool.submit(f"convert {f} ...", f)
+
+        if pool.failures:
+            ...
+
+    When the with block ends, every command has finished, and the
+    outcome has been written to the log as one tombstone.
+    """
+
+    def __init__(self, name:str, *, 
+            workers:int=None, 
+            stop_on_failure:bool=True) -> None:
+        """
+        name -- used to label the summary.
+        workers -- the most commands to run at once. The default is
+            pool_size().
+        stop_on_failure -- after a command fails, do not start the 
+            ones that are still waiting. This is the way a loop that
+            returns at the first failure behaves.
+        """
+        self.name = name
+        self.workers = workers or pool_size()
+        self.stop_on_failure = stop_on_failure
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self.lock = threading.Lock()
+        self.failed = threading.Event()
+        self.submitted = 0
+        self.successes = 0
+        self.skipped = 0
+        self.failures = []
+        self.started = time.time()
+
+
+    def __enter__(self) -> object:
+        return self
+
+
+    def __exit__(self, exc_type:type, exc_value:BaseException, traceback:object) -> bool:
+        # Something went wrong in the with block; do not start anything else.
+        if exc_type is not None: self.failed.set()
+        self.wait()
+        return False
+
+
+    def submit(self, command:Union[str, list], tag:str=None) -> int:
+        """
+        command -- a string is run by the shell; a list is not.
+        tag -- the name used for this command in the summary, usually
+            the file it is working on.
+
+        returns -- the number of commands submitted so far.
+        """
+        self.submitted += 1
+        self.executor.submit(self._run, command, tag or str(command))
+        return self.submitted
+
+
+    def _run(self, command:Union[str, list], tag:str) -> None:
+        if self.stop_on_failure and self.failed.is_set():
+            with self.lock: self.skipped += 1
+            return
+
+        try:
+            result = subprocess.run(command, 
+                shell=isinstance(command, str),
+                stdout=subprocess.PIPE, 
+                stderr=subprocess.PIPE)
+            code, text = result.returncode, result.stderr.decode('utf-8', 'replace').strip()
+
+        except Exception as e:
+            code, text = -1, uu.type_and_text(e)
+
+        with self.lock:
+            if code == 0:
+                self.successes += 1
+            else:
+                self.failures.append((tag, command, code, text))
+                self.failed.set()
+
+
+    def wait(self) -> bool:
+        """
+        Wait for the commands to finish, and write the summary.
+
+        returns -- True if none of them failed.
+        """
+        self.executor.shutdown(wait=True)
+        tomb.tombstone(self.summary())
+        return not self.failures
+
+
+    def summary(self) -> str:
+        s = ( f"{self.name}: {self.submitted} commands on {self.workers} workers in "
+            f"{time.time()-self.started:.1f}s; {self.successes} succeeded, "
+            f"{len(self.failures)} failed, {self.skipped} not started." )
+        for tag, command, code, text in self.failures[:10]:
+            s += f"\n  {tag} returned {code}: {text[-200:]}"
+        if len(self.failures) > 10:
+            s += f"\n  ... and {len(self.failures)-10} more."
+        return s
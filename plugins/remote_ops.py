@@ -72,6 +72,8 @@ def remote_ops_main(opcodes:list) -> ERROR_ACTION:
         try:
             if 'db' in subroutine:
                 rdb = urdb.URdb(subroutine.db)
+                batch_size = subroutine.get('batch_size') or int(os.environ.get('CANOE_FETCH_BATCH', 5000))
+                packing = subroutine.get('packing') or os.environ.get('CANOE_PACKING', 'pickle')
                 debugging and uu.tombstone("database opened.")
                 for op in subroutine.ops:
                     is_select = op.upper().startswith('SELECT')
@@ -79,35 +81,56 @@ def remote_ops_main(opcodes:list) -> ERROR_ACTION:
                     stats.update(myname, mytype, LED.ON)
                     try:
                         tomb.tombstone(op)
-                        result = rdb.execute_SQL(uu.date_filter(op))
+                        t = uu.path_join(subroutine.local_dir, 'tempfile')
+                        if is_select and packing != 'frame':
+                            # Stream the rows straight into the intermediate file
+                            # rather than holding the whole result set in memory.
+                            # The values are the driver's own, so a nullable 
+                            # integer column stays integer rather than becoming 
+                            # 5.0 as it does in a DataFrame; packing: frame 
+                            # keeps the old behavior.
+                            packer = urpacker.URpacker()
+                            packer.attachIO(t)
+                            batches = rdb.fetch_batches(uu.date_filter(op), batch_size)
+                            result = ( packer.write_columnar(batches)
+                                if packing == 'columnar' 
+                                else packer.write_batches(batches) )
+                        else:
+                            result = rdb.execute_SQL(uu.date_filter(op))
                         tomb.tombstone('DB operation completed.')
                         if result is None:
                             debugging and uu.tombstone("Error in DB operation.")
                             stats.update(myname, mytype, LED.RED)
+                            if os.path.exists(t): os.unlink(t)
                             return ERROR_ACTION.cleanup
 
-                        if not result and test_empty(result, subroutine.on_error):
+                        if not result and test_empty([], subroutine.on_error):
                             debugging and uu.tombstone("No data. Stopping.")
                             stats.update(myname, mytype, LED.GREEN)
+                            # Nothing downstream reads an empty result; leave
+                            # no tempfile behind, as before streaming.
+                            if os.path.exists(t): os.unlink(t)
                             return ERROR_ACTION.stop
 
                         selected_columns = rdb.selected_columns
 
-                        if is_select:
+                        if is_select and packing == 'frame':
                             packer = urpacker.URpacker()
-                            t = uu.path_join(subroutine.local_dir, 'tempfile')
                             packer.attachIO(t)
-                            message = f'Query returned {len(result)} rows.'
-                            stats.update(myname, mytype, LED.GREEN)
                             packer.write(result)
+                            result = len(result)
+
+                        if is_select:
+                            message = f'Query returned {result} rows.'
+                            stats.update(myname, mytype, LED.GREEN)
                             tcols = uu.path_join(subroutine.local_dir, 'tempfile.columns')
                             trows = uu.path_join(subroutine.local_dir, 'tempfile.rows')
                             with open(tcols, 'w+') as tc:
                                 tc.write("|".join(selected_columns))
                             with open(trows, 'w+') as tr:
-                                tr.write(f"{len(result)}")
+                                tr.write(f"{result}")
                             if (subroutine.on_error is ERROR_ACTION.test_empty and
-                                not len(result)): return ERROR_ACTION.stop
+                                not result): return ERROR_ACTION.stop
 
                         else:
                             message = f'{result} rows affected.'
@@ -185,7 +185,9 @@ def source_main(opcodes:list) -> ERROR_ACTION:
                     need_something = 0 not in subroutine.required.count
                     # uu.tombstone(f"{got_something} and {need_something}")
                     if need_something and not got_something:
-                        interval, until, use = wait_or_give_up(blinker, interval, until, use)
+                        interval, until, use = wait_or_give_up(blinker, interval, until, use,
+                            watch=f if handle.local_hop else None, 
+                            expected=subroutine.required.count)
                         waiting = until is not None
                         continue
 
@@ -170,7 +170,19 @@ def xforms_main(opcodes:list) -> ERROR_ACTION:
             csv_info = subroutine.output.format
             p = urpacker.URpacker()
             p.attachIO(input_file, s_mode='read')
-            frame = p.read(format='pandas')
+            # A columnar file can be written out a chunk at a time. Each
+            # chunk is first cast to the dtypes of the whole file (those
+            # that concat() gives the first rows of the chunks), so that a
+            # column that only meets a NULL in a later chunk is written
+            # as 1.0 throughout, not 1 and then 2.0.
+            if p.is_columnar():
+                heads = [ _.iloc[:1] for _ in p.iter_chunks() ]
+                dtypes = pandas.concat(heads, ignore_index=True).dtypes if heads else {}
+                p.attachIO(input_file, s_mode='read')
+                chunks = ( _.astype(dtypes) for _ in p.iter_chunks() )
+            else:
+                chunks = iter([p.read(format='pandas')])
+            frame = next(chunks, pandas.DataFrame())
 
             # If frame is empty, and we were halfway expecting it...
             if ( frame.empty and 
@@ -208,6 +220,13 @@ def xforms_main(opcodes:list) -> ERROR_ACTION:
                     columns=column_names,
                     sep=csv_info.sep, 
                     quotechar=csv_info.quote)
+                for frame in chunks:
+                    frame.to_csv(output_file, index=False, mode='a',
+                        header=False,
+                        quoting=csv_info.qforce,
+                        columns=column_names,
+                        sep=csv_info.sep, 
+                        quotechar=csv_info.quote)
                 debugging and uu.tombstone(f"{output_file} written.")
                 stats.update(myname, mytype, LED.GREEN)
 
@@ -222,8 +241,7 @@ def xforms_main(opcodes:list) -> ERROR_ACTION:
             tomb.tombstone("About to invoke pandas2xml plugin")
             xml_writer = pandas2xml.Pandas2XML(**xml_info)
             tomb.tombstone('Exporting data to XML file {}'.format(output_file))
-            xml_writer.read_all()
-            num = xml_writer.write()
+            num = xml_writer.stream()
             if debugging: 
                 tomb.tombstone('wrote {} nodes.'.format(num))
                 stats.update(myname, mytype, LED.GREEN)
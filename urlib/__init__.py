@@ -4,6 +4,7 @@ __all__ = (
     ,'hop'
     ,'ijklparser'
     ,'__init__'
+    ,'jobqueue'
     ,'jparse'
     ,'pandas2xml'
     ,'sfy'
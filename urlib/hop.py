@@ -9,16 +9,21 @@ originates at one end only of the connection. It does not, however,
 create a shell on the other end. 
 """
 
+import concurrent.futures
 import fnmatch as fnm
 from   glob import glob
+import hashlib
 import os
 import paramiko
 from   paramiko import SSHException
+import re
 import shlex
 import shutil
 import socket
 import subprocess
 import sys
+import threading
+import time
 import typing
 from   typing import *
 
@@ -88,6 +93,31 @@ sftp_commands = {
     }
 
 
+###
+# Transfers of more than one file use several SFTP channels at once,
+# all on the one SSH transport. Each file is written under a .part 
+# name first, so a transfer that is cut off can pick up where it left
+# off, and the file only gets its real name once it is verified.
+#
+# The .part name carries the size and mtime of the source, as in
+# name.<size>-<mtime>.part, so that only a part of the same version of
+# the file is resumed. Without a checksum, the size is all that is 
+# checked at the end.
+###
+sftp_channels = int(os.environ.get('CANOE_SFTP_CHANNELS', 4))
+sftp_attempts = 3
+block_size = 1 << 20
+sha256_timeout = 30
+
+
+def file_sha256(filename:str) -> str:
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
 class HOP:
     pass
 
@@ -155,6 +185,8 @@ class HOP:
         self._transport = None
         self._sftp = None
         self._hostname = hostinfo.hostname
+        self._has_sha256sum = None
+        self._lease_lock = threading.Lock()
 
         for k, v in hostinfo.items():
             setattr(self, "_"+str(k), v)
@@ -170,19 +202,32 @@ class HOP:
             uu.tombstone("Local hop")
             return
 
+        self._hostinfo = hostinfo
+        if not self._lease(): return
+
+        uu.tombstone(f"Connected to {hostinfo.hostname}")
+        
+
+    def _lease(self) -> bool:
+        """
+        Get the connection (and its SFTP channel) for this host from the 
+        pool in urtunnel. Several HOPs to the same host in the same job
+        share one transport, and if the transport has gone away since
+        we last used it, the pool reconnects.
+
+        returns -- True if we are connected.
+        """
+        if self.local_hop: return True
         try:
-            self._hop = urt.drill_baby_drill(hostinfo, self._password)
-            if self._hop is None: return
-            self._transport = self._hop.get_transport()
-            self._sftp = paramiko.SFTPClient.from_transport(self._hop.get_transport())
+            self._hop, self._sftp = urt.lease_sftp(self._hostinfo, self._password)
+            self._transport = None if self._hop is None else self._hop.get_transport()
     
         except Exception as e:
             uu.tombstone(f"Exception {e}")
-            self._hop = None
-            return            
+            self._hop = self._sftp = self._transport = None
+
+        return self._hop is not None
 
-        uu.tombstone(f"Connected to {hostinfo.hostname}")
-        
 
 
     def __str__(self) -> str:
@@ -239,53 +284,272 @@ class HOP:
         remote_filename = uu.date_filter(remote_filename)
 
         if self.local_hop:
-            shutil.copy2(remote_filename, local_directory) 
-            return True
+            # Like the remote case, a wildcard name is allowed, and 
+            # nothing to copy is not an error.
+            local_files = glob(remote_filename)
+            for _ in local_files: shutil.copy2(_, local_directory) 
+            return len(local_files) > 0
             
+        if not self._lease():
+            raise Exception(f"Host {self._hostname} is not available.")
 
+        remote_dir, remote_file = os.path.split(remote_filename)
+        if not remote_dir: remote_dir = '.'
+        tomb.tombstone("checking remote dir <{}>".format(remote_dir))
         try:
-            remote_dir, remote_file = os.path.split(remote_filename)
-            if not remote_dir: remote_dir = '.'
-            tomb.tombstone("checking remote dir <{}>".format(remote_dir))
-            try:
-                remote_files = [ 
-                    _ for _ in 
-                    self._sftp.listdir(remote_dir) 
-                    if fnm.fnmatch(_, remote_file) 
-                    ]
-                tomb.tombstone("found these matching files: " + str(remote_files))
-                if not len(remote_files): 
-                    return False
-
-            except FileNotFoundError as e:
-                tomb.tombstone("Nothing found matching {}.".format(remote_filename))
+            remote_files = [ 
+                _ for _ in 
+                self._sftp.listdir(remote_dir) 
+                if fnm.fnmatch(_, remote_file) 
+                ]
+            tomb.tombstone("found these matching files: " + str(remote_files))
+            if not len(remote_files): 
                 return False
 
-            except OSError as e:
-                tomb.tombstone("unable to ls on " + remote_dir)
-                raise
+        except FileNotFoundError as e:
+            tomb.tombstone("Nothing found matching {}.".format(remote_filename))
+            return False
 
-            else:
-                tomb.tombstone("{}".format("\n".join(remote_files)))
-
-            i = 0
-            for _ in remote_files:
-                tomb.tombstone(uu.fcn_signature('_sftp.get',
-                    uu.path_join(remote_dir, _), uu.path_join(local_directory, _)
-                    ))
-                self._sftp.get(
-                    uu.path_join(remote_dir, _), 
-                    uu.path_join(local_directory, _)
-                    )
-                i += 1
-            else:
-                tomb.tombstone("Retrieved {} files.".format(i))
+        except OSError as e:
+            tomb.tombstone("unable to ls on " + remote_dir)
+            raise
+
+        results = self.transfer([ (uu.path_join(remote_dir, _), uu.path_join(local_directory, _))
+            for _ in remote_files ], 'get', overwrite)
+
+        failed = [ k for k, v in results.items() if not v ]
+        if failed: raise Exception(f"Unable to retrieve {failed}")
+        tomb.tombstone("Retrieved {} files.".format(len(results)))
+        return True
+
+
+    @trap
+    def send_files(self,
+            local_filenames:List[str],
+            remote_directory:str,
+            overwrite:bool=True) -> Dict[str, bool]:
+        """
+        Send several files to the same directory on the remote host, 
+        several at a time.
+
+        returns -- {local filename: True if it was sent}
+        """
+        if self.local_hop:
+            return { _: self.send_one_file(_, None, overwrite, remote_directory) 
+                for _ in local_filenames }
+
+        if not self._lease(): return { _: False for _ in local_filenames }
+        return self.transfer([ (os.path.abspath(_), uu.path_join(remote_directory, os.path.basename(_)))
+            for _ in local_filenames ], 'put', overwrite)
+
+
+    def transfer(self, 
+            jobs:List[Tuple[str, str]], 
+            direction:str, 
+            overwrite:bool=True) -> Dict[str, bool]:
+        """
+        The transfer engine. Move files, up to sftp_channels at once,
+        each over its own SFTP channel on our transport.
+
+        jobs -- a list of (from, to) filenames.
+        direction -- 'get' or 'put'.
+        overwrite -- if False, a file that is already at the other end
+            is left alone.
+
+        returns -- {from: True if it arrived and was verified}
+        """
+        mover = {'get':self._get_one, 'put':self._put_one}[direction]
+        channels = threading.local()
+        opened = []
+        moved = [0]
+        count_lock = threading.Lock()
+
+        def move(job:Tuple[str, str]) -> bool:
+            for attempt in range(1, sftp_attempts+1):
+                try:
+                    if getattr(channels, 'sftp', None) is None or channels.sftp.get_channel().closed:
+                        channels.sftp = paramiko.SFTPClient.from_transport(self._transport)
+                        with count_lock: opened.append(channels.sftp)
+                    n = mover(channels.sftp, *job, overwrite)
+                    with count_lock: moved[0] += n
+                    return True
+
+                except Exception as e:
+                    tomb.tombstone(f"{direction} {job[0]} failed (try {attempt}): {uu.type_and_text(e)}")
+                    if getattr(channels, 'sftp', None) is not None: channels.sftp.close()
+                    channels.sftp = None
+                    with self._lease_lock:
+                        if self._transport is None or not self._transport.is_active(): self._lease()
+                    if self._transport is None: return False
+            return False
+
+        start = time.time()
+        workers = max(1, min(sftp_channels, len(jobs)))
+        try:
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                results = dict(zip([ _[0] for _ in jobs ], pool.map(move, jobs)))
+
+        finally:
+            # The transport outlives the batch; its channels must not.
+            for sftp in opened: sftp.close()
+
+        elapsed = max(time.time() - start, 1e-6)
+        tomb.tombstone(f"{direction} {sum(results.values())} of {len(jobs)} files, "
+            f"{moved[0]/2**20:.1f} MB in {elapsed:.1f}s ({moved[0]/2**20/elapsed:.1f} MB/s) "
+            f"over {workers} channels.")
+        return results
+
+
+    @staticmethod
+    def _part_name(filename:str, info:object) -> str:
+        """
+        The .part name for filename, when the source has the size and
+        mtime in info (an os.stat_result or an SFTPAttributes).
+        """
+        return f"{filename}.{info.st_size}-{int(info.st_mtime)}.part"
+
+
+    @staticmethod
+    def _stale_parts(filename:str, part:str, names:Iterable[str]) -> List[str]:
+        """
+        The names (from a listing of filename's directory) of the parts
+        of other versions of filename. Parts of other files whose names
+        begin with this one's do not match.
+        """
+        pattern = re.compile(re.escape(os.path.basename(filename)) + r'\.\d+-\d+\.part')
+        return [ _ for _ in names 
+            if pattern.fullmatch(_) and _ != os.path.basename(part) ]
+
+
+    def _remote_sha256(self, remote_filename:str) -> Union[str, None]:
+        """
+        Ask the remote host for the file's checksum. If it cannot tell
+        us (no sha256sum, no shell, or too slow), we stop asking and 
+        settle for the size.
+        """
+        if self._has_sha256sum is False: return None
+        channel = None
+        try:
+            stdin, stdout, stderr = self._hop.exec_command(
+                f"sha256sum {shlex.quote(remote_filename)}", timeout=sha256_timeout)
+            channel = stdout.channel
+            answer = stdout.read().decode('utf-8', 'replace').split()
+            status = channel.recv_exit_status()
 
         except Exception as e:
-            tomb.tombstone(uu.type_and_text(e))
+            # SFTP-only accounts refuse exec, and a ForceCommand may 
+            # never answer.
+            status, answer = None, []
+            tomb.tombstone(f"{self._hostname} cannot run sha256sum: {uu.type_and_text(e)}")
+
+        finally:
+            # Each exec is a session; sshd allows only MaxSessions of them.
+            if channel is not None: channel.close()
+
+        if status != 0 or not answer:
+            self._has_sha256sum = False
+            tomb.tombstone(f"{self._hostname} gives no checksums; verifying by size.")
+            return None
+
+        self._has_sha256sum = True
+        return answer[0]
+
+
+    def _verify(self, local_filename:str, remote_filename:str, size:int, actual:int) -> None:
+        if actual != size:
+            raise Exception(f"{remote_filename} is {actual} bytes, but should be {size}.")
+        remote_sum = self._remote_sha256(remote_filename)
+        if remote_sum is not None and remote_sum != file_sha256(local_filename):
+            raise Exception(f"{remote_filename} and {local_filename} have different checksums.")
+
+
+    def _get_one(self, sftp:paramiko.SFTPClient, remote:str, local:str, overwrite:bool) -> int:
+        """
+        Copy one file here, starting from the end of any .part file
+        that a previous attempt at the same version left. Parts of 
+        other versions are removed.
+
+        returns -- the number of bytes moved.
+        """
+        if not overwrite and os.path.exists(local): return 0
+        info = sftp.stat(remote)
+        part = self._part_name(local, info)
+        where = os.path.dirname(local) or '.'
+        for stale in self._stale_parts(local, part, os.listdir(where)):
+            os.unlink(os.path.join(where, stale))
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset > info.st_size: offset = 0
+        if offset: tomb.tombstone(f"resuming {remote} at {offset} bytes.")
+
+        with sftp.open(remote, 'rb') as rf, open(part, 'ab' if offset else 'wb') as lf:
+            rf.seek(offset)
+            rf.prefetch(info.st_size)
+            for data in iter(lambda: rf.read(block_size), b''):
+                lf.write(data)
+
+        try:
+            self._verify(part, remote, info.st_size, os.path.getsize(part))
+        except Exception as e:
+            os.unlink(part)
             raise
-        
-        return True
+
+        os.utime(part, (info.st_atime, info.st_mtime))
+        os.replace(part, local)
+        return info.st_size - offset
+
+
+    def _put_one(self, sftp:paramiko.SFTPClient, local:str, remote:str, overwrite:bool) -> int:
+        """
+        Copy one file to the remote host, starting from the end of any
+        .part file that a previous attempt at the same version left 
+        there. Parts of other versions are removed.
+
+        returns -- the number of bytes moved.
+        """
+        if not overwrite:
+            try:
+                sftp.stat(remote)
+                return 0
+            except IOError as e:
+                pass
+
+        size = os.path.getsize(local)
+        part = self._part_name(remote, os.stat(local))
+        where = os.path.dirname(remote) or '.'
+        for stale in self._stale_parts(remote, part, sftp.listdir(where)):
+            sftp.remove(uu.path_join(where, stale))
+        try:
+            offset = sftp.stat(part).st_size
+        except IOError as e:
+            offset = 0
+        if offset > size: offset = 0
+        if offset: tomb.tombstone(f"resuming {local} at {offset} bytes.")
+
+        with open(local, 'rb') as lf, sftp.open(part, 'r+b' if offset else 'wb') as rf:
+            rf.set_pipelined(True)
+            lf.seek(offset)
+            rf.seek(offset)
+            for data in iter(lambda: lf.read(block_size), b''):
+                rf.write(data)
+
+        try:
+            self._verify(local, part, size, sftp.stat(part).st_size)
+        except Exception as e:
+            sftp.remove(part)
+            raise
+
+        info = os.stat(local)
+        sftp.utime(part, (info.st_atime, info.st_mtime))
+        try:
+            sftp.posix_rename(part, remote)
+        except IOError as e:
+            # The server does not have the posix-rename extension.
+            try:
+                sftp.remove(remote)
+            except IOError as e:
+                pass
+            sftp.rename(part, remote)
+        return size - offset
 
 
     def ls_sftp(self, pathname:str) -> List[str]:
@@ -346,6 +610,8 @@ class HOP:
                 else: raise
 
         else:
+            if not self._lease():
+                raise Exception(f"Host {self._hostname} is not available.")
             cmd = shlex.split(cmd)
             direct_function = sftp_commands.get(cmd[0], None)
             if direct_function is None:
@@ -426,37 +692,18 @@ class HOP:
             tomb.tombstone(" ".join(["local copy:", local_filename, "to", remote_filename]))
             return uu.fcopy_safe(local_filename, remote_filename) == 0
 
-        try:
-            channel = self._sftp.get_channel()
-            channel.settimeout(5.0)
-        except Exception as e:
-            tomb.tombstone('Cannot set timeout of get channel')
+        if not self._lease():
+            tomb.tombstone('Host {} is not available.'.format(self._hostname)) 
+            return False
 
-        # Note that if this blows up there are several possible causes, and most of 
-        # them involve an incorrectly written set of instructions. For example, you
-        # cannot copy a bunch of files to a single file.
-        try:
-            tomb.tombstone("local name: {}".format(os.path.abspath(local_filename)))
-            tomb.tombstone("dest name:  {}".format(remote_filename))
-            result = self._sftp.put(
-                os.path.abspath(str(local_filename)), 
-                remote_filename)
-            tomb.tombstone("result is {}".format(result))
-            
-        except AttributeError as e:
-            if self._sftp is None: 
-                tomb.tombstone('Host {} is not available.'.format(self._hostname)) 
-                return False
-                
-        except FileNotFoundError as e:
+        if not os.path.isfile(local_filename):
             tomb.tombstone("Either the source file does not exist or the destination file cannot be written.")
             return None
 
-        except Exception as e:
-            tomb.tombstone(uu.type_and_text(e))
-            return False
-
-        return True
+        tomb.tombstone("local name: {}".format(os.path.abspath(local_filename)))
+        tomb.tombstone("dest name:  {}".format(remote_filename))
+        return self.transfer([ (os.path.abspath(str(local_filename)), remote_filename) ], 
+            'put', overwrite)[os.path.abspath(str(local_filename))]
 
     @trap
     def mount_exists(self, mount_name:str) -> bool:
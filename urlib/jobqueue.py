@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+JobQueue is the durable transport between canoeschedd and canoed.
+It replaces the bytes-in-a-pipe scheme of FIFO with an SQLite
+database (in WAL mode) that sits next to the pipe:
+
+    $PIPEDIR/queue_name         the FIFO, now only a doorbell.
+    $PIPEDIR/queue_name.queue   the jobs.
+
+Usage:
+
+    from jobqueue import JobQueue
+
+    # The writer. The database is created if it is not there, and
+    # the reader does not need to be running.
+    q = JobQueue(queue_name, 'w')
+    q(['recipe_a', 'recipe_b'])       # or q.enqueue(...)
+
+    # The reader.
+    q = JobQueue(queue_name, 'r')
+    q.replay()                      # offer again what was in flight.
+    select.select([q], [], [], 60)  # the doorbell is select-able.
+    for job_id, name in q.lease():
+        ... run it ...
+        q.ack(job_id)
+
+Each job is a row, so a message is never split or truncated, and
+a batch can be as large as you like; a batch is written in one
+transaction. A job that has been leased stays in the database until
+it is acknowledged. If the reader dies, replay() makes the unfinished
+jobs available again, at most max_attempts times.
+
+After each enqueue, the writer puts the delimiter in the FIFO to wake
+the reader. The reader opens the FIFO read/write so that the pipe
+never reads as EOF when there is no writer. Anything else that
+arrives on the pipe is read the way FIFO reads it (names separated
+by the delimiter, and comments ignored), and enqueued, so
+
+    echo "some_recipe" > $PIPEDIR/queue_name
+
+still works.
+"""
+
+from   typing import *
+
+# Credits
+__author__ = 'George Flanagin'
+__copyright__ = 'Copyright 2020, University of Richmond'
+__credits__ = None
+__version__ = '0.1'
+__maintainer__ = 'George Flanagin'
+__email__ = 'gflanagin@richmond.edu'
+__status__ = 'Working Prototype'
+
+__license__ = 'MIT'
+import license
+
+import os
+import sqlite3
+import stat
+import time
+
+from   urdecorators import show_exceptions_and_frames as trap
+import urutils as uu
+
+class JobQueue:
+    """
+    Enqueue, lease, and acknowledge jobs by name.
+    """
+
+    schema = """
+        create table if not exists jobs (
+            id integer primary key autoincrement,
+            name text not null,
+            enqueued real not null,
+            leased_by integer,
+            leased_at real,
+            attempts integer not null default 0
+            );
+        create index if not exists jobs_waiting on jobs(id) where leased_at is null;
+        """
+
+    enqueue_stmt = "insert into jobs (name, enqueued) values (?, ?)"
+    waiting_stmt = "select id, name from jobs where leased_at is null order by id"
+    lease_stmt = """update jobs set leased_by = ?, leased_at = ?,
+        attempts = attempts + 1 where id = ?"""
+    ack_stmt = "delete from jobs where id = ?"
+    abandon_stmt = "delete from jobs where leased_at is not null and attempts >= ?"
+    replay_stmt = """update jobs set leased_by = null, leased_at = null
+        where leased_at is not null"""
+    requeue_stmt = """update jobs set leased_by = null, leased_at = null
+        where id = ? and attempts < ?"""
+    count_stmt = "select count(*) from jobs where leased_at is null"
+
+    max_attempts = int(os.environ.get('CANOE_QUEUE_ATTEMPTS', 3))
+
+    def __init__(self,
+            queue_name:str,
+            mode:str='r',
+            delimiter:str=';',
+            ignore:str='#'):
+        """
+        queue_name -- the name of the queue, relative to $PIPEDIR, or
+            absolute. It is the same name the FIFO had.
+        mode -- 'r' for the reader (canoed), 'w' for writers.
+        delimiter, ignore -- as for FIFO; see the module docstring.
+        """
+        if mode not in ('r', 'w'):
+            raise Exception(f"unknown mode {mode}. must be one of ('r', 'w').")
+
+        self.name = ( queue_name
+            if queue_name.startswith(os.sep) else
+            os.path.join(os.environ.get('PIPEDIR', os.getcwd()), queue_name) )
+        self.mode = mode
+        self.delimiter = delimiter
+        self.ignore = ignore
+        self.doorbell = None
+
+        try:
+            # isolation_level None means that we say when transactions
+            # begin, and lease() must begin with a write lock.
+            self.db = sqlite3.connect(self.name + '.queue', timeout=30,
+                isolation_level=None)
+            self.db.execute('pragma journal_mode = WAL')
+            self.db.execute('pragma synchronous = FULL')
+            self.db.executescript(JobQueue.schema)
+
+        except sqlite3.Error as e:
+            raise Exception(f"cannot open the queue {self.name}.queue: {str(e)}") from None
+
+        if self.mode == 'r': self._open_doorbell()
+        uu.tombstone(f"{self.name}.queue is open in mode <{self.mode}>")
+
+
+    def __str__(self) -> str:
+        return f"{self.name}.queue is open {self.mode} with {self.waiting()} jobs waiting."
+
+
+    def __call__(self, argument:Union[int, list]=None) -> Union[list, int]:
+        """
+        Like FIFO: enqueue if we are the writer, lease if we are the reader.
+        """
+        return self.enqueue(argument) if self.mode == 'w' else self.lease()
+
+
+    def fileno(self) -> int:
+        """
+        The doorbell, for select() and poll().
+        """
+        return self.doorbell
+
+
+    def _open_doorbell(self) -> None:
+        """
+        Make the FIFO if it is not there, and open it read/write and
+        non-blocking.
+        """
+        try:
+            if not stat.S_ISFIFO(os.stat(self.name).st_mode):
+                raise Exception(f"{self.name} is not a FIFO.")
+        except FileNotFoundError as e:
+            os.mkfifo(self.name, 0o600)
+            uu.tombstone(f"created new FIFO {self.name}")
+
+        self.doorbell = os.open(self.name, os.O_RDWR | os.O_NONBLOCK)
+
+
+    def _ring(self) -> None:
+        """
+        Wake the reader, if there is one. If there is not, the jobs
+        wait in the database until it starts.
+        """
+        try:
+            fd = os.open(self.name, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            # ENXIO: no reader. ENOENT: no reader has ever run.
+            return
+
+        try:
+            os.write(fd, self.delimiter.encode('utf-8'))
+        except BlockingIOError as e:
+            # The pipe is full of rings; one more is not needed.
+            pass
+        finally:
+            os.close(fd)
+
+
+    def _answer(self) -> List[str]:
+        """
+        Empty the doorbell, and return anything written to it other
+        than the rings.
+        """
+        data = b''
+        while True:
+            try:
+                chunk = os.read(self.doorbell, 65536)
+            except BlockingIOError as e:
+                break
+            if not chunk: break
+            data += chunk
+
+        return [ _.strip() for _ in data.decode('utf-8', 'replace').split(self.delimiter)
+            if _.strip() and not _.strip().startswith(self.ignore) ]
+
+
+    @trap
+    def enqueue(self, names:Union[str, List[str]]) -> int:
+        """
+        Add jobs, all in one transaction, and ring the doorbell.
+
+        returns -- the number of jobs added.
+        """
+        now = time.time()
+        rows = [ (name, now) for name in uu.listify(names) ]
+        if not rows: return 0
+
+        with self.db:
+            self.db.execute('begin immediate')
+            self.db.executemany(JobQueue.enqueue_stmt, rows)
+
+        self._ring()
+        return len(rows)
+
+
+    @trap
+    def lease(self, limit:int=None) -> List[Tuple[int, str]]:
+        """
+        Take the waiting jobs (or the first limit of them), oldest
+        first. A leased job is not offered again unless it is
+        replayed.
+
+        returns -- a list of (job_id, name).
+        """
+        if self.doorbell is not None:
+            strays = self._answer()
+            if strays: self.enqueue(strays)
+
+        pid = os.getpid()
+        now = time.time()
+        with self.db:
+            self.db.execute('begin immediate')
+            jobs = self.db.execute(JobQueue.waiting_stmt +
+                ("" if limit is None else f" limit {int(limit)}")).fetchall()
+            self.db.executemany(JobQueue.lease_stmt,
+                [ (pid, now, job_id) for job_id, _ in jobs ])
+
+        return jobs
+
+
+    @trap
+    def ack(self, job_id:int) -> None:
+        """
+        The job is finished (successfully or not); forget it.
+        """
+        with self.db:
+            self.db.execute(JobQueue.ack_stmt, (job_id,))
+
+
+    @trap
+    def requeue(self, job_id:int) -> bool:
+        """
+        The job was leased, but it did not finish (its worker died).
+        Offer it again, or drop it if it has been tried max_attempts
+        times.
+
+        returns -- True if it will be tried again.
+        """
+        with self.db:
+            self.db.execute('begin immediate')
+            again = self.db.execute(JobQueue.requeue_stmt, (job_id, JobQueue.max_attempts)).rowcount
+            if not again: self.db.execute(JobQueue.ack_stmt, (job_id,))
+
+        if not again:
+            uu.tombstone(f"job {job_id} in {self.name}.queue failed {JobQueue.max_attempts} times; dropped.")
+        return bool(again)
+
+
+    @trap
+    def replay(self) -> int:
+        """
+        Offer again the jobs that were leased and never acknowledged.
+        Only the reader should do this, and only when it starts. Jobs
+        that have already been tried max_attempts times are dropped.
+
+        returns -- the number of jobs that will be tried again.
+        """
+        with self.db:
+            self.db.execute('begin immediate')
+            dropped = self.db.execute(JobQueue.abandon_stmt, (JobQueue.max_attempts,)).rowcount
+            replayed = self.db.execute(JobQueue.replay_stmt).rowcount
+
+        if dropped:
+            uu.tombstone(f"{dropped} jobs in {self.name}.queue failed {JobQueue.max_attempts} times; dropped.")
+        if replayed:
+            uu.tombstone(f"{replayed} unfinished jobs in {self.name}.queue will be replayed.")
+        return replayed
+
+
+    def waiting(self) -> int:
+        return self.db.execute(JobQueue.count_stmt).fetchone()[0]
+
+
+    def close(self) -> None:
+        """
+        A forked worker closes the doorbell, but leaves the database
+        handle alone: it belongs to the parent.
+        """
+        if self.doorbell is not None:
+            os.close(self.doorbell)
+            self.doorbell = None
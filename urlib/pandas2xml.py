@@ -43,13 +43,13 @@ class Pandas2XML:
     __slots__ = (
         'frame', 'header', 'frame_name', 'row_name',
         'encoding', 'remap', 'output', 'tree', 
-        'root', 'frame_node', 'sep', 'debug', 'nodotzero'
+        'root', 'frame_node', 'sep', 'debug', 'nodotzero', 'source'
         )
     
     __defaults__ = (
         pandas.DataFrame(), default_header, default_frame_name, default_row_name,
         default_encoding, {}, None, None, 
-        None, None, '/', False, True
+        None, None, '/', False, True, None
         )
 
     def __init__(self, **kwargs) -> None:
@@ -106,7 +106,9 @@ class Pandas2XML:
 
         ###
         # Find out if we received data or the name of a packed file 
-        # containing the data. If it is a filename, unpack it.
+        # containing the data. If it is a filename, unpack it. A columnar
+        # file is left where it is, and only its column names are read;
+        # stream() reads it a chunk at a time.
         ###
         if isinstance(self.frame, str):
             if self.debug: tomb.tombstone("Attaching IO to {}".format(self.frame))
@@ -114,7 +116,12 @@ class Pandas2XML:
             if not p.attachIO(self.frame, s_mode='read'):
                 raise Exception("Could not read from {}".format(self.frame))
 
-            self.frame = p.read(format='pandas')
+            if p.is_columnar():
+                self.source = self.frame
+                self.frame = pandas.DataFrame(columns=p.columnar_index()['columns'])
+                p.unit.close()
+            else:
+                self.frame = p.read(format='pandas')
     
         ###
         # Find out what kind of map we got between the columns of data
@@ -173,6 +180,32 @@ class Pandas2XML:
         self.root.append(ET.Comment('Data generated by Canoe on {}'.format(uu.now_as_string())))
 
 
+    def _chunks(self) -> Iterator[pandas.DataFrame]:
+        """
+        The frame a piece at a time: the chunks of the columnar source
+        file, if there is one, or else the frame itself.
+        """
+        if self.source is None:
+            yield self.frame
+            return
+
+        p = urpacker.URpacker()
+        if not p.attachIO(self.source, s_mode='read'):
+            raise Exception("Could not read from {}".format(self.source))
+        yield from p.iter_chunks(list(self.frame.columns))
+
+
+    def _load_frame(self) -> None:
+        """
+        Read all of a columnar source into self.frame, for the methods
+        that need the whole frame.
+        """
+        if self.source is None: return
+        frames = list(self._chunks())
+        if frames: self.frame = pandas.concat(frames, ignore_index=True)
+        self.source = None
+
+
     @trap
     def attachIO(self, filename:str) -> bool:
         """
@@ -201,6 +234,7 @@ class Pandas2XML:
 
         returns -- the number of records written.
         """
+        self._load_frame()
         return self.read_some(self.frame.shape[0])
     
 
@@ -212,6 +246,7 @@ class Pandas2XML:
         returns -- the number of rows written (might be less than
             the number requested).
         """
+        self._load_frame()
         if start > stop: 
             start, stop = stop, start
 
@@ -302,6 +337,132 @@ class Pandas2XML:
             sys.exit(os.EX_DATAERR)
 
 
+    @trap
+    def compile_plan(self) -> List[tuple]:
+        """
+        Work out, once, what read_one() works out for every cell: the
+        parts of each remapped name, and the tag and attributes of 
+        each part.
+
+        returns -- a list with one entry per column that appears in
+            the XML: (position in the frame, [(tag, attribs) for each 
+            enclosing node], (tag, attribs) of the node with the value).
+        """
+        plan = []
+        for j, column in enumerate(self.frame.columns):
+            try:
+                remapped_name = self.remap[column].split(self.sep)
+            except KeyError as e:
+                continue
+
+            parts = []
+            for name in remapped_name:
+                info = name.strip().split()
+                parts.append((info[0], self.shred_to_attribs(info[1:])))
+            plan.append((j, parts[:-1], parts[-1]))
+            if self.debug: tomb.tombstone(f"{column} -> {parts}")
+
+        return plan
+
+
+    @trap
+    def stream(self, chunk_rows:int=1000) -> int:
+        """
+        Write the XML to self.output without building the whole tree. 
+        The rows are made into elements a chunk at a time, serialized,
+        and dropped, so the tree does not grow with the number of rows.
+        The output is the same as read_all() followed by write().
+
+        The frame itself is another matter. A frame passed in, or read
+        from a pickled file, is already all in memory; only a chunk of
+        it is converted at a time. A columnar file is read a chunk at a
+        time, twice: once for the dtypes, and once for the rows.
+
+        chunk_rows -- the number of rows serialized at once.
+
+        returns -- the number of rows written.
+        """
+        plan = self.compile_plan()
+
+        ###
+        # read_one() gets its values from iloc[i], a Series of the frame's
+        # common dtype. To get the same strings, convert the columns to
+        # that dtype, unless it is object, in which case the values are
+        # left as they are. For a columnar file, the whole frame's dtypes
+        # are those that concat() gives the first rows of the chunks, and
+        # each chunk's columns are first cast to those.
+        ###
+        if self.source is None:
+            whole = self.frame
+        else:
+            heads = [ _.iloc[:1] for _ in self._chunks() ]
+            whole = pandas.concat(heads, ignore_index=True) if heads else self.frame
+        row_dtype = whole.iloc[0].dtype if len(whole) else object
+        column_dtypes = list(whole.dtypes)
+
+        def rows() -> Iterator[tuple]:
+            for chunk in self._chunks():
+                for i in range(0, len(chunk), chunk_rows):
+                    piece = [ chunk.iloc[i:i+chunk_rows, j] for j, _, _ in plan ]
+                    if self.source is not None:
+                        piece = [ c.astype(column_dtypes[j]) for c, (j, _, _) in zip(piece, plan) ]
+                    piece = ( [ c.array for c in piece ] if row_dtype == object 
+                        else [ c.astype(row_dtype) for c in piece ] )
+                    yield from zip(*piece)
+
+        ###
+        # Serialize the frame node with only the comment in it, and use
+        # that to get the opening and closing tags.
+        ###
+        top = ET.Element(self.frame_name)
+        top.append(self.root[0])
+        head = ET.tostring(top, encoding='us-ascii')
+        close = head[head.rindex(b'</'):]
+        start_tag = b'<' + close[2:]
+
+        def emit(holder:ET.Element) -> None:
+            if not len(holder): return
+            blob = ET.tostring(holder, encoding='us-ascii')
+            output.write(blob[len(start_tag):-len(close)])
+            holder.clear()
+
+        n = 0
+        with open(self.output, 'wb') as output:
+            output.write(head[:-len(close)])
+
+            holder = ET.Element(self.frame_name)
+            for values in rows():
+                row_node = ET.SubElement(holder, self.row_name)
+
+                ###
+                # new_or_find() returns the first child with the tag. 
+                # Children are only ever appended, so the first one 
+                # never changes, and we can remember it.
+                ###
+                firsts = {}
+                for (_, path, (tag, attribs)), value in zip(plan, values):
+                    sub_node = row_node
+                    for e, e_attribs in path:
+                        found = firsts.get((id(sub_node), e))
+                        if found is None:
+                            found = ET.SubElement(sub_node, e, attrib=e_attribs)
+                            firsts[id(sub_node), e] = found
+                        sub_node = found
+
+                    leaf = ET.SubElement(sub_node, tag, attrib=attribs)
+                    firsts.setdefault((id(sub_node), tag), leaf)
+                    leaf.text = uu.remove_zeros(str(value).strip(), self.nodotzero)
+
+                n += 1
+                if not n % chunk_rows: emit(holder)
+
+            emit(holder)
+            output.write(close)
+
+        if self.debug: tomb.tombstone(f"{n} rows written to {self.output}")
+        return n
+
+
     ###
     # These functions provide the translation.
     ###
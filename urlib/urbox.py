@@ -22,14 +22,20 @@ __license__ = 'MIT'
 import license
 
 # Builtin packages.
+import base64
+import concurrent.futures
 import enum
 import fnmatch
 import glob
+import hashlib
 from http import HTTPStatus
+import json
 import os
 import pprint
+import re
 import requests
 import sys
+import threading
 import time
 import uuid
 
@@ -102,6 +108,53 @@ BOXCODES = uu.SloppyDict({
     "DELETE":   [HTTPStatus.NO_CONTENT]
     })
 
+# Files larger than this go up in parts, through an upload session,
+# rather than in one POST. (Box will not open a session for a file
+# smaller than 20MB.)
+chunked_threshold = int(os.environ.get('CANOE_BOX_CHUNKED_MB', 50)) << 20
+upload_workers = int(os.environ.get('CANOE_BOX_UPLOAD_WORKERS', 4))
+part_attempts = 3
+download_block_size = 1 << 20
+
+# The listings of the folders we have browsed, by folder id. Each is
+# (etag, content_modified_at, total_count, {name: id}), and it is used 
+# again for as long as Box says the folder has not changed.
+listings = {}
+listings_lock = threading.Lock()
+browse_workers = int(os.environ.get('CANOE_BOX_BROWSE_WORKERS', 4))
+
+# How many files get() and put() move at once.
+transfer_workers = int(os.environ.get('CANOE_BOX_TRANSFER_WORKERS', 4))
+
+
+def forget_listing(*box_folder_ids:str) -> None:
+    """
+    We changed these folders ourselves; do not trust their listings.
+    """
+    with listings_lock:
+        for _ in box_folder_ids: listings.pop(str(_), None)
+
+commit_attempts = 10
+# A commit that fails with one of these, or with no answer at all,
+# is tried again; other 4xx mean that Box has rejected the upload.
+retry_statuses = (HTTPStatus.UNAUTHORIZED, HTTPStatus.TOO_MANY_REQUESTS)
+
+
+def box_sha1(data:bytes) -> str:
+    """
+    Box wants its digests base64 encoded, not in hex.
+    """
+    return base64.b64encode(hashlib.sha1(data).digest()).decode('ascii')
+
+
+def file_sha1(filename:str) -> str:
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(block)
+    return base64.b64encode(hasher.digest()).decode('ascii')
+
+
 class URBoxHOP(tcsp.URTCSPHOP):
     """
     Box specific operations modeled on the base class.
@@ -191,6 +244,17 @@ class URBoxHOP(tcsp.URTCSPHOP):
 
         returns -- a string representation of the access token.
         """
+        return self._get_access_token_and_lifetime()[0]
+
+
+    @trap
+    def _get_access_token_and_lifetime(self) -> Tuple[str, int]:
+        """
+        Sign a JWT and trade it for an oauth2 token. Box tells us how long
+        the token is good for in expires_in.
+
+        returns -- the access token, and its lifetime in seconds.
+        """
         subject_type = 'user'
         subject_id = self._config['app-user-id']
         
@@ -213,7 +277,8 @@ class URBoxHOP(tcsp.URTCSPHOP):
                  "client_secret": self._config['client-secret'] }
 
         response = self._do_post(url, expected_codes=BOXCODES.OK, headers=headers, data=body)
-        return response.json()['access_token']
+        token = response.json()
+        return token['access_token'], int(token.get('expires_in', 3600))
 
 
     @trap
@@ -242,6 +307,7 @@ class URBoxHOP(tcsp.URTCSPHOP):
             self.box_folder_info = self.browse(cloud_folder_id=cloud_folder_id)
 
         url = f"https://api.box.com/2.0/files/{self.box_folder_info[filename]}"
+        forget_listing(box_folder_id)
         response = self._do_delete(url, expected_codes=BOXCODES.DELETE)
         return True if response.status_code in BOXCODES.DELETE else False
 
@@ -266,19 +332,85 @@ class URBoxHOP(tcsp.URTCSPHOP):
         # OK let's do this.
         box_file_id = self.box_folder_info[filename]
         uu.tombstone(f"{box_file_id} corresponds to {filename}")
-        url = f'https://api.box.com/2.0/files/{box_file_id}/content'
-        response = self._do_get(url, expected_codes=BOXCODES.OK)
-        uu.tombstone(f"_do_get yields {response}")
-
         try:
-            with open(local_filename,'wb') as download_file:
-                download_file.write(response.content)
-            uu.tombstone(f"wrote {local_filename}")
-            return True
+            return self._download(box_file_id, local_filename)
 
         except Exception as e:
             tomb.tombstone(uu.type_and_text(e))
             return False
+
+
+    def _download(self, box_file_id:str, local_filename:str) -> bool:
+        """
+        Stream the file to a .part file, a block at a time, and give it
+        its real name only once its SHA1 matches the one Box has for it.
+        The .part is named for that SHA1, so if one is already there 
+        from an earlier attempt, it is a piece of this version of the
+        file, and we ask Box for the rest of it rather than all of it.
+
+        returns -- True if it worked, False otherwise.
+        """
+        info = self._do_get(f'https://api.box.com/2.0/files/{box_file_id}?fields=sha1,size',
+            expected_codes=BOXCODES.OK).json()
+        size = int(info['size'])
+        part = f"{local_filename}.{info['sha1']}.part"
+
+        # Pieces of other versions are no use. Match only this file's
+        # parts: a.csv must not take a.csv.bak.<sha1>.part with it.
+        where = os.path.dirname(local_filename) or '.'
+        mine = re.compile(re.escape(os.path.basename(local_filename)) + r'\.[0-9a-f]{40}\.part')
+        for stale in os.listdir(where):
+            if mine.fullmatch(stale) and stale != os.path.basename(part):
+                os.unlink(os.path.join(where, stale))
+
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        if offset > size: offset = 0
+
+        hasher = hashlib.sha1()
+        headers = self._build_bearer_token_header()
+        if offset:
+            with open(part, 'rb') as f:
+                for block in iter(lambda: f.read(download_block_size), b''):
+                    hasher.update(block)
+
+        # All of it arrived last time, but was never renamed.
+        if offset and offset == size:
+            if hasher.hexdigest() == info['sha1']:
+                os.replace(part, local_filename)
+                uu.tombstone(f"wrote {local_filename} from the {part} already here.")
+                return True
+            offset = 0
+            hasher = hashlib.sha1()
+
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            uu.tombstone(f"resuming {local_filename} at {offset} of {size} bytes.")
+
+        start = time.time()
+        url = f'https://api.box.com/2.0/files/{box_file_id}/content'
+        with self._do_get(url, expected_codes=[HTTPStatus.OK, HTTPStatus.PARTIAL_CONTENT],
+                headers=headers, stream=True) as response:
+
+            # Box may send all of it anyway.
+            if offset and response.status_code == HTTPStatus.OK:
+                offset = 0
+                hasher = hashlib.sha1()
+
+            with open(part, 'ab' if offset else 'wb') as f:
+                for block in response.iter_content(download_block_size):
+                    hasher.update(block)
+                    f.write(block)
+
+        if hasher.hexdigest() != info['sha1']:
+            uu.tombstone(f"{local_filename} does not match the SHA1 from Box; discarded.")
+            os.unlink(part)
+            return False
+
+        os.replace(part, local_filename)
+        elapsed = max(time.time() - start, 1e-6)
+        uu.tombstone(f"wrote {local_filename}: {(size-offset)/2**20:.1f} MB in "
+            f"{elapsed:.1f}s ({(size-offset)/2**20/elapsed:.1f} MB/s).")
+        return True
         
 
     @trap
@@ -316,6 +448,7 @@ class URBoxHOP(tcsp.URTCSPHOP):
                 return False
 
         # decide if we are updating or uploading
+        forget_listing(box_folder_id)
         foo = ( self._update_file if 
                     filename_in_box in self.box_folder_info and klobber is not None 
                 else self._upload_file )
@@ -351,6 +484,9 @@ class URBoxHOP(tcsp.URTCSPHOP):
 
         try:
             box_file_id = self.box_folder_info[filename_in_box]
+            if os.path.getsize(filename) > chunked_threshold:
+                return self._chunked_upload(filename, box_file_id=box_file_id)
+
             with open(filename, 'rb') as upload_file:
                 url = f'https://upload.box.com/api/2.0/files/{box_file_id}/content'
                 response = self._do_post(url,
@@ -379,6 +515,9 @@ class URBoxHOP(tcsp.URTCSPHOP):
         filename_in_box = fname.Fname(filename).fname
 
         try:
+            if os.path.getsize(filename) > chunked_threshold:
+                return self._chunked_upload(filename, box_folder_id=box_folder_id)
+
             with open(filename,'rb') as upload_file:
                 url = 'https://upload.box.com/api/2.0/files/content'
                 body = { "attributes": '{ "name":"' + filename_in_box + '", "parent": {"id": "' + box_folder_id  + '"} }' }
@@ -394,6 +533,168 @@ class URBoxHOP(tcsp.URTCSPHOP):
             return False
 
 
+    @trap
+    def _chunked_upload(self,
+            filename:str,
+            box_folder_id:str=None,
+            box_file_id:str=None) -> bool:
+        """
+        Upload a large file in parts, through a Box upload session. The
+        parts go up several at a time, each with its SHA1, and a part 
+        that fails is tried again by itself. The session is remembered 
+        in filename.boxsession, so that if the upload does not finish, 
+        the next attempt sends only the parts that are missing.
+
+        filename      -- the local, fully qualified filename.
+        box_folder_id -- where a new file goes.
+        box_file_id   -- if given, the upload is a new version of this file.
+
+        returns -- True if it worked, False otherwise.
+        """
+        size = os.path.getsize(filename)
+        start = time.time()
+        state = self._upload_session(filename, size, box_folder_id, box_file_id)
+        endpoints = state['session']['session_endpoints']
+        part_size = int(state['session']['part_size'])
+        offsets = [ _ for _ in range(0, size, part_size) if str(_) not in state['parts'] ]
+        lock = threading.Lock()
+
+        def send_part(offset:int) -> bool:
+            with open(filename, 'rb') as f:
+                f.seek(offset)
+                data = f.read(part_size)
+
+            for attempt in range(1, part_attempts+1):
+                headers = self._build_bearer_token_header()
+                headers.update({'Content-Type': 'application/octet-stream',
+                    'Digest': 'sha=' + box_sha1(data),
+                    'Content-Range': f'bytes {offset}-{offset+len(data)-1}/{size}'})
+                try:
+                    response = self._do_put(endpoints['upload_part'], 
+                        expected_codes=BOXCODES.OK, headers=headers, data=data)
+                    with lock:
+                        state['parts'][str(offset)] = response.json()['part']
+                        self._save_upload_state(filename, state)
+                    return True
+
+                except Exception as e:
+                    tomb.tombstone(f"part at {offset} of {filename} failed (try {attempt}): {uu.type_and_text(e)}")
+
+            return False
+
+        with concurrent.futures.ThreadPoolExecutor(upload_workers + 1) as pool:
+            digest = pool.submit(file_sha1, filename)
+            sent = all(pool.map(send_part, offsets))
+
+        if not sent:
+            tomb.tombstone(f"{filename} is not all there; the next try will pick up where this one stopped.")
+            return False
+
+        parts = sorted(state['parts'].values(), key=lambda p: p['offset'])
+        for attempt in range(commit_attempts):
+            headers = self._build_bearer_token_header()
+            headers.update({'Content-Type': 'application/json', 'Digest': 'sha=' + digest.result()})
+            try:
+                response = self._do_post(endpoints['commit'], 
+                    expected_codes=[HTTPStatus.CREATED, HTTPStatus.ACCEPTED],
+                    headers=headers, data=json.dumps({'parts': parts}))
+
+            except tcsp.URTCSPException as e:
+                status = e.status
+                tomb.tombstone(f"commit of {filename} failed: {uu.type_and_text(e)}")
+                if status is not None and 400 <= status < 500 and status not in retry_statuses:
+                    # Box did not like what it got. Start again next time.
+                    self._abort_upload(filename, state)
+                    return False
+
+                # The network, or Box, is having trouble; the parts are
+                # safe with Box, so try the commit again.
+                time.sleep(min(2 ** attempt, 30))
+                continue
+
+            if response.status_code == HTTPStatus.CREATED: break
+
+            # Box is still putting the parts together.
+            time.sleep(int(response.headers.get('Retry-After', 1)))
+        else:
+            tomb.tombstone(f"commit of {filename} was never finished; the next try will commit it.")
+            return False
+
+        self._forget_upload_state(filename)
+        elapsed = max(time.time() - start, 1e-6)
+        tomb.tombstone(f"{filename}: {size/2**20:.1f} MB in {len(parts)} parts, "
+            f"{elapsed:.1f}s ({size/2**20/elapsed:.1f} MB/s).")
+        return True
+
+
+    def _upload_session(self, 
+            filename:str, 
+            size:int, 
+            box_folder_id:str, 
+            box_file_id:str) -> dict:
+        """
+        Pick up the session from an earlier attempt to upload this file, 
+        if the file has not changed and Box still has the session, or 
+        open a new one.
+        """
+        key = [size, os.stat(filename).st_mtime, box_folder_id, box_file_id]
+        try:
+            with open(filename + '.boxsession') as f:
+                state = json.load(f)
+            if state['key'] == key:
+                self._do_get(state['session']['session_endpoints']['status'], 
+                    expected_codes=BOXCODES.OK)
+                tomb.tombstone(f"resuming {filename} with {len(state['parts'])} of "
+                    f"{state['session']['total_parts']} parts already sent.")
+                return state
+
+        except FileNotFoundError as e:
+            pass
+
+        except Exception as e:
+            tomb.tombstone(f"cannot resume {filename}: {uu.type_and_text(e)}")
+
+        if box_file_id is None:
+            url = 'https://upload.box.com/api/2.0/files/upload_sessions'
+            body = {'folder_id': box_folder_id, 'file_size': size, 
+                'file_name': fname.Fname(filename).fname}
+        else:
+            url = f'https://upload.box.com/api/2.0/files/{box_file_id}/upload_sessions'
+            body = {'file_size': size}
+
+        response = self._do_post(url, expected_codes=BOXCODES.CREATE, json=body)
+        state = {'key': key, 'session': response.json(), 'parts': {}}
+        self._save_upload_state(filename, state)
+        return state
+
+
+    def _save_upload_state(self, filename:str, state:dict) -> None:
+        try:
+            with open(filename + '.boxsession.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(filename + '.boxsession.tmp', filename + '.boxsession')
+
+        except OSError as e:
+            # We can still upload it; we just cannot resume.
+            tomb.tombstone(f"cannot save the upload session of {filename}: {e}")
+
+
+    def _forget_upload_state(self, filename:str) -> None:
+        try:
+            os.unlink(filename + '.boxsession')
+        except FileNotFoundError as e:
+            pass
+
+
+    def _abort_upload(self, filename:str, state:dict) -> None:
+        try:
+            self._do_delete(state['session']['session_endpoints']['abort'], 
+                expected_codes=BOXCODES.DELETE)
+        except Exception as e:
+            tomb.tombstone(f"cannot abort the upload session of {filename}: {uu.type_and_text(e)}")
+        self._forget_upload_state(filename)
+
+
     @trap
     def _rename_file(self, 
         filename:str, 
@@ -419,6 +720,7 @@ class URBoxHOP(tcsp.URTCSPHOP):
 
         target_folder = cloud_folder_id if new_folder_id is None else new_folder_id
         target_filename = filename if new_filename is None else new_filename
+        forget_listing(cloud_folder_id, target_folder)
         
         try:
             self._do_put(url, expected_codes=BOXCODES.OK, 
@@ -429,39 +731,78 @@ class URBoxHOP(tcsp.URTCSPHOP):
             return 0
 
 
+    def _each_file(self, op:Callable, names:List[str]) -> List[bool]:
+        """
+        Call op(name) for each of the names, several at a time,
+        and keep what happened to each in self.results, in the order 
+        of the names. A file that raises an exception has failed; the
+        others carry on.
+
+        returns -- the list of results, True or False.
+        """
+        def one(name:str) -> bool:
+            try:
+                return bool(op(name))
+            except Exception as e:
+                tomb.tombstone(f"{name}: {uu.type_and_text(e)}")
+                return False
+
+        width = int(self._config.get('transfer-workers', transfer_workers))
+        with concurrent.futures.ThreadPoolExecutor(max(1, min(width, len(names) or 1))) as pool:
+            self.results = list(zip(names, pool.map(one, names)))
+
+        failed = [ name for name, ok in self.results if not ok ]
+        if failed: tomb.tombstone(f"{len(failed)} of {len(names)} files failed: {failed}")
+        return [ ok for name, ok in self.results ]
+
+
     ######################
     ### Public methods ###
     ######################
 
     @trap
     def browse(self, cloud_folder_id: str) -> uu.SloppyDict:
+        """
+        The names and ids of everything in the folder. The pages of the
+        listing are fetched several at a time, and the listing is kept,
+        so that browsing a folder that has not changed costs only the
+        request for the folder's description. The folder's etag alone 
+        is not trusted to change when someone else adds a file, so its
+        content_modified_at and item count must match, too.
+        """
         
         tomb.tombstone(f'browsing {cloud_folder_id}')
+        cloud_folder_id = str(cloud_folder_id)
+        with listings_lock:
+            cached = listings.get(cloud_folder_id)
+
         folder_info = self._get_folder_info(cloud_folder_id)
-        item_count = int(folder_info.item_collection.total_count)
-        folder_items = {}
-        
-        offset = 0
-        original_block_size = 997
-        block_size = 997 # This is tunable. 
+        version = (folder_info.get('etag'), folder_info.get('content_modified_at'),
+            int(folder_info.item_collection.total_count))
+        if cached and version == cached[:3]:
+            tomb.tombstone(f'{len(cached[3])} files in {cloud_folder_id} have not changed.')
+            return uu.deepsloppy(dict(cached[3]))
 
-        while len(folder_items) < item_count:
+        item_count = version[2]
+        block_size = 997 # This is tunable. 
 
-            uu.tombstone(f"folder_items: {len(folder_items)} item_count: {item_count}")
+        def page(offset:int) -> dict:
             url = f'https://api.box.com/2.0/folders/{cloud_folder_id}/items?limit={block_size}&offset={offset}'
             response = self._do_get(url, expected_codes=BOXCODES.OK)
+            return { e['name']: e['id'] for e in response.json()['entries'] }
 
-            folder_items.update({ e['name']: e['id'] 
-                for e in response.json()['entries'] })
-            offset += original_block_size
-        else:
-            uu.tombstone(f"Exiting while loop with offset={offset}")
+        folder_items = {}
+        offsets = range(0, item_count, block_size)
+        with concurrent.futures.ThreadPoolExecutor(max(1, min(browse_workers, len(offsets)))) as pool:
+            for items in pool.map(page, offsets):
+                folder_items.update(items)
     
-        folder_keys = sorted(list(folder_items.keys()))
-        folder_items = {k:folder_items[k] for k in folder_keys}
+        folder_items = { k:folder_items[k] for k in sorted(folder_items) }
+        with listings_lock:
+            listings[cloud_folder_id] = version + (folder_items,)
 
         tomb.tombstone(f'{len(folder_items)} files in {cloud_folder_id} browsed.')
-        return uu.deepsloppy(folder_items)
+        return uu.deepsloppy(dict(folder_items))
 
 
     @trap
@@ -484,6 +825,7 @@ class URBoxHOP(tcsp.URTCSPHOP):
 
         url = 'https://api.box.com/2.0/folders'
         body = f'{{ "name":"{folder_name}", "parent": {{"id":"{parent_folder_id}"}} }}'
+        forget_listing(parent_folder_id)
         response = self._do_post(url, expected_codes=BOXCODES.CREATE, data=body)
         return str(response.json()['id'])
 
@@ -491,6 +833,7 @@ class URBoxHOP(tcsp.URTCSPHOP):
     @trap
     def delete_folder(self, cloud_folder_id: str, recursive: bool = False):
         url = f'https://api.box.com/2.0/folders/{cloud_folder_id}'
+        forget_listing(cloud_folder_id)
         response = self._do_delete(url, expected_codes=BOXCODES.DELETE,
                                    params={"recursive": str(recursive).lower()})
         return response.status_code in BOXCODES.DELETE
@@ -510,15 +853,16 @@ class URBoxHOP(tcsp.URTCSPHOP):
         local_dir -- Where we are downloading to.
         klobber -- True or False whether we overwrite an existing file.
 
-        returns  -- number of files gotten.
+        returns  -- number of files gotten. What happened to each file is in
+            self.results.
         """
 
         if self.box_folder_info is None:
             self.box_folder_info = self.browse(box_folder_id)
         source_files = fnmatch.filter(self.box_folder_info.keys(), filename)
 
-        result = sum([ self._get_single_file(box_folder_id, filename, local_dir, klobber) 
-            for f in source_files ])
+        result = sum(self._each_file(lambda f: 
+            self._get_single_file(box_folder_id, f, local_dir, klobber), source_files))
         if not result: self.box_folder_info = None
         return result
 
@@ -537,14 +881,16 @@ class URBoxHOP(tcsp.URTCSPHOP):
                     False: don't overwrite existing
                     None:  remove existing, then upload (prevents versions).
 
-        returns  -- number of files put.
+        returns  -- number of files put. What happened to each file is in
+            self.results.
         """
 
         if self.box_folder_info is None:
             self.box_folder_info = self.browse(box_folder_id)
             
-        return len([ self._put_single_file(box_folder_id, fname.Fname(f).fqn, klobber) 
-            for f in glob.glob(filename) ])
+        return sum(self._each_file(lambda f:
+            self._put_single_file(box_folder_id, fname.Fname(f).fqn, klobber), 
+            glob.glob(filename)))
         
 
     @trap
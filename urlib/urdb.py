@@ -359,6 +359,47 @@ class URdb:
         return rows if first_word == 'SELECT' else self.row_count
 
 
+    def fetch_batches(self, sql:str, batch_size:int=5000) -> Iterator[List[uu.SloppyDict]]:
+        """
+        The streaming alternative to execute_SQL() for a SELECT. Rather 
+        than build a DataFrame of the whole result set (and then three
+        more copies of it), fetch batch_size rows at a time and yield 
+        each batch as a list of row dicts, in the same form that
+        execute_SQL() returns: NULLs become ''. The values are the 
+        driver's, not pandas': a NUMBER column with NULLs in it yields 
+        5 where execute_SQL() yields 5.0.
+
+        sql -- a SELECT statement.
+        batch_size -- rows per round trip to the database, and per batch.
+
+        yields -- lists of at most batch_size rows. self.selected_columns
+            is set before the first batch, and self.row_count is the
+            running total.
+
+        raises -- an Exception if there is no connection, so that the
+            writer consuming the batches fails (where execute_SQL() 
+            would return None) rather than writing an empty result.
+        """
+        if not self._db: raise Exception("no database connection.")
+
+        self.row_count = 0
+        this_cursor = self._db.cursor()
+        this_cursor.arraysize = batch_size
+        try:
+            this_cursor.execute(str(sql))
+            self.selected_columns = [ _[0] for _ in this_cursor.description ]
+            while True:
+                rows = this_cursor.fetchmany(batch_size)
+                if not rows: break
+                self.row_count += len(rows)
+                yield [ uu.SloppyDict(zip(self.selected_columns, 
+                            ( '' if v is None else v for v in row ))) 
+                        for row in rows ]
+
+        finally:
+            this_cursor.close()
+
+
     @show_exceptions_and_frames
     def get_lines(self) -> List[str]:
         """ 
@@ -4,14 +4,20 @@ import typing
 from   typing import *
 
 import bz2
+import io
 import json
 import math
+import mmap
 import os
 import pickle
+import struct
 import sys
 import tempfile
+import time
+import zlib
 
 import cx_Oracle
+import numpy
 import pandas
 
 # Canøe imports
@@ -57,6 +63,33 @@ def enum_to_int(e:object) -> object:
 built_in_hooks = [enum_to_int, set_to_list, timestamp_to_str]
 null_key = bytes.fromhex('00')
 
+###
+# The columnar format. The file is laid out this way:
+#
+#   Bytes  0-9:  the same version header as object code, so that
+#                uu.is_canoe_code() accepts the file.
+#   Bytes 10-17: columnar_magic
+#   Bytes 18-25: the offset of the index, little endian.
+#   Bytes 26-  : the column blocks, one per column per chunk, each
+#                compressed on its own.
+#   The index:   JSON, from its offset to the end of the file.
+#
+# The index is written last (and its offset patched in) so that the
+# chunks can be written as they arrive. Numeric columns are stored as
+# the raw bytes of their numpy arrays; anything else is pickled.
+###
+columnar_version = b'canoe20c00'
+columnar_magic   = b'URCOLS01'
+columnar_offset  = struct.Struct('<Q')
+columnar_preamble = len(columnar_version) + len(columnar_magic) + columnar_offset.size
+
+codecs = {
+    'none': (lambda b: b, lambda b: b),
+    'zlib': (lambda b: zlib.compress(b, 1), zlib.decompress),
+    'bz2':  (bz2.compress, bz2.decompress)
+    }
+
+
 class URpacker: 
     pass
 
@@ -219,6 +252,192 @@ class URpacker:
             self.unit = None
 
     
+    @trap
+    def write_batches(self, batches:Iterable[list], *,
+            show_stats:bool=False) -> int:
+        """
+        Like write(), but for data that arrive a piece at a time. Each
+        batch (a list) is pickled and pushed through the compressor as
+        it arrives, so only one batch is ever in memory. read() puts 
+        the batches back together as one list.
+
+        batches -- an iterable of lists, e.g., URdb.fetch_batches().
+        show_stats -- whether to write the progress/results to stderr.
+
+        returns -- the number of items written, or None on failure.
+        """
+        n = 0
+        compressor = bz2.BZ2Compressor()
+        try:
+            for batch in batches:
+                self.unit.write(compressor.compress(pickle.dumps(batch)))
+                n += len(batch)
+                show_stats and uu.tombstone(f'{n} items written.')
+
+            # An empty result set is still an (empty) list.
+            if not n: self.unit.write(compressor.compress(pickle.dumps([])))
+            self.unit.write(compressor.flush())
+            return n
+
+        except Exception as e:
+            uu.tombstone(uu.type_and_text(e))
+            return None   
+
+        finally:
+            self.unit.close()
+            self.unit = None
+
+
+    @trap
+    def write_columnar(self, data:Union[pandas.DataFrame, Iterable], *,
+            chunk_rows:int=65536,
+            codec:str='zlib',
+            show_stats:bool=False,
+            object_code:bytes=None) -> int:
+        """
+        Write the data in the columnar format. Unlike write(), the data
+        are not pickled as a whole, and a reader can get to any chunk 
+        or column without unpacking the rest of the file.
+
+        data -- a DataFrame, or an iterable of batches (lists of dicts, 
+            or DataFrames) such as URdb.fetch_batches(). A DataFrame is
+            cut into chunks of chunk_rows; batches are written as chunks
+            just as they arrive.
+        chunk_rows -- rows per chunk when data is a DataFrame.
+        codec -- one of the keys in codecs.
+        show_stats -- whether to write the progress/results to stderr.
+        object_code -- the 10 byte version header. 
+
+        returns -- the number of rows written, or None on failure.
+        """
+        compress, _ = codecs[codec]
+        if isinstance(data, pandas.DataFrame):
+            chunk_rows = max(1, int(chunk_rows))
+            frame = data
+            data = ( frame.iloc[i:i+chunk_rows] for i in range(0, len(frame), chunk_rows) )
+
+        index = {'codec':codec, 'columns':None, 'rows':0, 'chunks':[]}
+        try:
+            self.unit.write((object_code or columnar_version) + 
+                columnar_magic + columnar_offset.pack(0))
+
+            for chunk in data:
+                if not isinstance(chunk, pandas.DataFrame):
+                    chunk = pandas.DataFrame.from_records(chunk)
+                if index['columns'] is None:
+                    index['columns'] = [ str(c) for c in chunk.columns ]
+                if not len(chunk): continue
+
+                blocks = []
+                for name in index['columns']:
+                    column = chunk[name]
+                    if isinstance(column.dtype, numpy.dtype) and column.dtype.kind in 'biufmM':
+                        dtype, raw = column.dtype.str, column.to_numpy().tobytes()
+                    else:
+                        dtype, raw = 'object', pickle.dumps(column.tolist(), 
+                            protocol=pickle.HIGHEST_PROTOCOL)
+                    raw = compress(raw)
+                    blocks.append([self.unit.tell(), len(raw), dtype])
+                    self.unit.write(raw)
+
+                index['chunks'].append({'rows':len(chunk), 'blocks':blocks})
+                index['rows'] += len(chunk)
+                show_stats and uu.tombstone(f"{index['rows']} rows written.")
+
+            index['columns'] = index['columns'] or []
+            where = self.unit.tell()
+            self.unit.write(json.dumps(index).encode('utf-8'))
+            self.unit.seek(columnar_preamble - columnar_offset.size, 0)
+            self.unit.write(columnar_offset.pack(where))
+            return index['rows']
+
+        except Exception as e:
+            uu.tombstone(uu.type_and_text(e))
+            return None
+
+        finally:
+            self.unit.close()
+            self.unit = None
+
+
+    def is_columnar(self) -> bool:
+        """
+        Peek at the attached unit to see if it was written by 
+        write_columnar().
+        """
+        if self.unit is None: return False
+        self.unit.seek(0, 0)
+        preamble = self.unit.read(columnar_preamble)
+        self.unit.seek(0, 0)
+        return (len(preamble) == columnar_preamble and
+            preamble[10:18] == columnar_magic)
+
+
+    @staticmethod
+    def _columnar_index(m:mmap.mmap) -> dict:
+        where, = columnar_offset.unpack(m[18:columnar_preamble])
+        return json.loads(m[where:].decode('utf-8'))
+
+
+    def columnar_index(self) -> dict:
+        """
+        returns -- the index of a columnar file: the codec, the column
+            names, the number of rows, and where every block is.
+        """
+        with mmap.mmap(self.unit.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return URpacker._columnar_index(m)
+
+
+    def iter_chunks(self, columns:List[str]=None) -> Iterator[pandas.DataFrame]:
+        """
+        Memory-map a columnar file and yield its chunks, one DataFrame
+        at a time. Only the blocks for the requested columns are read 
+        and decompressed. The unit is closed when the iteration ends.
+
+        columns -- the names of the columns to read. None means all of them.
+        """
+        try:
+            with mmap.mmap(self.unit.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                index = URpacker._columnar_index(m)
+                _, decompress = codecs[index['codec']]
+                wanted = [ (i, c) for i, c in enumerate(index['columns'])
+                    if columns is None or c in columns ]
+
+                for chunk in index['chunks']:
+                    frame = {}
+                    for i, name in wanted:
+                        offset, length, dtype = chunk['blocks'][i]
+                        raw = decompress(m[offset:offset+length])
+                        frame[name] = ( pickle.loads(raw) if dtype == 'object' 
+                            else numpy.frombuffer(raw, dtype=numpy.dtype(dtype)) )
+                    yield pandas.DataFrame(frame, columns=[ c for _, c in wanted ])
+
+        finally:
+            self.unit.close()
+            self.unit = None
+
+
+    def _read_columnar(self, format:str) -> object:
+        columns = self.columnar_index()['columns']
+        frames = list(self.iter_chunks())
+        frame = (pandas.concat(frames, ignore_index=True) if frames 
+            else pandas.DataFrame(columns=columns))
+        return frame if format == 'pandas' else frame.to_dict('records')
+
+
+    @staticmethod
+    def _unpickle_all(data:bytes) -> object:
+        """
+        Undo a write() or a write_batches(). The latter leaves several
+        pickled lists, end to end, that are joined back into one.
+        """
+        stream = io.BytesIO(data)
+        pyobj = pickle.load(stream)
+        while stream.tell() < len(data):
+            pyobj.extend(pickle.load(stream))
+        return pyobj
+
+
     @trap
     def read(self, format:str='python') -> object:
         """
@@ -239,6 +458,9 @@ class URpacker:
             uu.tombstone('No unit attached.')
             return None
 
+        if format != 'raw' and self.is_columnar():
+            return self._read_columnar(format)
+
         self.unit.seek(0, 0)
         as_read_data = self.unit.read()
         header = as_read_data[:20]
@@ -258,7 +480,7 @@ class URpacker:
                 data = bz2.decompress(as_read_data)
 
             try:
-                pyobj = pickle.loads(data)
+                pyobj = URpacker._unpickle_all(data)
                 if format == 'python': 
                     return pyobj
                 elif format == 'pandas': 
@@ -290,9 +512,53 @@ if __name__ == '__main__':
     p.add_argument('--raw-input', type=str, default="")
     p.add_argument('-i', '--input', type=str, default="")
     p.add_argument('-o', '--output', type=str, default='')
+    p.add_argument('--benchmark', type=int, default=0,
+        help="compare pickle+bz2 with the columnar format on a frame of this many rows.")
 
     opts = p.parse_args()
 
+    if opts.benchmark:
+        rng = numpy.random.default_rng(1)
+        n = opts.benchmark
+        frame = pandas.DataFrame({
+            'id': numpy.arange(n, dtype='int64'),
+            'amount': rng.random(n) * 1000,
+            'count': rng.integers(0, 100, n),
+            'when': pandas.date_range('2020-01-01', periods=n, freq='s'),
+            'name': [ f"name{i % 5000}" for i in range(n) ]
+            })
+        where = tempfile.mkdtemp()
+        print(f"{n} rows, {len(frame.columns)} columns")
+
+        def timed(label:str, f:Callable) -> object:
+            start = time.perf_counter()
+            result = f()
+            print(f"  {label:<32} {time.perf_counter()-start:8.2f}s")
+            return result
+
+        def packer(filename:str, s_mode:str) -> URpacker:
+            _ = URpacker()
+            _.attachIO(os.path.join(where, filename), s_mode=s_mode)
+            return _
+
+        print("pickle + bz2")
+        timed("write", lambda: packer('old', 'write').write(frame.to_dict('records')))
+        print(f"  {'size':<32} {os.path.getsize(os.path.join(where, 'old')):8d} bytes")
+        timed("read all", lambda: packer('old', 'read').read('pandas'))
+        timed("read one column", lambda: packer('old', 'read').read('pandas')['amount'].sum())
+
+        for codec in ('zlib', 'none'):
+            print(f"columnar + {codec}")
+            timed("write", lambda: packer(codec, 'write').write_columnar(frame, codec=codec))
+            print(f"  {'size':<32} {os.path.getsize(os.path.join(where, codec)):8d} bytes")
+            timed("read all", lambda: packer(codec, 'read').read('pandas'))
+            timed("read one column", lambda: sum(c['amount'].sum()
+                for c in packer(codec, 'read').iter_chunks(['amount'])))
+
+        for f in os.listdir(where): os.unlink(os.path.join(where, f))
+        os.rmdir(where)
+        sys.exit(os.EX_OK)
+
     if not opts.input or opts.raw_input:
         print('At least one of --input and --raw-input is required.')
         sys.exit(os.EX_DATAERR)
@@ -27,10 +27,15 @@ from abc import *
 import enum
 import functools
 import glob
+import hashlib
 from http import HTTPStatus
 import os
 import pprint
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import sqlite3
+import threading
 import time
 #import typing
 #from typing import *
@@ -46,6 +51,128 @@ import urexception as ue
 import urutils as uu
 import fname as fn
 
+class TokenCache:
+    """
+    Access tokens, keyed by whatever identifies the account, kept until
+    margin seconds before they expire. The tokens are always kept in 
+    memory; if a filename is given they are also kept in a small SQLite 
+    database so that other processes (the other canoed workers, for 
+    example) can use them rather than asking for their own.
+    """
+
+    create_stmt = """create table if not exists tokens (
+        k text primary key, token text, expires real)"""
+    get_stmt = "select token, expires from tokens where k = ?"
+    put_stmt = "insert or replace into tokens (k, token, expires) values (?, ?, ?)"
+    forget_stmt = "delete from tokens where k = ?"
+
+    def __init__(self, filename:str=None, margin:int=60) -> None:
+        self.margin = margin
+        self.tokens = {}
+        self.filename = filename
+        self.db = None
+        # The upload, download and listing pools ask for tokens from
+        # their worker threads, so the connection is shared among them.
+        self.lock = threading.Lock()
+        if not filename: return
+
+        try:
+            is_new = not os.path.exists(filename)
+            self.db = sqlite3.connect(filename, timeout=5, check_same_thread=False)
+            self.db.execute(TokenCache.create_stmt)
+            self.db.commit()
+            # These are bearer tokens; nobody else needs to read them.
+            if is_new: os.chmod(filename, 0o600)
+
+        except Exception as e:
+            tomb.tombstone(f"Token cache {filename} is unavailable: {e}")
+            self.db = None
+
+
+    def get(self, k:str) -> Union[str, None]:
+        """
+        returns -- the token if we have one that is good for at least
+            margin more seconds, otherwise None.
+        """
+        with self.lock:
+            token, expires = self.tokens.get(k, (None, 0))
+            if token is None and self.db is not None:
+                try:
+                    row = self.db.execute(TokenCache.get_stmt, (k,)).fetchone()
+                    if row: token, expires = self.tokens[k] = row
+                except sqlite3.Error as e:
+                    tomb.tombstone(f"Token cache read failed: {e}")
+
+        return token if expires - self.margin > time.time() else None
+
+
+    def put(self, k:str, token:str, expires_in:int) -> str:
+        expires = time.time() + int(expires_in)
+        with self.lock:
+            self.tokens[k] = (token, expires)
+            if self.db is not None:
+                try:
+                    self.db.execute(TokenCache.put_stmt, (k, token, expires))
+                    self.db.commit()
+                except sqlite3.Error as e:
+                    tomb.tombstone(f"Token cache write failed: {e}")
+        return token
+
+
+    def forget(self, k:str) -> None:
+        with self.lock:
+            self.tokens.pop(k, None)
+            if self.db is not None:
+                try:
+                    self.db.execute(TokenCache.forget_stmt, (k,))
+                    self.db.commit()
+                except sqlite3.Error as e:
+                    tomb.tombstone(f"Token cache write failed: {e}")
+
+
+# One token cache and one requests.Session per process for each
+# distinct configuration. A forked child starts over with its own.
+_token_caches = {}
+_sessions = {}
+_owner = os.getpid()
+
+def _per_process(d:dict) -> dict:
+    global _owner
+    if os.getpid() != _owner:
+        _token_caches.clear()
+        _sessions.clear()
+        _owner = os.getpid()
+    return d
+
+
+def token_cache(filename:str=None, margin:int=60) -> TokenCache:
+    k = (filename, margin)
+    caches = _per_process(_token_caches)
+    if k not in caches: caches[k] = TokenCache(filename, margin)
+    return caches[k]
+
+
+def session(pool_size:int=10, retries:int=3) -> requests.Session:
+    """
+    A requests.Session keeps its connections alive, so only the first 
+    request to a host pays for the TLS handshake. Idempotent requests
+    that fail with a connection error or a 429/5xx are retried with
+    backoff; POSTs are not, because an upload's file has been read.
+    """
+    k = (pool_size, retries)
+    sessions = _per_process(_sessions)
+    if k not in sessions:
+        s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=Retry(total=retries, backoff_factor=0.5, 
+                status_forcelist=[429, 500, 502, 503, 504], 
+                raise_on_status=False))
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        sessions[k] = s
+    return sessions[k]
+
+
 class URTCSPHOP(uo.URObject,metaclass=ABCMeta):
     """
     """   
@@ -80,6 +207,23 @@ class URTCSPHOP(uo.URObject,metaclass=ABCMeta):
         #Set the klobber option
         self._default_klobber = default_klobber
         self.box_folder_info = None
+        #(filename, True/False) for each file of the last get() or put().
+        self.results = []
+
+        #Tokens are reused until they are within token-refresh-margin seconds
+        #of expiring. If token-cache names a file (or $CANOE_TOKEN_CACHE does),
+        #the tokens are shared with other processes through it.
+        self._token_cache = token_cache(
+            self._config.get('token-cache', os.environ.get('CANOE_TOKEN_CACHE')),
+            int(self._config.get('token-refresh-margin', 60)))
+        self._token_key = hashlib.sha256(repr(
+            [ (k, self._config.get(k)) for k in sorted(self._required_keys) ]
+            ).encode('utf-8')).hexdigest()
+
+        #All the verbs go through one pooled, keep-alive session.
+        self._session = session(
+            int(self._config.get('http-pool-size', 10)),
+            int(self._config.get('http-retries', 3)))
 
 
     ### Register methods
@@ -107,7 +251,10 @@ class URTCSPHOP(uo.URObject,metaclass=ABCMeta):
     ### Utility methods
     
     def _build_bearer_token_header(self) -> Dict:
-        access_token = self._get_access_token()
+        access_token = self._token_cache.get(self._token_key)
+        if access_token is None:
+            access_token = self._token_cache.put(self._token_key, 
+                *self._get_access_token_and_lifetime())
         return { "Authorization": "Bearer {0}".format(access_token) } 
 
     
@@ -117,10 +264,22 @@ class URTCSPHOP(uo.URObject,metaclass=ABCMeta):
         #If there are no headers in the provided args, set the headers to the bearer token.
         #If there are headers included, it is the responsibility of the caller to include
         #a bearer token
-        if not 'headers' in kwargs: kwargs['headers'] = self._build_bearer_token_header() 
+        use_bearer_token = not 'headers' in kwargs
+        if use_bearer_token: kwargs['headers'] = self._build_bearer_token_header() 
         try:
             #tomb.tombstone(uu.fcn_signature('requests_method', url, kwargs))
+            marks = self._body_marks(kwargs)
             response = requests_method(url, **kwargs) 
+
+            #A cached token may have been revoked before it expired. Get a
+            #new one and try once more, but only if the body can be sent 
+            #again: the first attempt has read any file objects to the end.
+            if use_bearer_token and response.status_code == HTTPStatus.UNAUTHORIZED:
+                self._token_cache.forget(self._token_key)
+                if marks is not None:
+                    for f, position in marks: f.seek(position)
+                    kwargs['headers'] = self._build_bearer_token_header()
+                    response = requests_method(url, **kwargs)
         except Exception as e:
             raise URTCSPException(exception=e)
 
@@ -130,19 +289,45 @@ class URTCSPHOP(uo.URObject,metaclass=ABCMeta):
         return response
 
 
+    @staticmethod
+    def _body_marks(kwargs:dict) -> Optional[List[Tuple[Any, int]]]:
+        """
+        Find the file objects in the files= or data= of a request, and
+        where each one is now, so that the body can be sent again.
+
+        returns -- a list of (file object, position) pairs, or None if 
+            some part of the body is a stream that cannot be rewound.
+        """
+        parts = []
+        files = kwargs.get('files') or {}
+        for f in (files.values() if isinstance(files, dict) else (_[1] for _ in files)):
+            parts.append(f[1] if isinstance(f, (tuple, list)) else f)
+        parts.append(kwargs.get('data'))
+
+        marks = []
+        for part in parts:
+            if part is None or isinstance(part, (str, bytes, bytearray, dict, list, tuple)):
+                continue
+            try:
+                marks.append((part, part.tell()))
+            except Exception as e:
+                return None
+        return marks
+
+
     def _do_get(self, url: str, expected_codes:  List[HTTPStatus], **kwargs) -> requests.models.Response:
-        return self._do_request(requests.get, url, expected_codes, **kwargs)
+        return self._do_request(self._session.get, url, expected_codes, **kwargs)
 
 
     def _do_post(self, url: str, expected_codes: List[HTTPStatus], **kwargs) -> requests.models.Response:
-        return self._do_request(requests.post, url, expected_codes, **kwargs)
+        return self._do_request(self._session.post, url, expected_codes, **kwargs)
 
     
     def _do_delete(self, url: str, expected_codes: List[HTTPStatus], **kwargs) -> requests.models.Response:
-        return self._do_request(requests.delete, url, expected_codes, **kwargs)
+        return self._do_request(self._session.delete, url, expected_codes, **kwargs)
     
     def _do_put(self, url: str, expected_codes: List[HTTPStatus], **kwargs) -> requests.models.Response:
-        return self._do_request(requests.put, url, expected_codes, **kwargs)
+        return self._do_request(self._session.put, url, expected_codes, **kwargs)
    
     @abstractmethod 
     def _get_access_token(self) -> str:
@@ -150,6 +335,15 @@ class URTCSPHOP(uo.URObject,metaclass=ABCMeta):
         Returns the next magic token to use for API calls
         """
         pass
+
+
+    def _get_access_token_and_lifetime(self) -> Tuple[str, int]:
+        """
+        Returns a new token and the number of seconds it is good for. 
+        Derived classes that are told the lifetime should override this;
+        otherwise we assume the token-lifetime in the config, or an hour.
+        """
+        return self._get_access_token(), int(self._config.get('token-lifetime', 3600))
     
     ### Public methods
 
@@ -60,6 +60,117 @@ def drill_baby_drill(remote_host_info:uu.SloppyDict, password:str=None) -> SSHCl
     return _getSSHConnection(remote_host_info, None, password)
 
 
+###
+# A recipe may visit the same host several times -- source, then 
+# remote_ops, then destination. Rather than authenticate each time,
+# connections are kept in this pool, keyed by (host, port, user, keys),
+# for the life of the job. The pool belongs to the process that 
+# filled it; a forked child starts with an empty one, and does not
+# touch the sockets it inherited. Call release_all() when the job
+# is finished.
+###
+_pool = {}
+_pool_owner = os.getpid()
+
+def _pool_key(info:uu.SloppyDict) -> tuple:
+    return (info.hostname, int(info.get('port', 22)), info.get('user'), 
+        tuple(uu.listify(info.get('identityfile'))))
+
+
+def _is_alive(client:SSHClient) -> bool:
+    """
+    Health check. An idle transport that the far end has dropped still
+    looks active until we try to write to it.
+    """
+    try:
+        t = client.get_transport()
+        if t is None or not t.is_active(): return False
+        t.send_ignore()
+        return True
+
+    except Exception as e:
+        return False
+
+
+def lease(remote_host_info:uu.SloppyDict, password:str=None) -> SSHClient:
+    """
+    Return a connected client for this host from the pool, connecting
+    (and adding it to the pool) only if there is no live one.
+
+    returns -- the SSHClient, or None if we cannot connect.
+    """
+    return lease_sftp(remote_host_info, password)[0]
+
+
+def lease_sftp(remote_host_info:uu.SloppyDict, 
+        password:str=None) -> Tuple[SSHClient, paramiko.SFTPClient]:
+    """
+    Like lease(), but also return the SFTP channel that goes with the
+    connection. The SFTP channel is opened once per connection.
+
+    returns -- (client, sftp) or (None, None)
+    """
+    global _pool, _pool_owner
+
+    if os.getpid() != _pool_owner:
+        _pool = {}
+        _pool_owner = os.getpid()
+
+    info = uu.SloppyDict(remote_host_info)
+    key = _pool_key(info)
+    client, sftp = _pool.get(key, (None, None))
+
+    if client is not None and _is_alive(client):
+        if sftp is None or sftp.get_channel().closed:
+            sftp = paramiko.SFTPClient.from_transport(client.get_transport())
+            _pool[key] = (client, sftp)
+        uu.tombstone(f"Reusing connection to {info.hostname}")
+        return client, sftp
+
+    if client is not None:
+        uu.tombstone(f"Connection to {info.hostname} has gone stale. Reconnecting.")
+        _close(client, sftp)
+
+    client = drill_baby_drill(info, password)
+    if client is None: 
+        _pool.pop(key, None)
+        return None, None
+
+    # Keep the transport from being dropped by firewalls while it
+    # sits in the pool between opcodes.
+    client.get_transport().set_keepalive(int(info.get('serveraliveinterval', 30)))
+    sftp = paramiko.SFTPClient.from_transport(client.get_transport())
+    _pool[key] = (client, sftp)
+    return client, sftp
+
+
+def _close(client:SSHClient, sftp:paramiko.SFTPClient=None) -> None:
+    for _ in (sftp, client):
+        try:
+            if _ is not None: _.close()
+        except Exception as e:
+            pass
+
+
+def release_all() -> int:
+    """
+    Close everything in the pool. 
+
+    returns -- the number of connections that were closed.
+    """
+    global _pool
+
+    if os.getpid() != _pool_owner: 
+        _pool = {}
+        return 0
+
+    n = len(_pool)
+    for client, sftp in _pool.values():
+        _close(client, sftp)
+    _pool = {}
+    return n
+
+
 @trap
 def _getSSHConnection(info:uu.SloppyDict, sock=None, password:str=None) -> object:
     """
@@ -1538,6 +1538,52 @@ def new_serial_number() -> str:
     return "{}{:0>2}{:0>2}.{:0>5}.{}".format(ahora.year, ahora.month, ahora.day, os.getpid(), suffix)
 
 
+def next_fire_time(after_minute:int, schedule:list, horizon:int=5*366) -> Union[int, None]:
+    """
+    Find the first minute of the epoch after after_minute that is in
+    the schedule, i.e., the next minute for which this_is_the_time()
+    would be True. Rather than testing each minute, we walk forward
+    a day at a time and only look at the hours and minutes in the
+    schedule for the days that match.
+
+    after_minute -- minutes since the epoch.
+    schedule -- [ minutes, hours, days, months, days-of-week ], as
+        produced by parse_schedule(). 
+    horizon -- how many days to look ahead before giving up.
+
+    returns -- minutes since the epoch, or None if the schedule does 
+        not fire within the horizon (e.g., @adhoc).
+    """
+    def ordered(s:set, universe:range) -> list:
+        return list(universe) if isinstance(s, Universal) else sorted(_ for _ in s if _ in universe)
+
+    minutes = ordered(schedule[0], range(60))
+    hours = ordered(schedule[1], range(24))
+    if not minutes or not hours: return None
+
+    start = crontuple_now(after_minute + 1)
+    day = start.date()
+    for _ in range(horizon):
+        if (day.day in schedule[2] and 
+            day.month in schedule[3] and 
+            day.isoweekday() % 7 in schedule[4]):
+            for h in hours:
+                if day == start.date() and h < start.hour: continue
+                for m in minutes:
+                    moment = datetime.datetime(day.year, day.month, day.day, h, m)
+                    if moment < start: continue
+                    candidate = int(moment.timestamp() // 60)
+                    # Local times that do not exist when the clocks spring
+                    # forward are skipped, just as they are when we check
+                    # minute by minute. The repeated hour in the fall is
+                    # only found once.
+                    if candidate > after_minute and this_is_the_time(candidate, schedule):
+                        return candidate
+        day += datetime.timedelta(days=1)
+
+    return None
+
+
 def normalize_phone_number(s: str) -> str:
     """ Remove the non-digits from the string. """
     t = []